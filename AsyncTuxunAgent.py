@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import json, asyncio
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from Cache import DiskCache
+from TuxunAgent import TuxunGame, TuxunAgentException
+
+
+class _RateLimiter():
+
+    def __init__(self, rate:float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.__next = 0
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        wait = self.__next - now
+        self.__next = max(now, self.__next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AsyncTuxunAgent():
+    '''Async Tuxun Agent, the asyncio version of `TuxunAgent` sharing one pooled HTTP session.'''
+
+    base_url = "https://tuxun.fun"
+    '''The base URL of the API server, can be replaced with a local server for testing.'''
+    game_ttl = 5
+    '''The time-to-live(s) of the cached game state.'''
+    rate_limits = {
+        'default': 10,
+        'joinRandom': 2
+    }
+    '''The maximum number of requests per second of each API endpoint.'''
+
+    def __init__(self, cache:DiskCache=None, max_connections:int=100, timeout:float=10):
+        '''
+        Initialize an AsyncTuxunAgent instance.
+        Use `async with` or call `close` to release the connections. Requires the optional `aiohttp` package.
+        :param cache: DiskCache object to cache the game state, `None` to disable.
+        :param max_connections: The maximum number of concurrent connections.
+        :param timeout: The timeout(s) of each request.
+        '''
+        if aiohttp is None:
+            raise ImportError("AsyncTuxunAgent requires aiohttp, install it by: pip install aiohttp")
+        self.cookie = ""
+        self.cache = cache
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.__session = None
+        self.__limiters = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        '''Close the shared HTTP session.'''
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
+
+    def set_cookie(self, cookie:str):
+        '''Set the Cookie to be used to interact with the server.'''
+        self.cookie = cookie
+
+    async def get_user_id(self):
+        '''Get the user ID of the current user.'''
+        try:
+            data = await self.__request('get_profile', "/api/get_profile")
+            if not data:
+                raise TuxunAgentException(f"No user ID returned.")
+            return str(data['userId'])
+        except Exception as e:
+            return e
+
+    async def get_user_rating(self, id:int):
+        '''Get the rating of the specified user.'''
+        try:
+            data = await self.__request('getProfile', "/api/v0/tuxun/getProfile", userId=id)
+            return data['rating']
+        except Exception as e:
+            return e
+
+    async def create(self, type='country', mode='streak'):
+        '''
+        Create a Tuxun Game.
+        :param type: 'country' or 'province'.
+        :param mode: 'streak'.
+        :returns: TuxunGame object if success.
+        '''
+        try:
+            return TuxunGame(await self.__request('create', f"/api/v0/tuxun/{mode}/create", type=type))
+        except Exception as e:
+            return e
+
+    async def get(self, id:str, mode='solo'):
+        '''
+        Get a given Tuxun Game.
+        :param id: Game UUID.
+        :param mode: 'solo' or 'streak'.
+        :returns: TuxunGame object if success.
+        '''
+        try:
+            if self.cache:
+                # The disk I/O of the cache runs in the default executor, not to block the event loop
+                cached = await asyncio.get_running_loop().run_in_executor(None, self.cache.get, self.__get_game_key(mode, id), self.game_ttl)
+                if cached is not None:
+                    return TuxunGame(json.loads(cached))
+            data = await self.__request('get', f"/api/v0/tuxun/{mode}/get", gameId=id)
+            await self.__cache_game(mode, data)
+            return TuxunGame(data)
+        except Exception as e:
+            return e
+
+    async def guess(self, game:TuxunGame, lng:float, lat:float):
+        '''
+        Do a guess of the game.
+        :param game: TuxunGame object.
+        :param lng: The lng of the place.
+        :param lat: The lat of the place.
+        :returns: TuxunGame object if success.
+        '''
+        try:
+            if 'streak' in game.type:
+                api = 'streak'
+            elif 'solo' in game.type:
+                api = 'solo'
+            else:
+                return TuxunAgentException(f"Unsupported game type: {game.type}")
+            data = await self.__request('guess', f"/api/v0/tuxun/{api}/guess", gameId=game.id, lng=lng, lat=lat)
+            await self.__cache_game(api, data)
+            return TuxunGame(data)
+        except Exception as e:
+            return e
+
+    async def emoji(self, game:TuxunGame, emoji_id:int):
+        '''
+        Send an emoji to the given game.
+        :param game: TuxunGame object.
+        :param emoji_id: Emoji ID, see `TuxunAgent.emoji`.
+        :returns: True if success.
+        '''
+        try:
+            if 'solo' in game.type:
+                api = 'solo'
+            else:
+                return TuxunAgentException(f"Unsupported game type: {game.type}")
+            await self.__request('sendEmoji', f"/api/v0/tuxun/{api}/sendEmoji", gameId=game.id, emojiId=emoji_id)
+            return True
+        except Exception as e:
+            return e
+
+    async def match(self, mode='solo', timeout:float=None):
+        '''
+        Match a PVP game, other coroutines keep running while waiting.
+        :param mode: 'solo'.
+        :param timeout: The maximum time(s) to wait, `None` for no limit.
+        :returns: Game ID string if success.
+        '''
+        async def poll():
+            interval = 1500
+            while True:
+                resp = await self.__request('joinRandom', f"/api/v0/tuxun/{mode}/joinRandom", check=False, interval=interval)
+                if resp['data']:
+                    return resp['data']
+                await asyncio.sleep(interval / 1000)
+        try:
+            return await asyncio.wait_for(poll(), timeout)
+        except Exception as e:
+            return e
+
+    async def join(self, id:str):
+        '''
+        Join-in a multi-player game.
+        :param id: Game ID string.
+        :returns: TuxunGame object if success.
+        '''
+        try:
+            return TuxunGame(await self.__request('join', "/api/v0/tuxun/game/join", gameId=id))
+        except Exception as e:
+            return e
+
+    def __get_session(self):
+        if self.__session is None or self.__session.closed:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.__session
+
+    def __get_limiter(self, endpoint:str):
+        if endpoint not in self.__limiters:
+            rate = self.rate_limits.get(endpoint, self.rate_limits.get('default', 0))
+            self.__limiters[endpoint] = _RateLimiter(rate)
+        return self.__limiters[endpoint]
+
+    async def __request(self, endpoint:str, path:str, check:bool=True, **params):
+        await self.__get_limiter(endpoint).acquire()
+        params = {k: str(v) for k, v in params.items()}
+        async with self.__get_session().get(self.base_url + path, params=params, headers={'cookie': self.cookie}) as r:
+            if r.status != 200:
+                raise TuxunAgentException(f"HTTP request failed, response code: {r.status}")
+            resp = json.loads(await r.text(encoding='UTF-8'))
+        if not check:
+            return resp
+        if not resp['success']:
+            msg = resp['errorCode'] if 'errorCode' in resp.keys() else 'unknown'
+            raise TuxunAgentException(f"API operation failed, reason: {msg}")
+        return resp['data']
+
+    async def __cache_game(self, mode:str, data:dict):
+        if self.cache and data and data.get('id'):
+            await asyncio.get_running_loop().run_in_executor(None, self.cache.set, self.__get_game_key(mode, data['id']),
+                json.dumps(data).encode('UTF-8'))
+
+    @staticmethod
+    def __get_game_key(mode:str, id:str):
+        return f"game:{mode}:{id}"
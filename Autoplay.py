@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, time, threading, queue
+from TuxunAgent import TuxunAgent, TuxunGame, StreetView, StreetViewException
+from Dataset import StreetViewImageDataset
+import Metrics
+
+
+class AutoplayJob():
+    '''Autoplay Job, the state of a single game flowing through the pipeline.'''
+
+    def __init__(self, index:int):
+        self.index = index
+        '''The serial number of the job.'''
+        self.game:TuxunGame = None
+        '''The latest TuxunGame object.'''
+        self.image = None
+        self.prediction:list = None
+        '''The latest prediction list.'''
+        self.probs = None
+        '''The latest probabilities of all the target places, only with the guess engine.'''
+        self.rounds = 0
+        '''The number of rounds guessed.'''
+        self.distances = []
+        '''The distances of the guesses returned by the server.'''
+        self.error:Exception = None
+        '''The exception which terminated the job.'''
+
+
+class AutoplayStats():
+    '''Autoplay Stats, which records the latency of every stage.'''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__latencies = {}
+        self.__errors = {}
+        self.__start = time.perf_counter()
+
+    def record(self, stage:str, latency:float, success:bool=True):
+        with self.__lock:
+            self.__latencies.setdefault(stage, []).append(latency)
+            if not success:
+                self.__errors[stage] = self.__errors.get(stage, 0) + 1
+
+    def report(self):
+        '''
+        Get the stats of every stage.
+        :returns: A dict mapping each stage to its count, errors, p50/p99 latency(ms) and throughput(jobs/s).
+        '''
+        elapsed = time.perf_counter() - self.__start
+        result = {}
+        with self.__lock:
+            for stage, samples in self.__latencies.items():
+                samples = sorted(samples)
+                result[stage] = {
+                    'count': len(samples),
+                    'errors': self.__errors.get(stage, 0),
+                    'p50': samples[len(samples) // 2] * 1000,
+                    'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+                    'throughput': len(samples) / elapsed if elapsed else 0.0
+                }
+        return result
+
+
+class TuxunAutoplay():
+    '''Tuxun Autoplay, a headless pipeline of create/match → fetch → predict → guess, overlapping the stages across games.'''
+
+    def __init__(self, agent:TuxunAgent, predictor, type:str='country', mode:str='streak', max_rounds:int=1,
+            max_in_flight:int=8, acquire_workers:int=2, fetch_workers:int=4, predict_workers:int=2, guess_workers:int=2, harvester=None,
+            guess_engine=None):
+        '''
+        Initialize a TuxunAutoplay instance.
+        :param agent: TuxunAgent object.
+        :param predictor: TuxunPredictor or TuxunInferenceServer object.
+        :param type: The game type to create, 'country' or 'province'.
+        :param mode: 'streak' to create games, or 'solo' to match PVP games.
+        :param max_rounds: The maximum number of rounds to guess in each game.
+        :param max_in_flight: The maximum number of games in the pipeline, which is also the size of each stage queue.
+        :param harvester: TuxunHarvester object to record the answered rounds, `None` to disable.
+        :param guess_engine: TuxunGuessEngine object to guess the point of the minimum expected distance, `None` to guess the top-1 place.
+        '''
+        self.agent = agent
+        self.predictor = predictor
+        self.type = type
+        self.mode = mode
+        self.max_rounds = max(1, max_rounds)
+        self.max_in_flight = max(1, max_in_flight)
+        self.harvester = harvester
+        self.guess_engine = guess_engine
+        self.workers = {
+            'acquire': acquire_workers,
+            'fetch': fetch_workers,
+            'predict': predict_workers,
+            'guess': guess_workers
+        }
+        self.stats = AutoplayStats()
+
+    def run(self, num_games:int):
+        '''
+        Play the given number of games.
+        :returns: The list of finished AutoplayJob objects.
+        '''
+        self.stats = AutoplayStats()
+        self.__queues = {stage: queue.Queue(self.max_in_flight) for stage in self.workers.keys()}
+        self.__slots = threading.Semaphore(self.max_in_flight)
+        self.__done = []
+        self.__done_lock = threading.Lock()
+        self.__all_done = threading.Event()
+        self.__num_games = num_games
+        if num_games <= 0:
+            return []
+
+        handlers = {
+            'acquire': self.__acquire,
+            'fetch': self.__fetch,
+            'predict': self.__predict,
+            'guess': self.__guess
+        }
+        threads = []
+        for stage, n in self.workers.items():
+            for i in range(max(1, n)):
+                t = threading.Thread(target=self.__work, args=(stage, handlers[stage]), name=f'Autoplay-{stage}-{i}', daemon=True)
+                t.start()
+                threads.append(t)
+
+        for i in range(num_games):
+            self.__slots.acquire()
+            self.__queues['acquire'].put(AutoplayJob(i))
+        self.__all_done.wait()
+        for stage, n in self.workers.items():
+            for _ in range(max(1, n)):
+                self.__queues[stage].put(None)
+        for t in threads:
+            t.join()
+        return sorted(self.__done, key=lambda x: x.index)
+
+    def __work(self, stage:str, handler):
+        inbox = self.__queues[stage]
+        while True:
+            job = inbox.get()
+            if job is None:
+                return
+            Metrics.set_gauge('queue_depth', inbox.qsize(), queue=stage)
+            t = time.perf_counter()
+            try:
+                handler(job)
+                self.stats.record(stage, time.perf_counter() - t)
+            except Exception as e:
+                self.stats.record(stage, time.perf_counter() - t, False)
+                job.error = e
+                self.__finish(job)
+
+    def __finish(self, job:AutoplayJob):
+        job.image = None
+        with self.__done_lock:
+            self.__done.append(job)
+            if len(self.__done) >= self.__num_games:
+                self.__all_done.set()
+        self.__slots.release()
+
+    def __acquire(self, job:AutoplayJob):
+        if self.mode == 'solo':
+            gid = self.agent.match(self.mode)
+            if isinstance(gid, Exception):
+                raise gid
+            game = self.agent.join(gid)
+        else:
+            game = self.agent.create(self.type, self.mode)
+        if type(game) != TuxunGame:
+            raise game if isinstance(game, Exception) else TypeError(game)
+        job.game = game
+        self.__queues['fetch'].put(job)
+
+    def __fetch(self, job:AutoplayJob):
+        sv = StreetView(job.game.pano)
+        if type(sv.get_type()) == StreetViewException:
+            raise StreetViewException(f"Unsupported pano type of {job.game.pano}")
+        img = sv.get_image()
+        if isinstance(img, Exception):
+            raise img
+        if StreetViewImageDataset.decode_size:
+            img.draft('RGB', StreetViewImageDataset.decode_size)
+        job.image = img.convert('RGB')
+        self.__queues['predict'].put(job)
+
+    def __predict(self, job:AutoplayJob):
+        if self.type == 'province' and getattr(self.predictor, 'regions', None):
+            job.prediction = self.predictor.predict_regions(job.image, k=5)
+        elif self.guess_engine and hasattr(self.predictor, 'predict_probs'):
+            job.probs = self.predictor.predict_probs(job.image)
+        else:
+            job.prediction = self.predictor.predict(job.image, k=5)
+        job.image = None
+        self.__queues['guess'].put(job)
+
+    def __guess(self, job:AutoplayJob):
+        last = job.game
+        if job.probs is not None:
+            game = self.agent.guess_probs(last, job.probs, self.guess_engine)
+            job.probs = None
+        else:
+            top = job.prediction[0]
+            if top.get('regions'):
+                top = top['regions'][0]
+            game = self.agent.guess(last, top['lng'], top['lat'])
+        if type(game) != TuxunGame:
+            raise game if isinstance(game, Exception) else TypeError(game)
+        job.game = game
+        job.rounds += 1
+        if game.has_answer():
+            job.distances.append(game.last_guess_dictance)
+            if self.harvester:
+                self.harvester.harvest(game)
+        if job.rounds < self.max_rounds and len(game.rounds) > len(last.rounds) and game.pano:
+            self.__queues['fetch'].put(job)
+        else:
+            self.__finish(job)
+
+
+if __name__ == '__main__':
+    import argparse
+    from Inference import TuxunPredictor
+    from Guess import TuxunGuessEngine
+    parser = argparse.ArgumentParser(description='Tuxun-AI headless autoplay')
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=1, help='max rounds per game')
+    parser.add_argument('--type', default='country')
+    parser.add_argument('--mode', default='streak')
+    parser.add_argument('--in-flight', type=int, default=8)
+    parser.add_argument('--cookie', default='cookie.txt')
+    parser.add_argument('--base-url', default=TuxunAgent.base_url, help='API server, e.g. a local stub')
+    parser.add_argument('--fake-server', action='store_true', help='play offline against the fake API and tile server of Benchmark.py')
+    parser.add_argument('--model', default=os.path.join('models', 'v0.3.0.pth'))
+    parser.add_argument('--mapping', default=os.path.join('models', 'mapping.json'))
+    parser.add_argument('--harvest', default=None, help='directory to harvest the answered rounds into')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve the Prometheus metrics on this port, 0 to disable')
+    parser.add_argument('--regions', default=None, help='regions file of the region heads saved by Train.py, for the province games')
+    parser.add_argument('--expected-distance', action='store_true', help='guess the point of the minimum expected distance instead of the top-1 place')
+    parser.add_argument('--grid-step', type=float, default=None, help='step(degrees) of the extra candidate grid of the expected distance guess')
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        Metrics.serve_prometheus(port=args.metrics_port)
+
+    agent = TuxunAgent()
+    agent.base_url = args.base_url
+    if args.fake_server:
+        from Benchmark import start_fake_server
+        server, agent.base_url = start_fake_server()
+        StreetView.google_url = agent.base_url + "/tile/{pano}/{x}/{y}/{z}"
+    else:
+        agent.set_cookie(open(args.cookie, 'r').read().strip())
+    harvester = None
+    if args.harvest:
+        from Harvest import HarvestStore, TuxunHarvester
+        harvester = TuxunHarvester(HarvestStore(args.harvest))
+    autoplay = TuxunAutoplay(agent, TuxunPredictor.load(args.model, args.mapping, args.regions), args.type, args.mode, args.rounds, args.in_flight,
+        harvester=harvester, guess_engine=TuxunGuessEngine.load(args.mapping, args.grid_step) if args.expected_distance else None)
+    start = time.perf_counter()
+    jobs = autoplay.run(args.games)
+    elapsed = time.perf_counter() - start
+    if harvester:
+        harvester.store.close()
+
+    distances = [d for job in jobs for d in job.distances if d is not None]
+    print(f"Games: {len(jobs)}, failed: {len([job for job in jobs if job.error])}, time: {elapsed:.2f}s")
+    if distances:
+        print(f"Mean distance: {sum(distances) / len(distances):.1f}km over {len(distances)} rounds")
+    for stage, v in autoplay.stats.report().items():
+        print(f"  {stage:<8}\tn={v['count']}\terr={v['errors']}\tp50 {v['p50']:.1f}ms\tp99 {v['p99']:.1f}ms\t{v['throughput']:.2f}/s")
@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, sys, json, time, random, threading
+from PIL import Image
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from Dataset import StreetViewDataset, StreetViewImageDataset
+
+
+def make_jpeg(width:int=64, height:int=32, seed:int=0, quality:int=90):
+    '''
+    Make a synthetic street view JPEG with a black blank strip at the bottom.
+    :returns: The JPEG bytes.
+    '''
+    rnd = random.Random(seed)
+    blank = max(1, height // 8)
+    img = Image.frombytes('RGB', (width, height - blank), rnd.randbytes(width * (height - blank) * 3))
+    canvas = Image.new('RGB', (width, height))
+    canvas.paste(img, (0, 0))
+    img = canvas
+    buf = BytesIO()
+    img.save(buf, format='JPEG', quality=quality)
+    return buf.getvalue()
+
+def make_street_view_data(size:int, num_targets:int=180, seed:int=0):
+    '''
+    Make a synthetic dictionary in the format that `StreetViewDataset` expects.
+    :returns: The dictionary mapping each image's key to its information.
+    '''
+    rnd = random.Random(seed)
+    return {f'{i:08d}': {
+        'target': f'T{rnd.randrange(num_targets):03d}',
+        'lng': rnd.uniform(-180, 180),
+        'lat': rnd.uniform(-60, 70)
+        } for i in range(size)}
+
+def measure(func, repeat:int=1000):
+    '''
+    Call the function repeatedly.
+    :returns: A dict containing the p50/p99 latency(ms) and the throughput(calls/s).
+    '''
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t)
+    samples.sort()
+    return {
+        'p50': samples[len(samples) // 2] * 1000,
+        'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+        'throughput': len(samples) / sum(samples) if sum(samples) else float('inf')
+    }
+
+
+class _InMemoryImageDataset(StreetViewImageDataset):
+
+    image = make_jpeg()
+
+    def load_image_data(self):
+        for i in self.data.keys():
+            self.data[i]['image'] = self.image
+
+
+def bench_dataset_getitem(sizes=(1000, 10000, 100000), repeat:int=1000):
+    '''Benchmark the per-item latency of `StreetViewImageDataset.__getitem__` as the dataset grows.'''
+    result = {}
+    for size in sizes:
+        dataset = _InMemoryImageDataset('', StreetViewDataset(make_street_view_data(size)))
+        rnd = random.Random(size)
+        result[size] = measure(lambda: dataset[rnd.randrange(len(dataset))], repeat)
+    return result
+
+
+def _trim_image_bottom_blank_legacy(img:Image.Image):
+    # The per-pixel implementation before v0.3, kept as the parity reference
+    _img = img.convert('L')
+    width, height = img.width, img.height
+    try:
+        for y in range(0, height):
+            y = height - y - 1
+            if _img.getpixel((0, y)) > 0 and _img.getpixel((width - 1, y)) > 0:
+                return img.crop((0, 0, width, y - 1))
+    except:
+        pass
+    return img
+
+def check_trim_parity(sizes=((512, 512), (1024, 512), (2048, 1024), (416, 208)), seeds=range(4)):
+    '''
+    Check that `StreetViewImageDataset.trim_image_bottom_blank` produces the same pixels as the legacy implementation.
+    :returns: The list of the mismatched (size, seed) pairs.
+    '''
+    mismatches = []
+    for size in sizes:
+        for seed in seeds:
+            img = Image.open(BytesIO(make_jpeg(*size, seed=seed)))
+            a, b = StreetViewImageDataset.trim_image_bottom_blank(img), _trim_image_bottom_blank_legacy(img)
+            if a.size != b.size or a.tobytes() != b.tobytes():
+                mismatches.append((size, seed))
+    return mismatches
+
+def bench_trim(sizes=((512, 512), (1024, 512), (2048, 1024)), repeat:int=100):
+    '''Benchmark the bottom-blank trimming on typical tile sizes, comparing with the legacy implementation.'''
+    result = {}
+    for size in sizes:
+        img = Image.open(BytesIO(make_jpeg(*size)))
+        img.load()
+        name = f'{size[0]}x{size[1]}'
+        result[f'{name} numpy'] = measure(lambda: StreetViewImageDataset.trim_image_bottom_blank(img), repeat)
+        result[f'{name} legacy'] = measure(lambda: _trim_image_bottom_blank_legacy(img), repeat)
+    return result
+
+
+def _preprocess(binary:bytes, size:tuple, views:list):
+    from Inference import TuxunPredictor
+    img = StreetViewImageDataset.decode_image(binary, size).convert('RGB')
+    return TuxunPredictor.transform_views(StreetViewImageDataset.trim_image_bottom_blank(img), views)
+
+def check_decode_parity(predictor, samples:list, views=('left', 'right')):
+    '''
+    Compare the reduced-scale JPEG decode of `StreetViewImageDataset.decode_size` with the native resolution decode.
+    :param predictor: TuxunPredictor object.
+    :param samples: The list of tuples (binary, target), the target name can be `None` if unknown.
+    :returns: A dict containing the top-1 agreement, the top-1 accuracy of both pipelines(only over the known targets)
+        and the mean absolute difference of the normalized input tensors.
+    '''
+    import torch
+    agree, known, correct_native, correct_draft, diffs = 0, 0, 0, 0, []
+    for binary, target in samples:
+        native = _preprocess(binary, None, views)
+        draft = _preprocess(binary, StreetViewImageDataset.decode_size, views)
+        diffs.append(float((native - draft).abs().mean()))
+        top = [predictor.mapping[str(int(torch.argmax(predictor.policy.aggregate_views(predictor.forward(x)))))]['name']
+            for x in (native, draft)]
+        agree += top[0] == top[1]
+        if target is not None:
+            known += 1
+            correct_native += top[0] == target
+            correct_draft += top[1] == target
+    n = max(1, len(samples))
+    return {
+        'agreement': agree / n,
+        'acc1_native': correct_native / max(1, known),
+        'acc1_draft': correct_draft / max(1, known),
+        'mean_abs_diff': sum(diffs) / n
+    }
+
+def bench_decode(sizes=((512, 512), (1024, 512), (2048, 1024)), views=('left', 'right'), repeat:int=100):
+    '''Benchmark the per-image preprocessing(decode, trim, crop, resize and normalize) with the native and the reduced-scale decode.'''
+    result = {}
+    for size in sizes:
+        binary = make_jpeg(*size)
+        name = f'{size[0]}x{size[1]}'
+        result[f'{name} native'] = measure(lambda: _preprocess(binary, None, views), repeat)
+        result[f'{name} draft'] = measure(lambda: _preprocess(binary, StreetViewImageDataset.decode_size, views), repeat)
+    return result
+
+
+def bench_tta(predictor, data:dict, root:str, policies:list, limit:int=None):
+    '''
+    Benchmark the accuracy and the latency of the TTA policies on a local evaluation set.
+    :param predictor: TuxunPredictor object.
+    :param data: The dictionary in the format that `StreetViewDataset` expects.
+    :param root: The directory of the images.
+    :param policies: The list of the policy texts, see `TTAPolicy.parse`.
+    :returns: A dict mapping each policy to its acc1, p50/p99 latency(ms), throughput(images/s) and early exit rate.
+    '''
+    from Inference import TTAPolicy
+    samples = []
+    for key, item in list(data.items())[:limit]:
+        try:
+            samples.append((open(os.path.join(root, key + StreetViewImageDataset.image_ext), 'rb').read(), item['target']))
+        except OSError:
+            pass
+    result = {}
+    for text in policies:
+        predictor.policy = TTAPolicy.parse(text)
+        predictor.early_exits = 0
+        latencies, correct = [], 0
+        for binary, target in samples:
+            t = time.perf_counter()
+            top = predictor.predict(binary, k=1)
+            latencies.append(time.perf_counter() - t)
+            correct += top[0]['name'] == target
+        latencies.sort()
+        n = max(1, len(samples))
+        result[str(predictor.policy)] = {
+            'acc1': correct / n,
+            'p50': latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+            'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else 0.0,
+            'throughput': len(latencies) / sum(latencies) if sum(latencies) else 0.0,
+            'exit_rate': predictor.early_exits / n
+        }
+    return result
+
+
+class _FakeTuxunHandler(BaseHTTPRequestHandler):
+    # Serves the synthetic tiles at /tile/{pano}/{x}/{y}/{z} and a mock of the tuxun.fun API,
+    # the matchmaking returns a new game at once and every game has one ongoing round.
+    # The created games are kept, each has a random target and finishes after its round is guessed
+
+    tile:bytes = None
+    games:dict = None
+    lock:threading.Lock = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.startswith('/tile/'):
+            self._send(200, self.tile, 'image/jpeg')
+        elif url.path == '/api/get_profile':
+            self._send_data({'userId': 1})
+        elif url.path.endswith('/getProfile'):
+            self._send_data({'userId': int(query.get('userId', ['1'])[0]), 'rating': 1500})
+        elif url.path.endswith('/joinRandom'):
+            self._send_data(f"{random.getrandbits(128):032x}")
+        elif url.path.endswith('/sendEmoji'):
+            self._send_data(None)
+        elif url.path.endswith('/create'):
+            self._send_data(self._create(url.path.split('/')[-2], query.get('type', ['country'])[0]))
+        elif url.path.endswith('/guess') and query.get('gameId', [None])[0] in self.games:
+            self._send_data(self._guess(query['gameId'][0], float(query['lng'][0]), float(query['lat'][0])))
+        elif url.path.endswith('/get') and query.get('gameId', [None])[0] in self.games:
+            with self.lock:
+                self._send_data(self.games[query['gameId'][0]]['game'])
+        elif url.path.endswith('/get') or url.path.endswith('/guess') or url.path.endswith('/join'):
+            mode = 'solo' if url.path.endswith('/join') else url.path.split('/')[-2]
+            game = {'id': query.get('gameId', ['0'])[0], 'type': f'country_{mode}', 'teams': [], 'status': 'ongoing', 'player': {},
+                'rounds': [{'panoId': 'A' * 22, 'source': 'google', 'lng': None, 'lat': None}]}
+            self._send_data(game)
+        else:
+            self._send(404, b'', 'text/plain')
+
+    def _create(self, mode:str, type:str):
+        game = {'id': f"{random.getrandbits(128):032x}", 'type': f'{type}_{mode}', 'teams': [], 'status': 'ongoing', 'player': {},
+            'rounds': [{'panoId': 'A' * 22, 'source': 'google', 'lng': None, 'lat': None}]}
+        target = {'name': f'T{random.randrange(180):03d}', 'lng': random.uniform(-180, 180), 'lat': random.uniform(-60, 70)}
+        with self.lock:
+            self.games[game['id']] = {'game': game, 'target': target}
+        return game
+
+    def _guess(self, game_id:str, lng:float, lat:float):
+        with self.lock:
+            game, target = self.games[game_id]['game'], self.games[game_id]['target']
+            if game['status'] == 'ongoing':
+                game['rounds'][-1].update(lng=target['lng'], lat=target['lat'])
+                game['player'] = {'lastRoundResult': {'distance': StreetViewDataset.get_distance(lng, lat, target['lng'], target['lat']),
+                    'guessPlace': None, 'targetPlace': target['name']}}
+                game['status'] = 'finished'
+            return game
+
+    def _send_data(self, data):
+        self._send(200, json.dumps({'success': True, 'data': data}).encode('UTF-8'), 'application/json')
+
+    def _send(self, code:int, body:bytes, content_type:str):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_server(tile_size=(512, 512), host:str='127.0.0.1', port:int=0):
+    '''
+    Start a local server imitating the tile API and the Tuxun game API in a daemon thread.
+    :returns: Tuple (server, base_url), call `server.shutdown` to stop it.
+    '''
+    handler = type('_Handler', (_FakeTuxunHandler,), {'tile': make_jpeg(*tile_size), 'games': {}, 'lock': threading.Lock()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def get_peak_rss():
+    ''':returns: The peak resident set size(MB) of this process, or `None` if unavailable.'''
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, macOS reports bytes
+        return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+    except ImportError:
+        return None
+
+def make_random_predictor(num_classes:int=180):
+    ''':returns: TuxunPredictor object with the randomly initialized model and a synthetic mapping, for latency only.'''
+    from Model import TuxunAIModelV0
+    from Inference import TuxunPredictor
+    model = TuxunAIModelV0(classifier=TuxunAIModelV0.get_classifier(num_classes)).eval()
+    mapping = {str(i): {'name': f'T{i:03d}', 'lng': 0.0, 'lat': 0.0} for i in range(num_classes)}
+    return TuxunPredictor(model, mapping)
+
+def bench_pipeline(predictor, tile_size=(512, 512), batch_sizes=(1, 4, 16, 64), repeat:int=100):
+    '''
+    Benchmark each stage of the prediction pipeline separately, against the local fake server.
+    The stages are the game API request, the tile fetch, the JPEG decode, the trimming, the crop/resize/normalize transform,
+    the model forward at each batch size and the softmax/top-k.
+    :param predictor: TuxunPredictor object.
+    :returns: A dict mapping each stage to its p50/p99 latency(ms), throughput(items/s) and the peak RSS(MB) after it.
+    '''
+    import torch
+    from TuxunAgent import TuxunAgent, StreetView
+    server, base_url = start_fake_server(tile_size)
+    google_url, cache = StreetView.google_url, StreetView.cache
+    StreetView.google_url = base_url + "/tile/{pano}/{x}/{y}/{z}"
+    StreetView.cache = None
+    result = {}
+
+    def record(name:str, stats:dict, items:int=1):
+        stats['throughput'] *= items
+        stats['peak_rss_mb'] = get_peak_rss()
+        result[name] = stats
+    try:
+        agent = TuxunAgent()
+        agent.base_url = base_url
+        record('api get', measure(lambda: agent.get('0', 'streak'), repeat))
+        sv = StreetView('A' * 22)
+        record('tile fetch', measure(sv.get_image_bytes, repeat))
+        record('panorama fetch z1', measure(lambda: sv.get_panorama(1), max(1, repeat // 4)))
+    finally:
+        StreetView.google_url, StreetView.cache = google_url, cache
+        server.shutdown()
+        server.server_close()
+
+    binary = make_jpeg(*tile_size)
+    def decode():
+        img = Image.open(BytesIO(binary))
+        img.load()
+        return img
+    record('decode', measure(decode, repeat))
+    img = decode()
+    record('trim', measure(lambda: StreetViewImageDataset.trim_image_bottom_blank(img), repeat))
+    img = StreetViewImageDataset.trim_image_bottom_blank(img)
+    views = predictor.policy.views
+    record('transform', measure(lambda: predictor.transform_views(img, views), repeat), len(views))
+
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 3, *StreetViewImageDataset.image_size)
+        predictor.forward(x)
+        record(f'forward b{batch_size}', measure(lambda: predictor.forward(x), max(3, repeat // batch_size)), batch_size)
+    logits = predictor.forward(torch.randn(len(views), 3, *StreetViewImageDataset.image_size))
+    record('topk', measure(lambda: predictor.topk(logits, 5), repeat))
+    return result
+
+def compare_baseline(result:dict, baseline:dict, tolerance:float=0.2):
+    '''
+    Compare the results with the stored baseline of the same stages.
+    :param tolerance: The allowed relative slowdown of the p50 latency and the throughput.
+    :returns: The list of the regression messages, empty if none.
+    '''
+    regressions = []
+    for name, stats in result.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if stats['p50'] > base['p50'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {base['p50']:.3f}ms -> {stats['p50']:.3f}ms")
+        if stats['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput']:.1f}/s -> {stats['throughput']:.1f}/s")
+    return regressions
+
+
+def bench_guess(num_classes:int=180, batch_sizes=(1, 64, 1024, 4096), grid_step:float=None, repeat:int=100, seed:int=0):
+    '''
+    Benchmark the expected distance guess on random softmax outputs, and compare its expected distance with the top-1 guess.
+    :returns: A dict mapping each batch size to its p50/p99 latency(ms) and throughput(decisions/s), with the mean expected distances(km).
+    '''
+    import numpy as np
+    from Guess import TuxunGuessEngine
+    rnd = np.random.default_rng(seed)
+    mapping = {str(i): {'name': f'T{i:03d}', 'lng': float(rnd.uniform(-180, 180)), 'lat': float(rnd.uniform(-60, 70))}
+        for i in range(num_classes)}
+    engine = TuxunGuessEngine(mapping, grid_step)
+    result = {}
+    for batch_size in batch_sizes:
+        logits = rnd.normal(scale=3, size=(batch_size, num_classes)).astype(np.float32)
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        stats = measure(lambda: engine.guess(probs), repeat)
+        stats['throughput'] *= batch_size
+        _, expected = engine.guess(probs)
+        top1 = engine.expected_distances(probs)[np.arange(batch_size), probs.argmax(axis=1)]
+        stats['expected_km'] = float(expected.mean())
+        stats['top1_expected_km'] = float(top1.mean())
+        result[batch_size] = stats
+    return result
+
+
+def bench_async_agent(num_sessions:int=100, max_connections:int=100):
+    '''
+    Run the solo sessions of match → join → get → guess → emoji concurrently with one AsyncTuxunAgent, against the local fake server.
+    The rate limits are disabled.
+    :returns: A dict containing the p50/p99 latency(ms) of a session, the throughput(sessions/s) and the number of the errors.
+    '''
+    import asyncio
+    from AsyncTuxunAgent import AsyncTuxunAgent
+    from TuxunAgent import TuxunGame
+
+    async def session(agent:AsyncTuxunAgent):
+        t = time.perf_counter()
+        gid = await agent.match('solo', timeout=10)
+        game = await agent.join(gid) if isinstance(gid, str) else gid
+        if type(game) == TuxunGame:
+            game = await agent.get(game.id, 'solo')
+        if type(game) == TuxunGame:
+            game = await agent.guess(game, 0.0, 0.0)
+        if type(game) == TuxunGame:
+            game = await agent.emoji(game, 1)
+        return time.perf_counter() - t, game is True
+
+    async def run(base_url:str):
+        async with AsyncTuxunAgent(max_connections=max_connections) as agent:
+            agent.base_url = base_url
+            agent.rate_limits = {'default': 0}
+            start = time.perf_counter()
+            results = await asyncio.gather(*[session(agent) for _ in range(num_sessions)])
+            return results, time.perf_counter() - start
+
+    server, base_url = start_fake_server()
+    try:
+        results, elapsed = asyncio.run(run(base_url))
+    finally:
+        server.shutdown()
+        server.server_close()
+    latencies = sorted(t for t, _ in results)
+    return {
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'throughput': len(results) / elapsed,
+        'errors': len([ok for _, ok in results if not ok])
+    }
+
+
+def _print_result(title:str, result:dict):
+    print(title)
+    for k, v in result.items():
+        print(f"  {k:>18}\tp50 {v['p50']:.3f}ms\tp99 {v['p99']:.3f}ms\t{v['throughput']:.0f}/s")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Tuxun-AI benchmarks')
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--tta-data', default=None, help='JSON file of the street view data to benchmark the TTA policies')
+    parser.add_argument('--images', default='images')
+    parser.add_argument('--model', default=os.path.join('models', 'v0.3.0.pth'))
+    parser.add_argument('--mapping', default=os.path.join('models', 'mapping.json'))
+    parser.add_argument('--pipeline', action='store_true', help='benchmark the stages of the prediction pipeline against a local fake server')
+    parser.add_argument('--pipeline-model', default=None, help='model file of the pipeline benchmark, the randomly initialized model if not given')
+    parser.add_argument('--tile-size', type=int, nargs=2, default=[512, 512])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--json', default=None, help='path to save the pipeline results as JSON')
+    parser.add_argument('--baseline', default=None, help='JSON file of the stored pipeline results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--policies', nargs='+', default=['left,right', 'left,right;exit=0.5', 'left,right;exit=0.3',
+        'left,right,center;agg=probs', 'left,right,center,left-flip,right-flip;exit=0.5'])
+    parser.add_argument('--async-sessions', type=int, default=0, help='benchmark this many concurrent AsyncTuxunAgent sessions against a local fake server')
+    args = parser.parse_args()
+
+    if args.async_sessions:
+        result = bench_async_agent(args.async_sessions)
+        _print_result(f'AsyncTuxunAgent sessions ({result.pop("errors")} errors)', {args.async_sessions: result})
+        exit()
+
+    if args.pipeline:
+        if args.pipeline_model:
+            from Inference import TuxunPredictor
+            predictor = TuxunPredictor.load(args.pipeline_model, args.mapping)
+        else:
+            predictor = make_random_predictor()
+        result = bench_pipeline(predictor, tuple(args.tile_size), args.batch_sizes, max(1, args.repeat // 10))
+        _print_result('Pipeline stages', result)
+        print(f"Peak RSS: {get_peak_rss()}MB")
+        if args.json:
+            json.dump(result, open(args.json, 'w', encoding='UTF-8'), indent=4)
+        if args.baseline:
+            regressions = compare_baseline(result, json.load(open(args.baseline, 'r', encoding='UTF-8')), args.tolerance)
+            for line in regressions:
+                print(f"Regression: {line}")
+            print(f"{len(regressions)} regressions against {args.baseline}")
+            exit(1 if regressions else 0)
+        exit()
+
+    _print_result('StreetViewImageDataset.__getitem__ (dataset size)', bench_dataset_getitem(repeat=args.repeat))
+    result = bench_guess(repeat=max(1, args.repeat // 10))
+    _print_result('TuxunGuessEngine.guess (batch size)', result)
+    for k, v in result.items():
+        print(f"  {k:>18}\texpected {v['expected_km']:.0f}km, top-1 {v['top1_expected_km']:.0f}km")
+    print(f"Trim parity mismatches: {check_trim_parity()}")
+    _print_result('StreetViewImageDataset.trim_image_bottom_blank (image size)', bench_trim(repeat=max(1, args.repeat // 10)))
+    _print_result('Preprocessing (image size, decode)', bench_decode(repeat=max(1, args.repeat // 10)))
+    if args.tta_data:
+        from Inference import TuxunPredictor
+        predictor = TuxunPredictor.load(args.model, args.mapping)
+        data = json.load(open(args.tta_data, 'r', encoding='UTF-8'))
+        samples = []
+        for key, item in data.items():
+            try:
+                samples.append((open(os.path.join(args.images, key + StreetViewImageDataset.image_ext), 'rb').read(), item['target']))
+            except OSError:
+                pass
+        print(f"Decode parity: {check_decode_parity(predictor, samples)}")
+        result = bench_tta(predictor, data, args.images, args.policies)
+        print('TTA policies')
+        for k, v in result.items():
+            print(f"  {k:<48}\tAcc@1 {v['acc1']*100:.2f}%\tp50 {v['p50']:.1f}ms\tp99 {v['p99']:.1f}ms\t{v['throughput']:.1f}/s\texit {v['exit_rate']*100:.0f}%")
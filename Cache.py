@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, time, hashlib, tempfile
+import Metrics
+
+
+class DiskCache():
+    '''Disk Cache, a content-addressed key-value store on disk with size-bounded LRU eviction.'''
+
+    def __init__(self, root:str, max_size:int=1 << 30):
+        '''
+        Initialize a DiskCache instance.
+        The cache directory can be shared by multiple processes, since every write is atomic.
+        :param root: The cache directory.
+        :param max_size: The maximum total size(bytes) of the cached values.
+        '''
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        '''The number of cache hits in this process.'''
+        self.misses = 0
+        '''The number of cache misses in this process.'''
+        self.__written = 0
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, key:str, ttl:float=None):
+        '''
+        Get the value of the given key.
+        :param ttl: The time-to-live(s) of the value since it was written, `None` for no expiration.
+        :returns: The bytes value, or `None` if not found or expired.
+        '''
+        path = self.__get_path(key)
+        try:
+            stat = os.stat(path)
+            now = time.time()
+            if ttl is not None and now - stat.st_mtime > ttl:
+                self.misses += 1
+                Metrics.inc('cache_requests_total', kind=key.split(':', 1)[0], result='expired')
+                return None
+            with open(path, 'rb') as f:
+                value = f.read()
+            # The access time records the recency for LRU, the modify time records the write time for TTL
+            os.utime(path, (now, stat.st_mtime))
+            self.hits += 1
+            Metrics.inc('cache_requests_total', kind=key.split(':', 1)[0], result='hit')
+            return value
+        except OSError:
+            self.misses += 1
+            Metrics.inc('cache_requests_total', kind=key.split(':', 1)[0], result='miss')
+            return None
+
+    def set(self, key:str, value:bytes):
+        '''Set the value of the given key, the old value will be replaced atomically.'''
+        path = self.__get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.__written += len(value)
+        if self.__written > self.max_size // 16:
+            self.evict()
+
+    def delete(self, key:str):
+        '''Delete the value of the given key if exists.'''
+        try:
+            os.remove(self.__get_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        '''Evict the least recently used values until the total size is within the maximum size.'''
+        self.__written = 0
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def hit_rate(self):
+        ''':returns: The ratio of the cache hits in this process.'''
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __get_path(self, key:str):
+        digest = hashlib.sha256(key.encode('UTF-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:])
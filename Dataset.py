@@ -1,18 +1,45 @@
-import os, math
+import os, math, json, glob, random, tarfile, tempfile, zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import torch
 import torchvision.transforms as transforms
+from torch.utils.data import IterableDataset, get_worker_info
 from torchvision.datasets import VisionDataset
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 from io import BytesIO
 
 
 class StreetViewDataset():
     '''Street View Dataset class'''
 
-    def __init__(self, street_view_data:dict={}, targets:dict=None):
-        self.data:dict = street_view_data
+    cleanse_chunk_size = 65536
+
+    def __init__(self, street_view_data:dict=None, targets:dict=None):
+        '''
+        Initialize a StreetViewDataset instance.
+        :param targets: The fixed dictionary of the target places, `None` to derive them from the data.
+        '''
+        self.data:dict = street_view_data if street_view_data is not None else {}
         '''The dictionary mapping each image's key(string) to its information.'''
-        self.targets:dict = targets if targets else self.__get_targets()
-        '''The dictionary mapping the number(string) of each target place to its information.'''
+        self.__stats = None
+        self.__targets = targets if targets else None
+        self.__pinned = bool(targets)
+
+    @property
+    def targets(self):
+        '''The dictionary mapping the number(string) of each target place to its information, built lazily after appending.'''
+        if self.__targets is None:
+            if self.__stats is None:
+                self.__stats = self.__get_stats(self.data)
+            self.__targets = self.__stats_to_targets(self.__stats, len(self.data))
+        return self.__targets
+
+    @targets.setter
+    def targets(self, targets:dict):
+        # The assigned targets are fixed as well, so that the class indices do not move on appending
+        self.__targets = targets
+        self.__pinned = bool(targets)
+        self.__stats = None
 
     def get_cleansed(self, keep_targets_topk:int, max_merging_distance:float=1000):
         '''
@@ -25,22 +52,25 @@ class StreetViewDataset():
         new_data = self.data.copy()
         keeps = list(self.targets.items())
         keeps = sorted(keeps, key=lambda x: x[1]['frequency'], reverse=True)[:keep_targets_topk]
-        keeps_name = [x[1]['name'] for x in keeps]
-
-        for i in list(new_data.keys()):
-            cur = new_data[i]
-            if cur['target'] not in keeps_name:
-                nears = keeps.copy()
-                lng1, lat1 = cur['lng'], cur['lat']
-                for j in nears:
-                    lng2, lat2 = j[1]['lng'], j[1]['lat']
-                    j[1]['distance'] = self.get_distance(lng1, lat1, lng2, lat2)
-                nears = sorted(nears, key=lambda x: x[1]['distance'], reverse=False)[0]
-                # print(f"{new_data[i]['target']} -> { nears[1]['name']} (d={round(nears[1]['distance'])}km)")
-                if nears[1]['distance'] > max_merging_distance:
+        keeps_name = set(x[1]['name'] for x in keeps)
+        if not keeps:
+            return StreetViewDataset({})
+
+        merges = [i for i, v in new_data.items() if v['target'] not in keeps_name]
+        keeps_lng = np.array([x[1]['lng'] for x in keeps], dtype=np.float64)
+        keeps_lat = np.array([x[1]['lat'] for x in keeps], dtype=np.float64)
+        for start in range(0, len(merges), self.cleanse_chunk_size):
+            chunk = merges[start:start + self.cleanse_chunk_size]
+            lng1 = np.array([new_data[i]['lng'] for i in chunk], dtype=np.float64)
+            lat1 = np.array([new_data[i]['lat'] for i in chunk], dtype=np.float64)
+            distances = self.get_distances(lng1[:, None], lat1[:, None], keeps_lng[None, :], keeps_lat[None, :])
+            nearest = np.argmin(distances, axis=1)
+            nearest_distance = distances[np.arange(len(chunk)), nearest]
+            for i, j, d in zip(chunk, nearest.tolist(), nearest_distance.tolist()):
+                if d > max_merging_distance:
                     new_data.pop(i)
                 else:
-                    new_data[i]['target'] = nears[1]['name']
+                    new_data[i] = dict(new_data[i], target=keeps[j][1]['name'])
 
         return StreetViewDataset(new_data)
 
@@ -57,31 +87,182 @@ class StreetViewDataset():
         hav = haversine(dlat) + math.cos(lat1) * math.cos(lat2) * haversine(dlng)
         return 2 * RADIUS * math.asin(math.sqrt(hav))
 
-    def __get_targets(self):
-        targets = {}
-        for i in self.data.keys():
-            tar = self.data[i]['target']
-            if tar not in targets.keys():
-                targets[tar] = [self.data[i]]
-            else:
-                targets[tar].append(self.data[i])
-        total_places = len(self.data)
-        total_targets = len(targets)
+    @staticmethod
+    def get_distances(lng1, lat1, lng2, lat2):
+        '''
+        The vectorized version of `get_distance`, the arguments are broadcast against each other.
+        :returns: The array of the great-circle distances(km).
+        '''
+        RADIUS = 6371
+
+        lng1, lat1 = np.radians(lng1), np.radians(lat1)
+        lng2, lat2 = np.radians(lng2), np.radians(lat2)
+        dlng, dlat = np.abs(lng1 - lng2), np.abs(lat1 - lat2)
+        hav = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+        return 2 * RADIUS * np.arcsin(np.sqrt(hav))
+
+    def get_regions(self, max_regions:int=8, min_region_size:int=50, iters:int=20, seed:int=0):
+        '''
+        Cluster the places of each target into sub-target regions by k-means over the great-circle distance. \n
+        The number of regions of a target is limited by both the max regions and the min region size.
+        :returns: Tuple (regions, assignments), regions is a dict mapping the number of each target
+            to a dict mapping the number of each region to its information,
+            assignments is a dict mapping each image's key to the number of its region.
+        '''
+        rnd = np.random.default_rng(seed)
+        names = {v['name']: k for k, v in self.targets.items()}
+        groups = {}
+        for key, item in self.data.items():
+            if item['target'] in names:
+                groups.setdefault(names[item['target']], []).append(key)
+
+        regions, assignments = {}, {}
+        for tar, keys in groups.items():
+            lng = np.array([self.data[k]['lng'] for k in keys], dtype=np.float64)
+            lat = np.array([self.data[k]['lat'] for k in keys], dtype=np.float64)
+            num = max(1, min(max_regions, len(keys) // max(1, min_region_size)))
+            centers = rnd.choice(len(keys), size=num, replace=False)
+            c_lng, c_lat = lng[centers], lat[centers]
+            for _ in range(iters):
+                assign = np.argmin(self.get_distances(lng[:, None], lat[:, None], c_lng[None, :], c_lat[None, :]), axis=1)
+                for j in range(num):
+                    members = assign == j
+                    if members.any():
+                        c_lng[j], c_lat[j] = self.__get_spherical_mean(lng[members], lat[members])
+            assign = np.argmin(self.get_distances(lng[:, None], lat[:, None], c_lng[None, :], c_lat[None, :]), axis=1)
+            counts = np.bincount(assign, minlength=num)
+            regions[tar] = {j: {
+                'name': f"{self.targets[tar]['name']}-{j}",
+                'lng': round(float(c_lng[j]), 5),
+                'lat': round(float(c_lat[j]), 5),
+                'frequency': round(float(counts[j]) / len(keys), 5)
+                } for j in range(num)}
+            assignments.update(zip(keys, assign.tolist()))
+        return regions, assignments
 
+    @staticmethod
+    def __get_spherical_mean(lng:np.ndarray, lat:np.ndarray):
+        lng, lat = np.radians(lng), np.radians(lat)
+        x, y, z = (np.cos(lat) * np.cos(lng)).sum(), (np.cos(lat) * np.sin(lng)).sum(), np.sin(lat).sum()
+        return math.degrees(math.atan2(y, x)), math.degrees(math.atan2(z, math.hypot(x, y)))
+
+    def to_shards(self, root:str, out_dir:str, shard_size:int=1000, image_ext:str='.jpg'):
+        '''
+        Convert the dataset with the images in the directory layout to the sharded format read by `StreetViewShardDataset`. \n
+        Each shard consists of a tar file of the images and a JSON Lines metadata sidecar, the same as `Harvest.HarvestStore`.
+        An `index.json` recording the shards and the targets is written as well.
+        :param root: The directory of the images.
+        :param out_dir: The directory to save the shards.
+        :param shard_size: The maximum number of records in a shard, for distributed training choose it so that
+            the number of shards is a multiple of the world size times the DataLoader workers,
+            as every rank stops at the end of the shortest one.
+        :returns: The number of the records written, the ones without a readable and valid image are skipped.
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+        shards, count, tar, meta = [], 0, None, None
+        for key, item in self.data.items():
+            try:
+                binary = open(os.path.join(root, key + image_ext), 'rb').read()
+            except OSError:
+                continue
+            # The shard counts are the dataset length, so only the images that can be decoded are written
+            if 'error' in validate_image(binary, StreetViewImageDataset.min_image_size):
+                continue
+            if tar is None or shards[-1]['count'] >= shard_size:
+                if tar:
+                    tar.close()
+                    meta.close()
+                name = StreetViewShardDataset.shard_name.format(len(shards))
+                tar = tarfile.open(os.path.join(out_dir, name + '.tar'), 'w')
+                meta = open(os.path.join(out_dir, name + '.jsonl'), 'w', encoding='UTF-8')
+                shards.append({'name': name, 'count': 0})
+            info = tarfile.TarInfo(key + image_ext)
+            info.size = len(binary)
+            tar.addfile(info, BytesIO(binary))
+            record = {k: v for k, v in item.items() if k != 'image'}
+            meta.write(json.dumps(dict(key=key, **record), ensure_ascii=False) + '\n')
+            shards[-1]['count'] += 1
+            count += 1
+        if tar:
+            tar.close()
+            meta.close()
+        with open(os.path.join(out_dir, StreetViewShardDataset.index_file), 'w', encoding='UTF-8') as f:
+            json.dump({'shards': shards, 'targets': self.targets}, f, ensure_ascii=False)
+        return count
+
+    def append(self, key:str, item:dict):
+        '''
+        Append an image's information to the dataset, and update the counts incrementally,
+        the targets are rebuilt from the counts on the next access,
+        unless the targets are given, which stay fixed so that the class indices never move.
+        To load many records, construct the dataset with all of them at once instead.
+        :param key: The image's key.
+        :param item: The dict containing at least `target`, `lng` and `lat`.
+        '''
+        if self.__pinned:
+            self.data[key] = item
+            return
+        if self.__stats is None:
+            self.__stats = self.__get_stats(self.data)
+        if key in self.data:
+            self.__update_stats(self.__stats, self.data[key], -1)
+        self.data[key] = item
+        self.__update_stats(self.__stats, item, 1)
+        self.__targets = None
+
+    @classmethod
+    def __get_stats(cls, data:dict):
+        stats = {}
+        for i in data.values():
+            cls.__update_stats(stats, i, 1)
+        return stats
+
+    @staticmethod
+    def __update_stats(stats:dict, item:dict, sign:int):
+        tar = item['target']
+        if tar not in stats:
+            stats[tar] = [0, 0.0, 0.0]
+        stat = stats[tar]
+        stat[0] += sign
+        stat[1] += sign * item['lng']
+        stat[2] += sign * item['lat']
+        if stat[0] <= 0:
+            stats.pop(tar)
+
+    @staticmethod
+    def __stats_to_targets(stats:dict, total_places:int):
         result = {}
-        for tar, i in zip(sorted(list(targets.keys())), range(total_targets)):
-            avg_lng = sum([j['lng'] for j in targets[tar]]) / len(targets[tar])
-            avg_lat = sum([j['lat'] for j in targets[tar]]) / len(targets[tar])
-            frequency = len(targets[tar]) / total_places
+        for i, tar in enumerate(sorted(stats.keys())):
+            count, sum_lng, sum_lat = stats[tar]
             result[i] = {
                 'name': tar,
-                'lng': round(avg_lng, 5),
-                'lat': round(avg_lat, 5),
-                'frequency': round(frequency, 5)
+                'lng': round(sum_lng / count, 5),
+                'lat': round(sum_lat / count, 5),
+                'frequency': round(count / total_places, 5)
             }
         return result
 
 
+def validate_image(binary:bytes, min_size:tuple=(1, 1)):
+    '''
+    Check whether the image can be decoded and is large enough.
+    The image is decoded at the reduced scale of the JPEG draft mode, which still detects the truncated data.
+    :returns: A dict containing the width and the height, or the error.
+    '''
+    try:
+        img = Image.open(BytesIO(binary))
+        width, height = img.size
+        if width < min_size[0] or height < min_size[1]:
+            return {'width': width, 'height': height, 'error': f"too small: {width}x{height}"}
+        img.draft('RGB', (max(1, width // 8), max(1, height // 8)))
+        img.load()
+        return {'width': width, 'height': height}
+    except UnidentifiedImageError:
+        return {'error': "undecodable: unknown image format"}
+    except Exception as e:
+        return {'error': f"undecodable: {e}"}
+
+
 class StreetViewImageDataset(VisionDataset):
     '''Street View Image Dataset class'''
 
@@ -91,65 +272,485 @@ class StreetViewImageDataset(VisionDataset):
     ]
     image_size = (224, 224)
     image_ext = '.jpg'
+    decode_size = (image_size[1] * 2, image_size[0])
+    '''The minimum (width, height) to decode the JPEG images at, since every view is a half-width crop, `None` for the native resolution.'''
+    min_image_size = (64, 32)
+    '''The minimum (width, height) of a valid image.'''
+    manifest_file = '.manifest.json'
+    load_workers = 16
+    '''The number of threads reading the images.'''
+    validate_processes = 0
+    '''The number of processes validating the images, 0 to validate in the reading threads.'''
     transform = transforms.Compose([
         transforms.Resize(image_size),
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
 
-    def __init__(self, root:str, street_view_dataset:StreetViewDataset, transform:transforms.Compose=transform):
+    def __init__(self, root:str, street_view_dataset:StreetViewDataset, transform:transforms.Compose=transform, views:list=None):
+        '''
+        Initialize a StreetViewImageDataset instance.
+        Each index maps to a (sample, view) pair: `index = view * samples + sample`.
+        :param views: The list of the view generators taking and returning an Image object, `None` for the enhance methods.
+        '''
         super(StreetViewImageDataset, self).__init__(root, transform=transform)
+        self.views:list = list(views) if views else list(self.enhance_methods)
+        '''The list of the view generators.'''
         self.data = street_view_dataset.data
         self.targets = street_view_dataset.targets
         self.classes = list(street_view_dataset.targets.keys())
         self.num_classes = len(self.classes)
+        self.trim_boxes:dict = {}
+        '''The dictionary mapping each image's key to its cached trim box.'''
+        self.dropped:dict = {}
+        '''The dictionary mapping each dropped key to the reason.'''
         self.load_image_data()
+        self.build_index()
 
     def __getitem__(self, index):
-        object = list(self.data.values())[index % self.__real_len__()]
-        binary = object['image']
-        label = object['target']
+        index = index % len(self)
+        view, index = index // self.__real_len__(), index % self.__real_len__()
+        key = self.keys[index]
+        binary = self.data[key]['image']
 
-        img = Image.open(BytesIO(binary))
-        img = self.trim_image_bottom_blank(img)
+        img = self.decode_image(binary, self.decode_size)
+        img = self.trim_images_bottom_blank([img], [key])[0]
         
-        mode = len(self) % len(self.enhance_methods)
-        img = self.enhance_methods[mode](img)
+        img = self.views[view](img)
         img = self.transform(img)
-        return img, self.target_to_index(label)
+        return img, int(self.labels[index])
 
     def __len__(self):
-        return self.__real_len__() * len(self.enhance_methods)
+        return self.__real_len__() * len(self.views)
     
     def __real_len__(self):
-        return len(self.data)
+        return len(self.keys)
+
+    def build_index(self):
+        '''
+        Build the compact index of the loaded data, so that the item access and the label lookup take constant time.
+        The samples whose targets are not in `self.targets` are dropped, like `StreetViewShardDataset` skips them.
+        Call this again if `self.data` or `self.targets` is modified.
+        :returns: The number of the samples dropped for the unknown targets.
+        '''
+        self.target_indices:dict = {v['name']: k for k, v in self.targets.items()}
+        '''The dictionary mapping the name of each target place to its number.'''
+        unknown = [k for k, v in self.data.items() if v['target'] not in self.target_indices]
+        for key in unknown:
+            self.dropped[key] = f"unknown target: {self.data.pop(key)['target']}"
+        self.keys:list = list(self.data.keys())
+        '''The ordered list of the image keys.'''
+        self.labels = np.fromiter((self.target_indices[self.data[k]['target']] for k in self.keys),
+            dtype=np.int64, count=len(self.keys))
+        '''The label array of the images.'''
+        return len(unknown)
     
-    def load_image_data(self):
-        for i in list(self.data.keys()):
+    def load_image_data(self, use_manifest:bool=True):
+        '''
+        Read the images in parallel, and drop the samples whose images are missing, undecodable or too small. \n
+        The results of the validation are saved in a manifest in the image directory,
+        so that the images unchanged since the last run are not decoded again.
+        :param use_manifest: Whether to read and update the manifest.
+        :returns: The dictionary mapping each dropped key to the reason.
+        '''
+        manifest_path = os.path.join(self.root, self.manifest_file)
+        manifest = {}
+        if use_manifest and os.path.isfile(manifest_path):
             try:
-                fpath = os.path.join(self.root, i + self.image_ext)
-                binary = open(fpath, 'rb').read()
-                self.data[i]['image'] = binary
-            except:
-                self.data.pop(i)
-    
+                manifest = json.load(open(manifest_path, 'r', encoding='UTF-8'))
+            except (OSError, ValueError):
+                manifest = {}
+        keys = list(self.data.keys())
+        validate_in_threads = self.validate_processes <= 0
+
+        def read(key:str):
+            try:
+                with open(os.path.join(self.root, key + self.image_ext), 'rb') as f:
+                    stat = os.fstat(f.fileno())
+                    binary = f.read()
+            except OSError as e:
+                return None, None, f"unreadable: {e.strerror or e}"
+            entry = manifest.get(key)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                return binary, entry, entry.get('error')
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            if validate_in_threads:
+                entry.update(validate_image(binary, self.min_image_size))
+                return binary, entry, entry.get('error')
+            return binary, entry, None
+
+        with ThreadPoolExecutor(max_workers=self.load_workers) as pool:
+            results = list(pool.map(read, keys))
+        pending = [i for i, (binary, entry, _) in enumerate(results) if entry is not None and 'width' not in entry and 'error' not in entry]
+        if pending:
+            with ProcessPoolExecutor(max_workers=self.validate_processes) as pool:
+                checks = pool.map(validate_image, [results[i][0] for i in pending], [self.min_image_size] * len(pending),
+                    chunksize=max(1, len(pending) // (self.validate_processes * 4)))
+                for i, check in zip(pending, checks):
+                    results[i][1].update(check)
+                    results[i] = (results[i][0], results[i][1], check.get('error'))
+
+        self.dropped = {}
+        updates = {}
+        for key, (binary, entry, error) in zip(keys, results):
+            if entry != manifest.get(key):
+                updates[key] = entry
+            if error:
+                self.dropped[key] = error
+                self.data.pop(key)
+            else:
+                self.data[key]['image'] = binary
+        if use_manifest and updates:
+            self.__update_manifest(manifest_path, updates)
+        return self.dropped
+
     @staticmethod
-    def trim_image_bottom_blank(img:Image.Image):
-        _img = img.convert('L')
-        width, height = img.width, img.height
+    def __update_manifest(manifest_path:str, updates:dict):
+        # Merge into the latest manifest, which may hold the entries of the other splits or written by the other ranks,
+        # and replace it atomically through a unique temporary file
+        try:
+            manifest = json.load(open(manifest_path, 'r', encoding='UTF-8'))
+        except (OSError, ValueError):
+            manifest = {}
+        for key, entry in updates.items():
+            if entry is None:
+                manifest.pop(key, None)
+            else:
+                manifest[key] = entry
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest_path) or '.', prefix='.tmp-')
+        except OSError:
+            return
         try:
-            for y in range(0, height):
-                y = height - y - 1
-                if _img.getpixel((0, y)) > 0 and _img.getpixel((width - 1, y)) > 0:
-                    return img.crop((0, 0, width, y - 1))
-        except:
-            pass
+            with os.fdopen(fd, 'w', encoding='UTF-8') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, manifest_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def get_trim_box(img:Image.Image):
+        '''
+        Find the crop box which removes the blank strip at the bottom of the image.
+        Only the two edge columns are converted to grayscale, and the last row whose both edge pixels are non-black is found at once.
+        :returns: Tuple (left, upper, right, lower), or `None` if the image needs no cropping.
+        '''
+        width, height = img.width, img.height
+        if width <= 0 or height <= 0:
+            return None
+        left = np.asarray(img.crop((0, 0, 1, height)).convert('L')).reshape(-1)
+        right = np.asarray(img.crop((width - 1, 0, width, height)).convert('L')).reshape(-1)
+        rows = np.flatnonzero((left > 0) & (right > 0))
+        if not len(rows) or rows[-1] < 1:
+            return None
+        return (0, 0, width, int(rows[-1]) - 1)
+
+    @staticmethod
+    def decode_image(binary:bytes, size:tuple=None):
+        '''
+        Open the encoded image. A JPEG image is decoded at the smallest DCT scale (1/2, 1/4 or 1/8)
+        whose size is still not less than the given size, which costs much less than the native resolution.
+        :param size: The minimum (width, height), `None` for the native resolution.
+        :returns: Image object, which is decoded lazily.
+        '''
+        img = Image.open(BytesIO(binary))
+        if size:
+            img.draft('RGB', size)
         return img
+
+    @staticmethod
+    def trim_image_bottom_blank(img:Image.Image):
+        box = StreetViewImageDataset.get_trim_box(img)
+        return img.crop(box) if box else img
+
+    def trim_images_bottom_blank(self, images:list, keys:list=None):
+        '''
+        Trim the bottom blank of many images at once.
+        :param images: The list of Image objects.
+        :param keys: The list of the image keys, the crop boxes of which are cached in `self.trim_boxes`.
+        :returns: The list of the trimmed Image objects.
+        '''
+        result = []
+        for i, img in enumerate(images):
+            key = keys[i] if keys else None
+            if key is not None and key in self.trim_boxes:
+                box = self.trim_boxes[key]
+            else:
+                box = self.get_trim_box(img)
+                if key is not None:
+                    self.trim_boxes[key] = box
+            result.append(img.crop(box) if box else img)
+        return result
     
     def target_to_index(self, target):
-        for i in range(len(self.targets)):
-            if target == self.targets[i]['name']:
-                return i
+        return self.target_indices.get(target)
     
     def index_to_target(self, index):
         return self.targets[index]['name']
+
+    def export_cache(self, cache_dir:str):
+        '''
+        Export the pre-decoded images to a tensor cache directory, which can be loaded by `StreetViewCachedImageDataset`.
+        Every image is trimmed, cropped by all the enhance methods and resized in advance,
+        then stored as uint8 HWC arrays in a memory-mappable `.npy` file.
+        :param cache_dir: The directory to save the cache files.
+        :returns: The number of samples exported.
+        '''
+        os.makedirs(cache_dir, exist_ok=True)
+        keys = self.keys
+        views = len(self.views)
+        height, width = self.image_size
+        images = np.lib.format.open_memmap(os.path.join(cache_dir, StreetViewCachedImageDataset.images_file),
+            mode='w+', dtype=np.uint8, shape=(len(keys), views, height, width, 3))
+        resize = transforms.Resize(self.image_size)
+        for i, key in enumerate(keys):
+            img = self.decode_image(self.data[key]['image'], self.decode_size).convert('RGB')
+            img = self.trim_image_bottom_blank(img)
+            for v, method in enumerate(self.views):
+                images[i, v] = np.asarray(resize(method(img)).convert('RGB'), dtype=np.uint8)
+        images.flush()
+        del images
+        np.save(os.path.join(cache_dir, StreetViewCachedImageDataset.labels_file), self.labels)
+        with open(os.path.join(cache_dir, StreetViewCachedImageDataset.index_file), 'w', encoding='UTF-8') as f:
+            json.dump({'keys': keys, 'targets': self.targets}, f, ensure_ascii=False)
+        return len(keys)
+
+
+class StreetViewImageSampleDataset(StreetViewImageDataset):
+    '''Street View Image Sample Dataset class, which decodes each sample once into a uint8 tensor,
+    so that the views are generated from batches by `StreetViewTensorAugment` instead of per PIL image.'''
+
+    sample_size = (224, 448)
+
+    def __getitem__(self, index):
+        index = index % self.__len__()
+        key = self.keys[index]
+        img = self.decode_image(self.data[key]['image'], self.decode_size)
+        img = self.trim_images_bottom_blank([img], [key])[0].convert('RGB')
+        img = img.resize((self.sample_size[1], self.sample_size[0]), Image.BILINEAR)
+        img = torch.from_numpy(np.asarray(img, dtype=np.uint8).copy()).permute(2, 0, 1)
+        return img, int(self.labels[index])
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class StreetViewTensorAugment():
+    '''Street View Tensor Augment, which generates the views of a batch of uint8 sample tensors.
+    It can be used as the `collate_fn` of a DataLoader over `StreetViewImageSampleDataset`.'''
+
+    view_methods = {
+        'left':  lambda x: x[..., :x.shape[-1] // 2],
+        'right': lambda x: x[..., x.shape[-1] // 2:],
+        'center': lambda x: x[..., x.shape[-1] // 4:x.shape[-1] // 4 + x.shape[-1] // 2],
+        'left-flip':  lambda x: x[..., :x.shape[-1] // 2].flip(-1),
+        'right-flip': lambda x: x[..., x.shape[-1] // 2:].flip(-1)
+    }
+    '''The dictionary mapping the name of each view to its generator over (N, C, H, W) tensors.'''
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+    def __init__(self, views:list=('left', 'right'), image_size:tuple=StreetViewImageDataset.image_size):
+        '''
+        Initialize a StreetViewTensorAugment instance.
+        :param views: The names of the views in `view_methods`, or callables over (N, C, H, W) tensors.
+        '''
+        self.views = [self.view_methods[v] if isinstance(v, str) else v for v in views]
+        self.image_size = image_size
+
+    def __call__(self, batch):
+        '''
+        :param batch: The list of (uint8 tensor, label) pairs, or a tuple (uint8 tensor of (N, C, H, W), label tensor).
+        :returns: Tuple (normalized float tensor of (N * views, C, H, W), label tensor), in the same view-major order as the datasets.
+        '''
+        if isinstance(batch, list):
+            images = torch.stack([b[0] for b in batch])
+            labels = torch.tensor([b[1] for b in batch], dtype=torch.long)
+        else:
+            images, labels = batch
+        views = []
+        for method in self.views:
+            x = method(images).float().div_(255)
+            if tuple(x.shape[-2:]) != tuple(self.image_size):
+                x = torch.nn.functional.interpolate(x, size=self.image_size, mode='bilinear', align_corners=False)
+            views.append(x)
+        x = torch.cat(views).sub_(self.mean).div_(self.std)
+        return x, labels.repeat(len(self.views))
+
+
+class StreetViewShardDataset(IterableDataset):
+    '''Street View Shard Dataset class, which streams the sharded images sequentially instead of holding them in memory. \n
+    The shards are split across the distributed ranks and the DataLoader workers,
+    and the samples are shuffled through a bounded buffer.'''
+
+    shard_name = 'shard-{:05d}'
+    index_file = 'index.json'
+    image_ext = '.jpg'
+
+    def __init__(self, root:str, targets:dict=None, views:list=None, transform:transforms.Compose=StreetViewImageDataset.transform,
+            shuffle_buffer:int=1000, seed:int=0):
+        '''
+        Initialize a StreetViewShardDataset instance.
+        :param root: The directory of the shards written by `StreetViewDataset.to_shards` or `Harvest.HarvestStore`.
+        :param targets: The dictionary mapping the number of each target place to its information, `None` to read from the index or the sidecars.
+        :param views: The list of the view generators, `None` for the enhance methods.
+        :param shuffle_buffer: The size of the shuffle buffer, 0 to disable shuffling.
+        '''
+        super().__init__()
+        self.root = root
+        self.views = list(views) if views else list(StreetViewImageDataset.enhance_methods)
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        index_path = os.path.join(root, self.index_file)
+        index = json.load(open(index_path, 'r', encoding='UTF-8')) if os.path.isfile(index_path) else None
+        if index:
+            self.shards = [s['name'] for s in index['shards']]
+        else:
+            self.shards = sorted(os.path.basename(p)[:-len('.jsonl')]
+                for p in glob.glob(os.path.join(root, self.shard_name.replace('{:05d}', '*') + '.jsonl')))
+        if index and targets is None:
+            targets = {int(k): v for k, v in index['targets'].items()}
+            self.num_samples = sum(s['count'] for s in index['shards'])
+        else:
+            meta = {key: {'target': item['target'], 'lng': item['lng'], 'lat': item['lat']} for key, item in self.__iter_metadata()}
+            if targets is None:
+                targets = StreetViewDataset(meta).targets
+            names = set(v['name'] for v in targets.values())
+            self.num_samples = sum(1 for item in meta.values() if item['target'] in names)
+        self.targets:dict = targets
+        self.classes = list(targets.keys())
+        self.num_classes = len(self.classes)
+        self.target_indices:dict = {v['name']: k for k, v in targets.items()}
+
+    def __len__(self):
+        '''
+        The number of the (sample, view) pairs of the records whose targets are known.
+        The images are validated when written by `StreetViewDataset.to_shards` or `Harvest.HarvestStore`,
+        so only a shard corrupted afterwards can yield fewer.
+        '''
+        return self.num_samples * len(self.views)
+
+    def set_epoch(self, epoch:int):
+        '''Set the epoch, which changes the shuffling order.'''
+        self.epoch = epoch
+
+    def __iter_metadata(self, shards:list=None):
+        for name in self.shards if shards is None else shards:
+            with open(os.path.join(self.root, name + '.jsonl'), 'r', encoding='UTF-8') as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        yield item.pop('key'), item
+
+    def get_assigned_shards(self):
+        '''
+        The shards are dealt to the ranks and then to the workers in turn, so each reader gets the same number of them
+        only if the shard count is a multiple of the world size times the workers.
+        :returns: The list of the shard names assigned to the current rank and worker, shuffled by the epoch.
+        '''
+        rank, world = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        shards = list(self.shards)
+        if self.shuffle_buffer > 0:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[rank::world][worker_id::num_workers]
+
+    def __iter_samples(self, shards:list):
+        for name in shards:
+            meta = dict(self.__iter_metadata([name]))
+            with tarfile.open(os.path.join(self.root, name + '.tar'), 'r|') as tar:
+                for member in tar:
+                    key = member.name[:-len(self.image_ext)]
+                    item = meta.pop(key, None)
+                    if item is None or item['target'] not in self.target_indices:
+                        continue
+                    yield key, tar.extractfile(member).read(), self.target_indices[item['target']]
+
+    def __iter__(self):
+        shards = self.get_assigned_shards()
+        worker = get_worker_info()
+        # Not `hash`, whose value of the strings is salted per process, so that the order is reproducible
+        rnd = random.Random(((self.seed * 1000003 + self.epoch) * 1000003 + (worker.id if worker else 0)) * 2 ** 32
+            + zlib.crc32(','.join(shards).encode('UTF-8')))
+        buffer = []
+        for sample in self.__iter_samples(shards):
+            if self.shuffle_buffer <= 0:
+                yield from self.__process(sample)
+                continue
+            buffer.append(sample)
+            if len(buffer) >= self.shuffle_buffer:
+                i = rnd.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield from self.__process(buffer.pop())
+        rnd.shuffle(buffer)
+        for sample in buffer:
+            yield from self.__process(sample)
+
+    def __process(self, sample:tuple):
+        _, binary, label = sample
+        try:
+            img = StreetViewImageDataset.decode_image(binary, StreetViewImageDataset.decode_size).convert('RGB')
+            img = StreetViewImageDataset.trim_image_bottom_blank(img)
+        except Exception:
+            return
+        for method in self.views:
+            yield self.transform(method(img)), label
+
+
+class StreetViewCachedImageDataset(VisionDataset):
+    '''Street View Cached Image Dataset class, which slices the pre-decoded images from a memory-mapped tensor cache'''
+
+    images_file = 'images.npy'
+    labels_file = 'labels.npy'
+    index_file = 'index.json'
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+    def __init__(self, root:str):
+        '''
+        Initialize a StreetViewCachedImageDataset instance.
+        :param root: The cache directory exported by `StreetViewImageDataset.export_cache`.
+        '''
+        super(StreetViewCachedImageDataset, self).__init__(root)
+        index = json.load(open(os.path.join(root, self.index_file), 'r', encoding='UTF-8'))
+        self.keys:list = index['keys']
+        '''The ordered list of the image keys.'''
+        self.targets:dict = {int(k): v for k, v in index['targets'].items()}
+        '''The dictionary mapping the number of each target place to its information.'''
+        self.classes = list(self.targets.keys())
+        self.num_classes = len(self.classes)
+        self.labels = np.load(os.path.join(root, self.labels_file))
+        self.__images = None
+
+    @property
+    def images(self):
+        '''The memory-mapped image array of shape (samples, views, H, W, 3), opened lazily in each worker process.'''
+        if self.__images is None:
+            self.__images = np.load(os.path.join(self.root, self.images_file), mmap_mode='r')
+        return self.__images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_StreetViewCachedImageDataset__images'] = None
+        return state
+
+    def __getitem__(self, index):
+        # The same index layout as StreetViewImageDataset: index = view * samples + sample
+        index = index % len(self)
+        sample, view = index % len(self.keys), index // len(self.keys)
+        img = torch.from_numpy(np.array(self.images[sample, view]))
+        img = img.permute(2, 0, 1).float().div_(255)
+        img = img.sub_(self.mean).div_(self.std)
+        return img, int(self.labels[sample])
+
+    def __len__(self):
+        return len(self.keys) * self.images.shape[1]
+
+    def index_to_target(self, index):
+        return self.targets[index]['name']
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, json, time, hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, Subset
+from Model import TuxunAIStudentModel
+from Train import Trainer, accuracy, load_image_dataset, split_dataset, make_loader
+
+
+class _IndexedDataset(Dataset):
+    # Yields the position of each item as well, to look up its cached teacher logits
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        x, y = self.dataset[index]
+        return x, y, index
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def get_logits_cache_key(teacher_path:str, dataset):
+    '''
+    Get the fingerprint of the teacher file and the items of the dataset in order, which the cached logits are valid for.
+    :param dataset: The dataset with `keys`, or a Subset of it.
+    :returns: The hex digest string.
+    '''
+    stat = os.stat(teacher_path)
+    digest = hashlib.sha1(f"{os.path.abspath(teacher_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode('UTF-8'))
+    base, indices = (dataset.dataset, [int(i) for i in dataset.indices]) if isinstance(dataset, Subset) else (dataset, None)
+    digest.update(json.dumps([list(getattr(base, 'keys', [])), len(base), indices]).encode('UTF-8'))
+    return digest.hexdigest()
+
+@torch.inference_mode()
+def cache_teacher_logits(teacher:nn.Module, dataset, path:str=None, batch_size:int=64, workers:int=0, key:str=None):
+    '''
+    Run the teacher once over the dataset in order.
+    :param path: The `.npy` file to cache the logits in, `None` to disable.
+    :param key: The key of the teacher and the dataset by `get_logits_cache_key`, saved beside the cache file,
+        the cache is reused only if the key matches.
+    :returns: Tensor of shape (N, classes) of the float16 logits.
+    '''
+    key_path = os.path.splitext(path)[0] + '.json' if path else None
+    if path and os.path.isfile(path) and os.path.isfile(key_path):
+        try:
+            cached_key = json.load(open(key_path, 'r', encoding='UTF-8'))['key']
+        except (OSError, ValueError, KeyError):
+            cached_key = None
+        logits = np.load(path)
+        if cached_key == key and len(logits) == len(dataset):
+            return torch.from_numpy(logits)
+    teacher.eval()
+    logits = torch.cat([teacher(x).half() for x, _ in make_loader(dataset, batch_size, False, workers)])
+    if path:
+        np.save(path, logits.numpy())
+        with open(key_path, 'w', encoding='UTF-8') as f:
+            json.dump({'key': key}, f)
+    return logits
+
+def distillation_loss(student_logits:torch.Tensor, teacher_logits:torch.Tensor, labels:torch.Tensor, temperature:float=4.0, alpha:float=0.7):
+    '''
+    The weighted sum of the KL divergence to the softened teacher distribution and the cross entropy to the hard labels.
+    :param alpha: The weight of the soft labels.
+    '''
+    soft = F.kl_div(F.log_softmax(student_logits / temperature, dim=1), F.softmax(teacher_logits / temperature, dim=1),
+        reduction='batchmean') * temperature ** 2
+    return alpha * soft + (1 - alpha) * F.cross_entropy(student_logits, labels)
+
+
+class DistillTrainer(Trainer):
+    '''Distill Trainer, which trains the student on the cached soft labels of the teacher.'''
+
+    def __init__(self, model:TuxunAIStudentModel, teacher_logits:torch.Tensor, temperature:float=4.0, alpha:float=0.7,
+            device:str='cpu', channels_last:bool=True):
+        '''
+        Initialize a DistillTrainer instance.
+        :param teacher_logits: Tensor of shape (N, classes) of the teacher logits, in the order of the training set.
+        '''
+        super().__init__(model, device, channels_last)
+        self.teacher_logits = teacher_logits
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def train_epoch(self, loader:DataLoader):
+        '''
+        Train one epoch.
+        :param loader: The loader over `_IndexedDataset` of the training set.
+        :returns: A dict containing the loss and the top-1/top-5 accuracy.
+        '''
+        self.model.train()
+        total, loss_sum, correct = 0, 0.0, [0, 0]
+        for x, y, index in loader:
+            x, y = self._to_device(x), y.to(self.device, non_blocking=True)
+            logits = self.model(x)
+            loss = distillation_loss(logits, self.teacher_logits[index].float().to(self.device), y, self.temperature, self.alpha)
+            self.optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            self.optimizer.step()
+            total += len(y)
+            loss_sum += loss.item() * len(y)
+            correct = [a + b for a, b in zip(correct, accuracy(logits.detach(), y))]
+        self.epoch += 1
+        total = max(1, total)
+        return {'loss': loss_sum / total, 'acc1': correct[0] / total, 'acc5': correct[1] / total}
+
+
+if __name__ == '__main__':
+    import argparse
+    from Export import load_eager_model, export_torchscript, quantize_dynamic, evaluate, measure_latency
+    parser = argparse.ArgumentParser(description='Tuxun-AI student distillation')
+    parser.add_argument('--data', required=True, help='JSON file of the street view data, or a tensor cache directory')
+    parser.add_argument('--images', default='images')
+    parser.add_argument('--mapping', default=os.path.join('models', 'mapping.json'))
+    parser.add_argument('--teacher', default=os.path.join('models', 'v0.3.0.pth'))
+    parser.add_argument('--output', default=os.path.join('models', 'student.pth'))
+    parser.add_argument('--logits-cache', default='teacher_logits.npy', help='file to cache the teacher logits of the training set in')
+    parser.add_argument('--pretrained', action='store_true', help='initialize the student backbone from the ImageNet weights')
+    parser.add_argument('--val-ratio', type=float, default=0.1)
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.7, help='weight of the soft labels against the hard labels')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for default')
+    parser.add_argument('--report', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    mapping = json.load(open(args.mapping, 'r', encoding='UTF-8'))
+    dataset = load_image_dataset(args.data, args.images, args.mapping)
+    train_set, val_set = split_dataset(dataset, args.val_ratio)
+    val_loader = make_loader(val_set, args.batch_size, False, args.workers)
+    teacher = load_eager_model(args.teacher, len(mapping))
+
+    t = time.perf_counter()
+    teacher_logits = cache_teacher_logits(teacher, train_set, args.logits_cache, args.batch_size, args.workers,
+        get_logits_cache_key(args.teacher, train_set))
+    print(f"Teacher logits: {tuple(teacher_logits.shape)} in {time.perf_counter() - t:.1f}s")
+
+    if args.pretrained:
+        import torchvision.models as models
+        backbone = models.mobilenet_v3_small(weights=models.MobileNet_V3_Small_Weights.DEFAULT)
+        student = TuxunAIStudentModel(backbone.features, backbone.avgpool, TuxunAIStudentModel.get_classifier(len(mapping)))
+    else:
+        student = TuxunAIStudentModel(classifier=TuxunAIStudentModel.get_classifier(len(mapping)))
+    trainer = DistillTrainer(student, teacher_logits, args.temperature, args.alpha)
+    trainer.set_phase('full', args.lr)
+    train_loader = make_loader(_IndexedDataset(train_set), args.batch_size, True, args.workers)
+    for epoch in range(args.epochs):
+        t = time.perf_counter()
+        train_result = trainer.train_epoch(train_loader)
+        val_result = trainer.evaluate(val_loader)
+        print(f"Epoch {trainer.epoch}\ttrain loss {train_result['loss']:.4f}\tAcc@1 {train_result['acc1']*100:.2f}%"
+            f"\tval Acc@1 {val_result['acc1']*100:.2f}%\tAcc@5 {val_result['acc5']*100:.2f}%\t{time.perf_counter() - t:.1f}s")
+        if val_result['acc1'] > trainer.best_acc or not os.path.isfile(args.output):
+            trainer.best_acc = val_result['acc1']
+            torch.save(trainer.model.state_dict(), args.output)
+
+    # Accuracy, CPU latency and size of the teacher and the student
+    student = load_eager_model(args.output, len(mapping))
+    prefix = os.path.splitext(args.output)[0]
+    export_torchscript(quantize_dynamic(student), prefix + '.dynamic.pt')
+    variants = {
+        'teacher': (teacher, args.teacher),
+        'student': (student, args.output),
+        'student-dynamic-int8': (torch.jit.load(prefix + '.dynamic.pt'), prefix + '.dynamic.pt')
+    }
+    report = {}
+    for name, (model, path) in variants.items():
+        entry = {'path': path, 'size_mb': round(os.path.getsize(path) / 2 ** 20, 2), 'latency_ms': round(measure_latency(model), 2)}
+        entry.update(evaluate(model, val_loader))
+        report[name] = entry
+        print(f"{name:<22}\t{entry['size_mb']:>7.2f}MB\t{entry['latency_ms']:>7.2f}ms\tAcc@1 {entry['acc1']*100:.2f}%\tAcc@5 {entry['acc5']*100:.2f}%")
+    if args.report:
+        json.dump(report, open(args.report, 'w', encoding='UTF-8'), indent=4)
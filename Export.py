@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, json, copy, time
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+from Model import TuxunAIModelV0, TuxunAIStudentModel
+from Train import accuracy, load_image_dataset, split_dataset, make_loader
+
+
+def load_eager_model(model_path:str, num_classes:int):
+    ''':returns: TuxunAIModelV0 or TuxunAIStudentModel object in eval mode.'''
+    state_dict = TuxunAIModelV0.strip_region_heads(torch.load(model_path, map_location='cpu'))
+    model_class = TuxunAIModelV0.get_model_class(state_dict)
+    model = model_class(classifier=model_class.get_classifier(num_classes))
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+def export_torchscript(model:nn.Module, path:str, image_size=(224, 224)):
+    '''
+    Trace and freeze the model, then save it as a TorchScript artifact.
+    :returns: The frozen ScriptModule.
+    '''
+    example = torch.zeros(1, 3, *image_size)
+    with torch.inference_mode():
+        script = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    torch.jit.save(script, path)
+    return script
+
+def export_onnx(model:nn.Module, path:str, image_size=(224, 224)):
+    '''Save the model as an ONNX artifact with a dynamic batch axis. Requires the optional `onnx` and `onnxscript` packages.'''
+    try:
+        import onnx, onnxscript
+    except ImportError:
+        raise ImportError("ONNX export requires onnx and onnxscript, install them by: pip install onnx onnxscript")
+    example = torch.zeros(1, 3, *image_size)
+    torch.onnx.export(model.eval(), example, path, input_names=['image'], output_names=['logits'],
+        dynamic_axes={'image': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17)
+
+def quantize_dynamic(model:nn.Module):
+    '''
+    Quantize the linear layers to int8 dynamically, the convolutional backbone stays fp32.
+    :returns: The quantized model.
+    '''
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static(model:TuxunAIModelV0, calibration:DataLoader, num_batches:int=32, backend:str='x86'):
+    '''
+    Quantize the whole model to int8 statically, the activation ranges are calibrated on the given data.
+    The weights are copied into the quantizable MobileNetV3 of torchvision, whose layers can be fused.
+    :returns: The quantized model.
+    '''
+    from torchvision.models.quantization import mobilenet_v3_large
+    torch.backends.quantized.engine = backend
+    qmodel = mobilenet_v3_large(weights=None, quantize=False)
+    qmodel.features.load_state_dict(model.features.state_dict())
+    qmodel.avgpool = copy.deepcopy(model.avgpool)
+    qmodel.classifier = copy.deepcopy(model.classifier)
+    qmodel.eval()
+    qmodel.fuse_model(is_qat=False)
+    qmodel.qconfig = torch.ao.quantization.get_default_qconfig(backend)
+    torch.ao.quantization.prepare(qmodel, inplace=True)
+    with torch.inference_mode():
+        for i, (x, _) in enumerate(calibration):
+            if i >= num_batches:
+                break
+            qmodel(x)
+    torch.ao.quantization.convert(qmodel, inplace=True)
+    return qmodel
+
+@torch.inference_mode()
+def evaluate(model, loader:DataLoader):
+    ''':returns: A dict containing the top-1/top-5 accuracy.'''
+    total, correct = 0, [0, 0]
+    for x, y in loader:
+        logits = model(x)
+        total += len(y)
+        correct = [a + b for a, b in zip(correct, accuracy(logits, y))]
+    total = max(1, total)
+    return {'acc1': correct[0] / total, 'acc5': correct[1] / total}
+
+@torch.inference_mode()
+def measure_latency(model, image_size=(224, 224), repeat:int=50):
+    ''':returns: The median latency(ms) of a single-image forward pass.'''
+    x = torch.randn(1, 3, *image_size)
+    for _ in range(5):
+        model(x)
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        model(x)
+        samples.append(time.perf_counter() - t)
+    return sorted(samples)[len(samples) // 2] * 1000
+
+
+if __name__ == '__main__':
+    import argparse
+    from Inference import TuxunPredictor
+    parser = argparse.ArgumentParser(description='Tuxun-AI model export and quantization')
+    parser.add_argument('--model', default=os.path.join('models', 'v0.3.0.pth'))
+    parser.add_argument('--mapping', default=os.path.join('models', 'mapping.json'))
+    parser.add_argument('--data', default=None, help='JSON file of the street view data, or a tensor cache directory, used for calibration and evaluation')
+    parser.add_argument('--images', default='images')
+    parser.add_argument('--val-ratio', type=float, default=0.1)
+    parser.add_argument('--calibration-batches', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--backend', default='x86', help="quantized engine, 'x86', 'fbgemm' or 'qnnpack'")
+    parser.add_argument('--onnx', action='store_true', help='also export the fp32 ONNX artifact')
+    parser.add_argument('--report', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+
+    mapping = json.load(open(args.mapping, 'r', encoding='UTF-8'))
+    model = load_eager_model(args.model, len(mapping))
+    prefix = os.path.splitext(args.model)[0]
+    artifacts = {'fp32': args.model}
+
+    export_torchscript(model, prefix + '.fp32.pt')
+    artifacts['fp32-ts'] = prefix + '.fp32.pt'
+    export_torchscript(quantize_dynamic(model), prefix + '.dynamic.pt')
+    artifacts['dynamic-int8'] = prefix + '.dynamic.pt'
+    if args.onnx:
+        export_onnx(model, prefix + '.onnx')
+        artifacts['fp32-onnx'] = prefix + '.onnx'
+
+    eval_loader = None
+    if args.data:
+        dataset = load_image_dataset(args.data, args.images, args.mapping)
+        _, held_out = split_dataset(dataset, args.val_ratio)
+        half = len(held_out) // 2
+        calibration = make_loader(Subset(held_out, range(half)), args.batch_size, True)
+        eval_loader = make_loader(Subset(held_out, range(half, len(held_out))), args.batch_size, False)
+        if isinstance(model, TuxunAIStudentModel):
+            # torchvision has no quantizable mobilenet_v3_small to fuse the student into
+            print("The static int8 variant of the student model is skipped")
+        else:
+            export_torchscript(quantize_static(model, calibration, args.calibration_batches, args.backend), prefix + '.int8.pt')
+            artifacts['static-int8'] = prefix + '.int8.pt'
+    else:
+        print("No --data given, the static int8 variant and the accuracy report are skipped")
+
+    report = {}
+    base = None
+    for name, path in artifacts.items():
+        predictor = TuxunPredictor.load(path, args.mapping)
+        entry = {
+            'path': path,
+            'size_mb': round(os.path.getsize(path) / 2 ** 20, 2),
+            'latency_ms': round(measure_latency(predictor.forward), 2)
+        }
+        if eval_loader:
+            entry.update(evaluate(predictor.forward, eval_loader))
+            if base is None:
+                base = entry
+            entry['acc1_delta'] = entry['acc1'] - base['acc1']
+            entry['acc5_delta'] = entry['acc5'] - base['acc5']
+        report[name] = entry
+        line = f"{name:<14}\t{entry['size_mb']:>7.2f}MB\t{entry['latency_ms']:>7.2f}ms"
+        if eval_loader:
+            line += f"\tAcc@1 {entry['acc1']*100:.2f}% ({entry['acc1_delta']*100:+.2f})\tAcc@5 {entry['acc5']*100:.2f}% ({entry['acc5_delta']*100:+.2f})"
+        print(line)
+    if args.report:
+        json.dump(report, open(args.report, 'w', encoding='UTF-8'), indent=4)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, json, hashlib
+import numpy as np
+from Dataset import StreetViewDataset
+
+
+class TuxunGuessEngine():
+    '''Tuxun Guess Engine, which chooses the guess minimizing the expected distance under the predicted probabilities.'''
+
+    def __init__(self, mapping:dict, grid_step:float=None, cache_path:str=None):
+        '''
+        Initialize a TuxunGuessEngine instance.
+        The candidates of the guess are the target places, plus the points of a lng/lat grid if given.
+        :param mapping: The dictionary mapping the number(string) of each target place to its information.
+        :param grid_step: The step(degrees) of the candidate grid, `None` for the target places only.
+        :param cache_path: The `.npz` file to cache the distance matrix in, `None` to disable.
+        '''
+        order = sorted(mapping.keys(), key=int)
+        targets = np.array([[mapping[i]['lng'], mapping[i]['lat']] for i in order], dtype=np.float64).reshape(-1, 2)
+        candidates = targets
+        if grid_step:
+            lng, lat = np.meshgrid(np.arange(-180, 180, grid_step), np.arange(-90 + grid_step / 2, 90, grid_step))
+            candidates = np.concatenate([targets, np.stack([lng.ravel(), lat.ravel()], axis=1)])
+        self.candidates:np.ndarray = candidates
+        '''The array of shape (K, 2) of the lng and lat of the candidates.'''
+        self.distances:np.ndarray = self.__load_distances(targets, candidates, cache_path)
+        '''The float32 array of shape (C, K) of the great-circle distances(km) from each target place to each candidate.'''
+
+    @classmethod
+    def load(cls, mapping_path:str, grid_step:float=None, cache:bool=True):
+        '''
+        Load the engine from the given mapping file, the distance matrix is cached beside it as `<name>.distances.npz`.
+        :returns: TuxunGuessEngine object.
+        '''
+        mapping = json.load(open(mapping_path, 'r', encoding='UTF-8'))
+        cache_path = os.path.splitext(mapping_path)[0] + '.distances.npz' if cache else None
+        return cls(mapping, grid_step, cache_path)
+
+    @staticmethod
+    def get_distance_matrix(targets:np.ndarray, candidates:np.ndarray):
+        ''':returns: The float32 array of shape (C, K) of the great-circle distances(km).'''
+        return StreetViewDataset.get_distances(targets[:, :1], targets[:, 1:], candidates[None, :, 0], candidates[None, :, 1]).astype(np.float32)
+
+    def __load_distances(self, targets:np.ndarray, candidates:np.ndarray, cache_path:str):
+        digest = hashlib.sha1(targets.tobytes() + candidates.tobytes()).hexdigest()
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                cached = np.load(cache_path)
+                if str(cached['digest']) == digest:
+                    return cached['distances']
+            except (OSError, KeyError, ValueError):
+                pass
+        distances = self.get_distance_matrix(targets, candidates)
+        if cache_path:
+            try:
+                np.savez(cache_path, distances=distances, digest=np.array(digest))
+            except OSError:
+                pass
+        return distances
+
+    def expected_distances(self, probs):
+        '''
+        :param probs: Array-like of shape (C,) or (B, C) of the probabilities of the target places.
+        :returns: The array of shape (B, K) of the expected distance(km) of guessing each candidate.
+        '''
+        return np.atleast_2d(np.asarray(probs, dtype=np.float32)) @ self.distances
+
+    def guess(self, probs):
+        '''
+        Choose the guess of each probability vector in one matrix multiply.
+        :param probs: Array-like of shape (C,) or (B, C).
+        :returns: Tuple (coords, expected), coords is the array of shape (B, 2) of the lng and lat,
+            expected is the array of shape (B,) of the minimum expected distances(km).
+        '''
+        expected = self.expected_distances(probs)
+        best = np.argmin(expected, axis=1)
+        return self.candidates[best], expected[np.arange(len(best)), best]
+
+    def guess_one(self, probs):
+        ''':returns: A dict containing the lng, the lat and the expected distance(km) of the guess of a single probability vector.'''
+        coords, expected = self.guess(probs)
+        return {'lng': round(float(coords[0, 0]), 5), 'lat': round(float(coords[0, 1]), 5), 'expected_distance': float(expected[0])}
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, json, glob, tarfile, tempfile, threading, time
+from io import BytesIO
+from Dataset import StreetViewDataset, StreetViewImageDataset, validate_image
+from TuxunAgent import TuxunAgent, TuxunGame, StreetView
+
+
+class HarvestStore():
+    '''Harvest Store, an append-only sharded store of street view records.'''
+
+    shard_name = 'shard-{:05d}'
+    image_ext = '.jpg'
+
+    def __init__(self, root:str, shard_size:int=1000):
+        '''
+        Initialize a HarvestStore instance, the existing records in the directory are resumed.
+        Each shard consists of a tar file holding the images and a JSON Lines file holding the metadata,
+        a record is committed once its metadata line is written.
+        The tar file of the current shard is kept open for appending, call `close` when done.
+        :param root: The store directory.
+        :param shard_size: The maximum number of records in a shard.
+        '''
+        self.root = root
+        self.shard_size = shard_size
+        self.__lock = threading.Lock()
+        self.__shard = 0
+        self.__shard_count = 0
+        self.__tar = None
+        os.makedirs(root, exist_ok=True)
+        data = {}
+        for path in sorted(glob.glob(os.path.join(root, self.shard_name.replace('{:05d}', '*') + '.jsonl'))):
+            self.__shard = int(os.path.basename(path)[len('shard-'):-len('.jsonl')])
+            self.__shard_count = 0
+            with open(path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        data[item.pop('key')] = item
+                        self.__shard_count += 1
+        self.dataset = StreetViewDataset(data)
+        '''StreetViewDataset object of all the records, whose targets are updated incrementally.'''
+
+    def __contains__(self, key:str):
+        return key in self.dataset.data
+
+    def __len__(self):
+        return len(self.dataset.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Close the tar file of the current shard, which is reopened on the next append.'''
+        with self.__lock:
+            self.__close_tar()
+
+    def __close_tar(self):
+        if self.__tar:
+            self.__tar.close()
+            self.__tar = None
+
+    def append(self, key:str, image:bytes, target:str, lng:float, lat:float):
+        '''
+        Append a record to the store, the record will be ignored if the key already exists or the image is invalid.
+        :returns: True if appended.
+        '''
+        if 'error' in validate_image(image, StreetViewImageDataset.min_image_size):
+            return False
+        with self.__lock:
+            if key in self.dataset.data:
+                return False
+            if self.__shard_count >= self.shard_size:
+                self.__close_tar()
+                self.__shard += 1
+                self.__shard_count = 0
+            name = self.shard_name.format(self.__shard)
+            # Opening in append mode reads every member header, so it is done once per shard rather than per record
+            if self.__tar is None:
+                self.__tar = tarfile.open(os.path.join(self.root, name + '.tar'), 'a')
+            info = tarfile.TarInfo(key + self.image_ext)
+            info.size = len(image)
+            info.mtime = int(time.time())
+            self.__tar.addfile(info, BytesIO(image))
+            # The image must be on disk before the metadata line commits the record
+            self.__tar.fileobj.flush()
+            item = {'target': target, 'lng': lng, 'lat': lat}
+            with open(os.path.join(self.root, name + '.jsonl'), 'a', encoding='UTF-8') as f:
+                f.write(json.dumps(dict(key=key, **item), ensure_ascii=False) + '\n')
+            self.__shard_count += 1
+            self.dataset.append(key, item)
+            return True
+
+    def get_cursor(self, name:str):
+        ''':returns: The saved cursor of the given source, `None` if not saved.'''
+        try:
+            return json.load(open(os.path.join(self.root, 'cursor.json'), 'r', encoding='UTF-8')).get(name)
+        except (OSError, ValueError):
+            return None
+
+    def set_cursor(self, name:str, value):
+        '''Save the cursor of the given source atomically.'''
+        with self.__lock:
+            path = os.path.join(self.root, 'cursor.json')
+            try:
+                cursors = json.load(open(path, 'r', encoding='UTF-8'))
+            except (OSError, ValueError):
+                cursors = {}
+            cursors[name] = value
+            fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+            with os.fdopen(fd, 'w', encoding='UTF-8') as f:
+                json.dump(cursors, f, ensure_ascii=False)
+            os.replace(tmp, path)
+
+    def export_images(self, image_root:str):
+        '''
+        Extract the images which do not exist yet to the directory layout that `StreetViewImageDataset` expects.
+        :returns: The number of images extracted.
+        '''
+        os.makedirs(image_root, exist_ok=True)
+        count = 0
+        for path in sorted(glob.glob(os.path.join(self.root, self.shard_name.replace('{:05d}', '*') + '.tar'))):
+            with tarfile.open(path, 'r') as tar:
+                for member in tar:
+                    key = member.name[:-len(self.image_ext)]
+                    fpath = os.path.join(image_root, member.name)
+                    if key in self.dataset.data and not os.path.exists(fpath):
+                        with open(fpath, 'wb') as f:
+                            f.write(tar.extractfile(member).read())
+                        count += 1
+        return count
+
+
+class TuxunHarvester():
+    '''Tuxun Harvester, which turns the answered games into street view records.'''
+
+    def __init__(self, store:HarvestStore):
+        self.store = store
+
+    @staticmethod
+    def get_key(game:TuxunGame):
+        ''':returns: The record key of the last round of the game.'''
+        return f"{game.id}-{len(game.rounds)}"
+
+    def harvest(self, game:TuxunGame):
+        '''
+        Harvest the last round of the game if it has been answered.
+        :returns: True if a new record is appended.
+        '''
+        if type(game) != TuxunGame or not game.has_answer() or not game.pano:
+            return False
+        key = self.get_key(game)
+        if key in self.store:
+            return False
+        image = StreetView(game.pano).get_image_bytes()
+        if type(image) != bytes:
+            return False
+        return self.store.append(key, image, game.last_guess_target,
+            game.last_guess_target_lng, game.last_guess_target_lat)
+
+    def run(self, agent:TuxunAgent, game_ids:list, mode:str='solo', source:str='default'):
+        '''
+        Harvest the given games in order, resuming from the saved cursor of the source.
+        :returns: The number of new records.
+        '''
+        start = self.store.get_cursor(source) or 0
+        count = 0
+        for i in range(start, len(game_ids)):
+            if self.harvest(agent.get(game_ids[i], mode)):
+                count += 1
+            self.store.set_cursor(source, i + 1)
+        return count
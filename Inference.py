@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, json, time, threading, queue
+import torch
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+from io import BytesIO
+from Dataset import StreetViewImageDataset
+from Model import TuxunAIModelV0
+import Metrics
+
+
+class TTAPolicy():
+    '''Test-Time Augmentation Policy, which decides the views of an image to run and how to aggregate them.'''
+
+    view_methods = {
+        'left':  StreetViewImageDataset.enhance_methods[0],
+        'right': StreetViewImageDataset.enhance_methods[1],
+        'center': lambda img: img.crop((img.width // 4, 0, img.width * 3 // 4, img.height)),
+        'left-flip':  lambda img: StreetViewImageDataset.enhance_methods[0](img).transpose(Image.FLIP_LEFT_RIGHT),
+        'right-flip': lambda img: StreetViewImageDataset.enhance_methods[1](img).transpose(Image.FLIP_LEFT_RIGHT),
+        'center-flip': lambda img: img.crop((img.width // 4, 0, img.width * 3 // 4, img.height)).transpose(Image.FLIP_LEFT_RIGHT)
+    }
+    '''The dictionary mapping the name of each view to its generator.'''
+
+    def __init__(self, views:list=('left', 'right'), early_exit:float=None, aggregate:str='logits'):
+        '''
+        Initialize a TTAPolicy instance, the default policy runs the two enhance crops and averages the logits.
+        :param views: The names of the views in `view_methods`, the first one is used for the early exit.
+        :param early_exit: The softmax margin between the top-2 places of the first view to stop early, `None` to disable.
+        :param aggregate: 'logits' to average the logits, or 'probs' to average the softmax probabilities.
+        '''
+        for v in views:
+            if v not in self.view_methods:
+                raise ValueError(f"Unknown view: {v}")
+        if aggregate not in ('logits', 'probs'):
+            raise ValueError(f"Unknown aggregation: {aggregate}")
+        self.views = list(views)
+        self.early_exit = early_exit
+        self.aggregate = aggregate
+
+    @classmethod
+    def parse(cls, text:str):
+        '''
+        Parse a policy from the text like `left,right,center-flip;exit=0.5;agg=probs`.
+        :returns: TTAPolicy object.
+        '''
+        parts = text.split(';')
+        kwargs = {'views': [v.strip() for v in parts[0].split(',') if v.strip()]}
+        for part in parts[1:]:
+            key, _, value = part.partition('=')
+            if key.strip() == 'exit':
+                kwargs['early_exit'] = float(value)
+            elif key.strip() == 'agg':
+                kwargs['aggregate'] = value.strip()
+        return cls(**kwargs)
+
+    def __str__(self):
+        text = ','.join(self.views)
+        if self.early_exit is not None:
+            text += f';exit={self.early_exit}'
+        return text + f';agg={self.aggregate}'
+
+    def aggregate_views(self, logits:torch.Tensor):
+        '''
+        Aggregate the per-view logits.
+        :param logits: Tensor of shape (views, classes).
+        :returns: The confidence tensor of shape (classes,).
+        '''
+        if self.aggregate == 'probs':
+            return torch.softmax(logits, dim=1).mean(dim=0)
+        return torch.softmax(logits.mean(dim=0), dim=0)
+
+    def is_confident(self, logits:torch.Tensor):
+        ''':returns: Whether the softmax margin of the single-view logits reaches the early exit threshold.'''
+        if self.early_exit is None or logits.numel() < 2:
+            return False
+        top = torch.softmax(logits, dim=0).topk(2).values
+        return float(top[0] - top[1]) >= self.early_exit
+
+
+class TuxunPredictor():
+    '''Tuxun Predictor, which turns street view images into ranked target places.'''
+
+    def __init__(self, model:torch.nn.Module, mapping:dict):
+        '''
+        Initialize a TuxunPredictor instance.
+        :param model: The model in eval mode.
+        :param mapping: The dictionary mapping the number(string) of each target place to its information.
+        '''
+        self.model = model
+        self.mapping = mapping
+        self.regions:dict = None
+        '''The dictionary mapping the number(string) of each target place to its regions, `None` if no region heads.'''
+        self.policy = TTAPolicy()
+        '''The test-time augmentation policy.'''
+        self.early_exits = 0
+        '''The number of predictions which exited early.'''
+
+    @classmethod
+    def load(cls, model_path:str, mapping_path:str, regions_path:str=None):
+        '''
+        Load the predictor from the given model file and mapping file.
+        The model file can be the eager weights (`.pth`) of the teacher or the student model,
+        an exported TorchScript artifact (`.pt`) or an ONNX artifact (`.onnx`) which requires the optional `onnxruntime` package.
+        :param regions_path: The regions file saved by `Train.py`, whose region heads weights are beside it, only for the eager weights.
+        :returns: TuxunPredictor object.
+        '''
+        mapping = json.load(open(mapping_path, 'r', encoding='UTF-8'))
+        regions = json.load(open(regions_path, 'r', encoding='UTF-8')) if regions_path else None
+        ext = os.path.splitext(model_path)[1].lower()
+        if ext == '.onnx':
+            model = _OnnxModel(model_path)
+        elif ext == '.pt':
+            model = torch.jit.load(model_path, map_location='cpu')
+            model.eval()
+        else:
+            state_dict = TuxunAIModelV0.strip_region_heads(torch.load(model_path, map_location='cpu'))
+            model_class = TuxunAIModelV0.get_model_class(state_dict)
+            model = model_class(classifier=model_class.get_classifier(len(mapping)))
+            # Both loads are strict, the main weights are loaded before the region heads are created
+            model.load_state_dict(state_dict)
+            if regions:
+                model.set_region_heads({int(c): len(r) for c, r in regions.items()})
+                model.region_heads.load_state_dict(torch.load(TuxunAIModelV0.get_region_heads_path(regions_path), map_location='cpu'))
+            model = model.to('cpu')
+            model.eval()
+        predictor = cls(model, mapping)
+        predictor.regions = regions
+        return predictor
+
+    def prepare(self, img:Image.Image):
+        '''
+        Decode the image if needed and trim its bottom blank.
+        A JPEG image which is not loaded yet is decoded at the reduced scale of `StreetViewImageDataset.decode_size`.
+        :param img: Image object, or the encoded image bytes.
+        :returns: Image object.
+        '''
+        if isinstance(img, bytes):
+            img = StreetViewImageDataset.decode_image(img, StreetViewImageDataset.decode_size)
+        elif StreetViewImageDataset.decode_size and img.format == 'JPEG':
+            # Does nothing if the image has been loaded
+            img.draft('RGB', StreetViewImageDataset.decode_size)
+        return StreetViewImageDataset.trim_image_bottom_blank(img.convert('RGB'))
+
+    def preprocess(self, img:Image.Image, views:list=None):
+        '''
+        Generate the crops of the given street view image.
+        :param img: Image object, or the encoded image bytes.
+        :param views: The names of the views to generate, `None` for all the views of the TTA policy.
+        :returns: Tensor of shape (views, 3, H, W).
+        '''
+        return self.transform_views(self.prepare(img), self.policy.views if views is None else views)
+
+    @staticmethod
+    def transform_views(img:Image.Image, views:list):
+        '''
+        Generate the crops of the given prepared image.
+        :returns: Tensor of shape (views, 3, H, W).
+        '''
+        return torch.stack([StreetViewImageDataset.transform(TTAPolicy.view_methods[v](img)) for v in views])
+
+    def forward(self, batch:torch.Tensor):
+        '''
+        Run the model on a batch of preprocessed crops without recording autograd graphs.
+        :returns: The logits tensor.
+        '''
+        with torch.inference_mode(), Metrics.timer('model_forward_seconds'):
+            return self.model(batch)
+
+    def embed(self, img:Image.Image):
+        '''
+        Get the feature vector of a single street view image, which is the mean pooled backbone output of all the crops.
+        Only available for the eager model.
+        :returns: Numpy array of shape (num_features,).
+        '''
+        with torch.inference_mode():
+            return self.model.forward_features(self.preprocess(img)).mean(dim=0).numpy()
+
+    def topk(self, logits:torch.Tensor, k:int=5):
+        '''
+        Rank the target places of the given per-view logits, which are aggregated by the TTA policy in advance.
+        :param logits: Tensor of shape (views, classes).
+        :returns: A list of dicts containing the target information and the confidence.
+        '''
+        confs = self.policy.aggregate_views(logits)
+        values, indices = torch.topk(confs, k=min(k, confs.numel()))
+        result = []
+        for conf, idx in zip(values.tolist(), indices.tolist()):
+            target = dict(self.mapping[str(idx)])
+            target['index'] = idx
+            target['confidence'] = conf
+            result.append(target)
+        return result
+
+    def predict(self, img:Image.Image, k:int=5):
+        '''
+        Predict the target places of a single street view image.
+        If the TTA policy enables early exit, the first view runs alone,
+        and the other views run in one batch only if the first view is not confident enough.
+        :returns: A list of dicts containing the target information and the confidence.
+        '''
+        return self.topk(self.__forward_policy(img), k)
+
+    def predict_probs(self, img:Image.Image):
+        '''
+        Predict the probabilities of all the target places of a single street view image, for `Guess.TuxunGuessEngine`.
+        :returns: Numpy array of shape (classes,).
+        '''
+        return self.policy.aggregate_views(self.__forward_policy(img)).numpy()
+
+    def __forward_policy(self, img:Image.Image):
+        views = self.policy.views
+        if self.policy.early_exit is None or len(views) < 2:
+            return self.forward(self.preprocess(img))
+        img = self.prepare(img)
+        logits = self.forward(self.transform_views(img, views[:1]))
+        if self.policy.is_confident(logits[0]):
+            self.early_exits += 1
+            return logits
+        return torch.cat([logits, self.forward(self.transform_views(img, views[1:]))])
+
+    def predict_regions(self, img:Image.Image, k:int=5, region_k:int=3):
+        '''
+        Predict the target places of a single street view image, together with the regions of each place.
+        The backbone runs once, and only the region heads of the top-k places are evaluated.
+        :returns: A list of dicts containing the target information, the confidence and the `regions` list,
+            which contains the region information and the confidence within the place.
+        '''
+        with torch.inference_mode():
+            logits, regions = self.model.forward_hierarchical(self.preprocess(img), k)
+        result = self.topk(logits, k)
+        for target in result:
+            idx = target['index']
+            views = [r[idx] for r in regions if idx in r]
+            target['regions'] = []
+            if not views or not self.regions:
+                continue
+            confs = torch.softmax(torch.stack(views).mean(dim=0), dim=0)
+            values, indices = torch.topk(confs, k=min(region_k, confs.numel()))
+            for conf, j in zip(values.tolist(), indices.tolist()):
+                region = dict(self.regions[str(idx)][str(j)])
+                region['index'] = j
+                region['confidence'] = conf
+                target['regions'].append(region)
+        return result
+
+
+class _OnnxModel():
+
+    def __init__(self, path:str):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("ONNX inference requires onnxruntime, install it by: pip install onnxruntime")
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch:torch.Tensor):
+        return torch.from_numpy(self.session.run(None, {self.input_name: batch.numpy()})[0])
+
+
+class _InferenceRequest():
+
+    def __init__(self, views:torch.Tensor, k:int):
+        self.views = views
+        self.k = k
+        self.future = Future()
+
+
+class TuxunInferenceServer():
+    '''Tuxun Inference Server, which micro-batches the crops of many pending games into a single forward pass.'''
+
+    def __init__(self, predictor:TuxunPredictor, max_batch_size:int=32, max_wait:float=5):
+        '''
+        Initialize a TuxunInferenceServer instance.
+        :param predictor: TuxunPredictor object.
+        :param max_batch_size: The maximum number of crops in a batch.
+        :param max_wait: The maximum time(ms) to wait for more requests after the first one arrives.
+        '''
+        self.predictor = predictor
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait
+        self.__queue = queue.Queue()
+        self.__thread = None
+        self.__running = False
+
+    def start(self):
+        '''Start the batching worker thread.'''
+        if self.__thread and self.__thread.is_alive():
+            return self
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__work, name='TuxunInferenceServer', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the batching worker thread, the pending requests will be finished first.'''
+        self.__running = False
+        self.__queue.put(None)
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def submit(self, img:Image.Image, k:int=5):
+        '''
+        Submit a street view image to the queue.
+        :returns: Future object whose result is the same as `TuxunPredictor.predict`.
+        '''
+        req = _InferenceRequest(self.predictor.preprocess(img), k)
+        self.__queue.put(req)
+        Metrics.set_gauge('queue_depth', self.__queue.qsize(), queue='inference')
+        return req.future
+
+    def predict(self, img:Image.Image, k:int=5, timeout:float=None):
+        '''Submit a street view image and wait for the result.'''
+        return self.submit(img, k).result(timeout)
+
+    def qsize(self):
+        ''':returns: The approximate number of pending requests.'''
+        return self.__queue.qsize()
+
+    def __collect(self):
+        first = self.__queue.get()
+        if first is None:
+            return []
+        batch, size = [first], len(first.views)
+        deadline = time.perf_counter() + self.max_wait / 1000
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                req = self.__queue.get(timeout=remaining) if remaining > 0 else self.__queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:
+                self.__queue.put(None)
+                break
+            batch.append(req)
+            size += len(req.views)
+        return batch
+
+    def __work(self):
+        while self.__running or not self.__queue.empty():
+            batch = self.__collect()
+            if not batch:
+                continue
+            try:
+                logits = self.predictor.forward(torch.cat([req.views for req in batch]))
+                start = 0
+                for req in batch:
+                    end = start + len(req.views)
+                    req.future.set_result(self.predictor.topk(logits[start:end], req.k))
+                    start = end
+            except Exception as e:
+                for req in batch:
+                    if not req.future.done():
+                        req.future.set_exception(e)
+
+
+class _InferenceHTTPHandler(BaseHTTPRequestHandler):
+
+    server_version = 'TuxunInference/0.3'
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            return self.__reply(404, {'success': False, 'errorCode': 'not_found'})
+        try:
+            k = int(parse_qs(url.query).get('k', ['5'])[0])
+            length = int(self.headers.get('Content-Length', 0))
+            img = Image.open(BytesIO(self.rfile.read(length)))
+            data = self.server.inference.predict(img, k)
+            self.__reply(200, {'success': True, 'data': data})
+        except Exception as e:
+            self.__reply(400, {'success': False, 'errorCode': str(e)})
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            return self.__reply(200, {'success': True, 'data': {'pending': self.server.inference.qsize()}})
+        self.__reply(404, {'success': False, 'errorCode': 'not_found'})
+
+    def log_message(self, format, *args):
+        pass
+
+    def __reply(self, code:int, obj:dict):
+        body = json.dumps(obj, ensure_ascii=False).encode('UTF-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_http_server(inference:TuxunInferenceServer, host:str='127.0.0.1', port:int=8730):
+    '''
+    Create a local HTTP front-end of the inference server.
+    `POST /predict?k=5` with the image bytes as body returns the top-k places as JSON.
+    :returns: ThreadingHTTPServer object, call `serve_forever` to run it.
+    '''
+    httpd = ThreadingHTTPServer((host, port), _InferenceHTTPHandler)
+    httpd.inference = inference
+    return httpd
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Tuxun-AI batched inference server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8730)
+    parser.add_argument('--model', default=os.path.join('models', 'v0.3.0.pth'))
+    parser.add_argument('--mapping', default=os.path.join('models', 'mapping.json'))
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait', type=float, default=5, help='max wait time(ms) per batch')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 for default')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    inference = TuxunInferenceServer(TuxunPredictor.load(args.model, args.mapping), args.max_batch_size, args.max_wait).start()
+    httpd = make_http_server(inference, args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port}/predict")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        inference.stop()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import json
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+class TuxunInferenceClient():
+    '''Tuxun Inference Client, which asks a resident inference server (see `Inference.py`) for predictions.
+    It only depends on the standard library so that importing it costs nothing.'''
+
+    def __init__(self, host:str='127.0.0.1', port:int=8730, timeout:float=30):
+        self.url = f"http://{host}:{port}"
+        self.timeout = timeout
+
+    def ping(self, timeout:float=0.2):
+        ''':returns: True if the server is ready.'''
+        try:
+            with urlopen(self.url + '/health', timeout=timeout) as r:
+                return json.loads(r.read())['success']
+        except Exception:
+            return False
+
+    def predict(self, img, k:int=5):
+        '''
+        Predict the target places of a single street view image.
+        :param img: The encoded image bytes, or Image object which will be encoded as JPEG.
+        :returns: A list of dicts containing the target information and the confidence.
+        '''
+        if not isinstance(img, bytes):
+            buf = BytesIO()
+            img.convert('RGB').save(buf, format='JPEG', quality=95)
+            img = buf.getvalue()
+        req = Request(f"{self.url}/predict?k={k}", data=img, method='POST',
+            headers={'Content-Type': 'application/octet-stream'})
+        try:
+            with urlopen(req, timeout=self.timeout) as r:
+                resp = json.loads(r.read().decode('UTF-8'))
+        except HTTPError as e:
+            resp = json.loads(e.read().decode('UTF-8'))
+        if not resp['success']:
+            raise RuntimeError(f"Inference failed, reason: {resp['errorCode']}")
+        return resp['data']
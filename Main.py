@@ -1,21 +1,108 @@
-import os, json
-import torch
-from Dataset import *
-from Model import *
-from TuxunAgent import *
+import os, time
+from concurrent.futures import ThreadPoolExecutor
+from InferenceClient import TuxunInferenceClient
+
+
+class StartupTimer():
+    '''Startup Timer, which records the elapsed time of each startup phase.'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    def mark(self, name:str, since:float=None):
+        now = time.perf_counter()
+        self.phases.append((name, now - (since if since is not None else self.start)))
+        return now
+
+    def __str__(self):
+        return "  ".join(f"{name} {round(t * 1000)}ms" for name, t in self.phases)
+
+
+model_prefixes = {'teacher': "v0.3.0", 'student': "student"}
+'''The file name prefix of each model choice, the student is distilled by Distill.py.'''
+model_artifacts = {'int8': ".int8.pt", 'dynamic': ".dynamic.pt", 'fp32': ".fp32.pt", 'eager': ".pth"}
+'''The file name suffix of each artifact exported by Export.py, in the order of preference.'''
+
+def load_predictor(mapping_path:str, timer:StartupTimer, tta:str=None, model:str=None, regions_path:str=None, artifact:str=None):
+    '''
+    Connect to the resident inference server if it is running, otherwise load the chosen model in this process.
+    The server is skipped if the model, the artifact, the TTA policy or the region heads are chosen, since it serves its own.
+    :param artifact: The key of `model_artifacts`, `None` for the first existing one.
+    :returns: Tuple (predictor, description of the loaded model).
+    '''
+    t = time.perf_counter()
+    client = TuxunInferenceClient()
+    if not (tta or model or regions_path or artifact) and client.ping():
+        timer.mark("模型(常驻进程)", t)
+        return client, "常驻推理进程 " + client.url
+    from Inference import TuxunPredictor
+    t = timer.mark("导入torch", t)
+    prefix = model_prefixes[model or 'teacher']
+    if artifact:
+        model_path, reason = os.path.join("models", prefix + model_artifacts[artifact]), "指定"
+    elif regions_path:
+        # 区域分类头只能载入到原始权重中
+        model_path, reason = os.path.join("models", prefix + model_artifacts['eager']), "区域分类头需要原始权重"
+    else:
+        # 优先使用 Export.py 导出的模型文件
+        model_path = next((os.path.join("models", prefix + i) for i in model_artifacts.values()
+            if os.path.isfile(os.path.join("models", prefix + i))), os.path.join("models", prefix + model_artifacts['eager']))
+        reason = "自动选择已导出的最快版本，可用 --artifact 指定"
+    predictor = TuxunPredictor.load(model_path, mapping_path, regions_path)
+    if tta:
+        from Inference import TTAPolicy
+        predictor.policy = TTAPolicy.parse(tta)
+    timer.mark("加载模型", t)
+    return predictor, f"{os.path.basename(model_path)}（{reason}）"
 
 
 if __name__ == '__main__':
+    import argparse
+    timer = StartupTimer()
+    parser = argparse.ArgumentParser(description='Tuxun-AI')
+    parser.add_argument('--tta', default=None, help='test-time augmentation policy, e.g. "left,right,center;exit=0.6;agg=probs", '
+        'the resident inference server is not used if set')
+    parser.add_argument('--model', choices=list(model_prefixes.keys()), default=os.environ.get('TUXUN_MODEL'),
+        help='the full model(teacher, default), or the faster distilled student, can also be set by the TUXUN_MODEL environment variable, '
+        'the resident inference server is not used if set')
+    parser.add_argument('--artifact', choices=list(model_artifacts.keys()), default=None,
+        help='the exported version of the model to load, the first existing one in the order of the choices if not set')
+    parser.add_argument('--regions', default=None, help='regions file of the region heads saved by Train.py, e.g. models/regions.json')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve the Prometheus metrics on this port, 0 to disable')
+    parser.add_argument('--metrics-log', default=None, help='JSON Lines file to append the metrics to every minute')
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    # 运行指标，默认关闭
+    if args.metrics_port or args.metrics_log:
+        import Metrics
+        if args.metrics_port:
+            Metrics.serve_prometheus(port=args.metrics_port)
+        if args.metrics_log:
+            Metrics.JsonLogSink(args.metrics_log)
+
+    # 在后台载入模型，同时进行凭据验证
+    mapping_path = os.path.join("models", "mapping.json")
+    loader = ThreadPoolExecutor(max_workers=1)
+    predictor_future = loader.submit(load_predictor, mapping_path, timer, args.tta, args.model, args.regions, args.artifact)
+
     # 凭据验证
-    os.chdir(os.path.dirname(__file__))
+    t = time.perf_counter()
+    from TuxunAgent import TuxunAgent, TuxunGame, StreetView, StreetViewException
+    from Cache import DiskCache
+    t = timer.mark("导入网络模块", t)
     cookie_path = "cookie.txt"
     if not os.path.isfile(cookie_path):
         open(cookie_path, 'x').close()
     
-    agent = TuxunAgent()
+    cache = DiskCache("cache")
+    StreetView.cache = cache
+    agent = TuxunAgent(cache)
     cookie = open(cookie_path, 'r').read().replace('\n', '').replace('\r', '')
     agent.set_cookie(cookie)
     uid = agent.get_user_id()
+    timer.mark("登录", t)
     if type(uid) != str:
         print("无法登录图寻。可能未设置有效的用户凭据 Cookie 或无法访问图寻服务器。")
         print("  请参考说明文档进行凭据配置：https://github.com/isHarryh/Tuxun-AI#readme")
@@ -25,14 +112,18 @@ if __name__ == '__main__':
     print(f"当前用户：UID {uid}")
 
     # 载入模型
-    print("正在加载模型...")
-    mapping_path = os.path.join("models", "mapping.json")
-    model_path = os.path.join("models", "v0.3.0.pth")
-    mapping = json.load(open(mapping_path, 'r', encoding='UTF-8'))
-    model = TuxunAIModelV0(classifier=TuxunAIModelV0.get_classifier(len(mapping)))
-    model.load_state_dict(torch.load(model_path, map_location='cpu'))
-    model = model.to('cpu')
-    model.eval()
+    if not predictor_future.done():
+        print("正在加载模型...")
+    predictor, model_name = predictor_future.result()
+    loader.shutdown()
+    # 本地模型可给出全部概率，用于计算期望距离最小的猜测点
+    engine = None
+    if hasattr(predictor, 'predict_probs'):
+        from Guess import TuxunGuessEngine
+        engine = TuxunGuessEngine.load(mapping_path)
+    timer.mark("启动完成")
+    print(f"已加载模型：{model_name}")
+    print(f"启动耗时：{timer}")
 
     while True:
         try:
@@ -53,36 +144,30 @@ if __name__ == '__main__':
                 print("  错误：不支持的街景类型")
                 continue
 
-            img = sv.get_image()
-            try:
-                img = img.convert('RGB')
-            except:
+            img = sv.get_image_bytes()
+            if type(img) != bytes:
                 print("  错误：获取街景失败")
                 print(img)
                 continue
 
             # 输入模型
             print("  正在分析...")
-            outputs = None
-            for method in StreetViewImageDataset.enhance_methods:
-                image = img.copy()
-                image = StreetViewImageDataset.trim_image_bottom_blank(image)
-                image = method(image)
-                image = StreetViewImageDataset.transform(image)
-                image = torch.autograd.Variable(image, requires_grad=True)
-                image = image.unsqueeze(0)
-                outputs = outputs + model(image) if outputs != None else model(image)
-
-            k = 5
-            topk_predicted = torch.topk(outputs.data, k=k, dim=1)[1].numpy().tolist()[0]
-            confs = torch.nn.functional.softmax(outputs, dim=1).detach().numpy().tolist()[0]
-
-            for idx, top in zip(topk_predicted, range(k)):
-                target = mapping[str(idx)]
-                conf = round(confs[idx] * 100)
+            if engine:
+                probs = predictor.predict_probs(img)
+                targets = [dict(predictor.mapping[str(i)], confidence=float(probs[i])) for i in probs.argsort()[::-1][:5]]
+            else:
+                targets = predictor.predict(img, k=5)
+            for top, target in enumerate(targets):
+                conf = round(target['confidence'] * 100)
                 # 输出预测
                 conf_str= "<1%" if conf < 1 else f"{conf}%"
                 print(f"  TOP {top+1}: {target['name']}\t置信 {conf_str}\t经纬 ({round(target['lng'])}°,{round(target['lat'])}°)")
+            if getattr(predictor, 'regions', None):
+                for region in predictor.predict_regions(img, k=1)[0]['regions']:
+                    print(f"    区域 {region['name']}\t置信 {round(region['confidence'] * 100)}%\t经纬 ({round(region['lng'])}°,{round(region['lat'])}°)")
+            if engine:
+                best = engine.guess_one(probs)
+                print(f"  最优猜测：经纬 ({best['lng']:.2f}°,{best['lat']:.2f}°)\t期望距离 {round(best['expected_distance'])}km")
 
         except Exception as arg:
             print(f"错误：{arg}")
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import json, time, threading, bisect, functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Histogram():
+    '''Histogram of latencies(s) in fixed cumulative buckets.'''
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        '''The number of observations in each bucket, the last one is above all the bounds.'''
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q:float):
+        ''':returns: The upper bound of the bucket containing the quantile, `inf` if above all the bounds.'''
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank and seen > 0:
+                return bound
+        return 0.0
+
+
+class MetricsRegistry():
+    '''Metrics Registry, the in-process store of the counters, the gauges and the latency histograms, each keyed by name and labels.'''
+
+    def __init__(self):
+        self.counters:dict = {}
+        self.gauges:dict = {}
+        self.histograms:dict = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, name:str, value:float=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name:str, value:float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name:str, seconds:float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        '''
+        :returns: A dict containing the counters, the gauges and the histogram summaries(count, sum, p50, p99),
+            each keyed by the metric name followed by the labels, e.g. `api_requests_total{endpoint="get"}`.
+        '''
+        with self.__lock:
+            return {
+                'time': time.time(),
+                'counters': {_format_key(k): v for k, v in self.counters.items()},
+                'gauges': {_format_key(k): v for k, v in self.gauges.items()},
+                'histograms': {_format_key(k): {'count': h.count, 'sum': h.sum, 'p50': h.quantile(0.5), 'p99': h.quantile(0.99)}
+                    for k, h in self.histograms.items()}
+            }
+
+    def to_prometheus(self):
+        ''':returns: The metrics in the Prometheus text exposition format.'''
+        lines = []
+        with self.__lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items(), key=lambda i: i[0]):
+                seen = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    seen += n
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {seen}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {h.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels:tuple):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+def _format_key(key:tuple):
+    return key[0] + _format_labels(key[1])
+
+
+registry:MetricsRegistry = None
+'''The global registry, `None` if the metrics are disabled, in which case every recording function returns at once.'''
+
+def enable():
+    '''
+    Enable the metrics, does nothing if already enabled.
+    :returns: The global MetricsRegistry object.
+    '''
+    global registry
+    if registry is None:
+        registry = MetricsRegistry()
+    return registry
+
+def disable():
+    global registry
+    registry = None
+
+def inc(name:str, value:float=1, **labels):
+    if registry is not None:
+        registry.inc(name, value, **labels)
+
+def set_gauge(name:str, value:float, **labels):
+    if registry is not None:
+        registry.set_gauge(name, value, **labels)
+
+def observe(name:str, seconds:float, **labels):
+    if registry is not None:
+        registry.observe(name, seconds, **labels)
+
+
+class _Timer():
+
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name:str, labels:dict):
+        self.name, self.labels = name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if registry is not None:
+            registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class _NullTimer():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+_null_timer = _NullTimer()
+
+def timer(name:str, **labels):
+    '''
+    Time a block of code into the histogram: `with Metrics.timer('model_forward_seconds'): ...`
+    :returns: A context manager, a shared no-op one if the metrics are disabled.
+    '''
+    return _null_timer if registry is None else _Timer(name, labels)
+
+def instrumented(endpoint:str):
+    '''
+    Decorate a method which returns an Exception object on failure instead of raising,
+    to count its calls by result and to time it in `api_request_seconds`.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if registry is None:
+                return func(*args, **kwargs)
+            t = time.perf_counter()
+            result = func(*args, **kwargs)
+            registry.observe('api_request_seconds', time.perf_counter() - t, endpoint=endpoint)
+            registry.inc('api_requests_total', endpoint=endpoint, result='error' if isinstance(result, Exception) else 'ok')
+            return result
+        return wrapper
+    return decorator
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics' or registry is None:
+            self.send_error(404)
+            return
+        body = registry.to_prometheus().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_prometheus(host:str='127.0.0.1', port:int=9731):
+    '''
+    Enable the metrics and serve them at `/metrics` in the Prometheus text format, in a daemon thread.
+    :returns: ThreadingHTTPServer object.
+    '''
+    enable()
+    httpd = ThreadingHTTPServer((host, port), _PrometheusHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+class JsonLogSink():
+    '''JSON Log Sink, which appends a snapshot of the metrics to a JSON Lines file periodically.'''
+
+    def __init__(self, path:str, interval:float=60):
+        '''
+        Enable the metrics and start writing in a daemon thread.
+        :param interval: The interval(s) between two snapshots.
+        '''
+        self.path = path
+        self.interval = interval
+        self.__stop = threading.Event()
+        enable()
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def flush(self):
+        '''Append a snapshot now.'''
+        if registry is not None:
+            with open(self.path, 'a', encoding='UTF-8') as f:
+                f.write(json.dumps(registry.snapshot(), ensure_ascii=False) + '\n')
+
+    def stop(self):
+        self.__stop.set()
+        self.flush()
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.flush()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2023, Harry Huang
 # @ BSD 3-Clause License
+import os
 import torch
 import torch.nn as nn
 import torchvision.models as models
@@ -9,25 +10,108 @@ import torchvision.models as models
 class TuxunAIModelV0(nn.Module):
     '''The classification model for the game Tuxun, aka Geo Guesser.'''
 
+    num_features = 960
+    '''The dimension of the pooled backbone features.'''
+
     def __init__(
             self,
             features:nn.Sequential=None,
             avgpool:nn.AdaptiveAvgPool2d=None,
-            classifier:nn.Sequential=None
+            classifier:nn.Sequential=None,
+            region_heads:nn.ModuleDict=None
         ):
         super().__init__()
-        model = models.mobilenet_v3_large()
+        model = self.get_backbone() if not (features and avgpool and classifier) else None
         self.features   = features   if features   else model.features
         self.avgpool    = avgpool    if avgpool    else model.avgpool
         self.classifier = classifier if classifier else model.classifier
+        self.region_heads = region_heads if region_heads else nn.ModuleDict()
+        '''The region classifiers of the countries, keyed by the country index(string).'''
     
     def forward(self, x):
+        x = self.forward_features(x)
+        x = self.classifier(x)
+        return x
+
+    def forward_features(self, x):
+        '''
+        Run the backbone only.
+        :returns: The pooled feature tensor of shape (N, num_features).
+        '''
         x = self.features(x)
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
-        x = self.classifier(x)
         return x
 
+    def forward_hierarchical(self, x, k:int=1):
+        '''
+        Run the backbone once, then the country classifier,
+        and only the region heads of the top-k countries of each sample.
+        :param k: The number of the top countries whose regions are evaluated.
+        :returns: Tuple (country_logits, regions), regions is a list containing a dict
+            mapping each top country index to its region logits for each sample.
+        '''
+        features = self.forward_features(x)
+        logits = self.classifier(features)
+        top = logits.topk(min(k, logits.shape[1]), dim=1).indices
+        regions = [{} for _ in range(len(x))]
+        for country in top.unique().tolist():
+            head = self.region_heads[str(country)] if str(country) in self.region_heads else None
+            if head is None:
+                continue
+            rows = (top == country).any(dim=1).nonzero(as_tuple=True)[0]
+            for row, region_logits in zip(rows.tolist(), head(features[rows])):
+                regions[row][country] = region_logits
+        return logits, regions
+
+    def set_region_heads(self, num_regions:dict):
+        '''
+        Create the region heads.
+        :param num_regions: The dict mapping each country index to its number of regions, countries with less than 2 regions are skipped.
+        '''
+        self.region_heads = nn.ModuleDict({str(c): self.get_region_head(n) for c, n in num_regions.items() if n >= 2})
+
+    def get_main_state_dict(self):
+        ''':returns: The state dict without the region heads, which are saved separately by `get_region_heads_path`.'''
+        return self.strip_region_heads(self.state_dict())
+
+    @staticmethod
+    def strip_region_heads(state_dict:dict):
+        ''':returns: The state dict without the keys of the region heads.'''
+        return {k: v for k, v in state_dict.items() if not k.startswith('region_heads.')}
+
+    @staticmethod
+    def get_region_heads_path(regions_path:str):
+        ''':returns: The path of the region heads weights beside the given regions file, e.g. `regions.json` -> `regions.pth`.'''
+        return os.path.splitext(regions_path)[0] + '.pth'
+
+    @staticmethod
+    def get_backbone():
+        ''':returns: The torchvision model whose features and avgpool are used as the backbone.'''
+        return models.mobilenet_v3_large()
+
+    @staticmethod
+    def get_model_class(state_dict:dict):
+        ''':returns: The model class whose classifier input matches the given state dict, TuxunAIModelV0 or TuxunAIStudentModel.'''
+        weight = state_dict.get('classifier.0.weight')
+        if weight is not None and weight.shape[1] == TuxunAIStudentModel.num_features:
+            return TuxunAIStudentModel
+        return TuxunAIModelV0
+
+    @classmethod
+    def get_region_head(cls, num_regions:int):
+        '''
+        Get the prefab region head sequential over the features of this model class, which is much cheaper than the country classifier.
+        :param num_regions: The number of regions in the output layer.
+        :returns: The sequential object.
+        '''
+        return nn.Sequential(
+            nn.Linear(cls.num_features, 128),
+            nn.Hardswish(),
+            nn.Dropout(0.2),
+            nn.Linear(128, num_regions)
+        )
+
     @staticmethod
     def get_classifier(num_classes:int):
         '''
@@ -51,6 +135,33 @@ class TuxunAIModelV0(nn.Module):
     def freeze_classifier_params(self, freeze:bool=True):
         self._freeze_params(self.classifier, freeze)
 
+    def freeze_region_heads_params(self, freeze:bool=True):
+        self._freeze_params(self.region_heads, freeze)
+
     def _freeze_params(self, module:nn.Module, freeze:bool):
         for p in module.parameters():
-            p.requires_grad = bool(freeze)
+            p.requires_grad = not freeze
+
+
+class TuxunAIStudentModel(TuxunAIModelV0):
+    '''The student model distilled from TuxunAIModelV0, with the mobilenet_v3_small backbone and a reduced-width head.'''
+
+    num_features = 576
+
+    @staticmethod
+    def get_backbone():
+        return models.mobilenet_v3_small()
+
+    @staticmethod
+    def get_classifier(num_classes:int):
+        '''
+        Get the prefab classifier sequential of the student.
+        :param num_classes: The number of classes in the output layer.
+        :returns: The sequential object.
+        '''
+        return nn.Sequential(
+            nn.Linear(576, 512),
+            nn.Hardswish(),
+            nn.Dropout(0.2),
+            nn.Linear(512, num_classes)
+        )
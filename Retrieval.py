@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, json, math
+import numpy as np
+
+
+def _normalize(x:np.ndarray):
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norm, 1e-12)
+
+def _kmeans(x:np.ndarray, k:int, iters:int=10, seed:int=0):
+    # Spherical k-means, the centroids are kept on the unit sphere
+    rnd = np.random.default_rng(seed)
+    centroids = x[rnd.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        nonempty = counts > 0
+        sums[nonempty] = np.add.reduceat(x[order], starts[nonempty], axis=0)
+        empty = counts == 0
+        sums[empty] = x[rnd.choice(len(x), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids.astype(np.float32)
+
+
+class TuxunRetrievalIndex():
+    '''Tuxun Retrieval Index, an inverted-file index of float16 feature vectors with their coordinates, memory-mapped from disk.'''
+
+    vectors_file = 'vectors.npy'
+    coords_file = 'coords.npy'
+    centroids_file = 'centroids.npy'
+    offsets_file = 'offsets.npy'
+    keys_file = 'keys.json'
+
+    def __init__(self, root:str):
+        '''
+        Open an index directory built by `TuxunRetrievalIndex.build`.
+        The vectors are memory-mapped, only the probed lists are paged in.
+        '''
+        self.root = root
+        self.vectors = np.load(os.path.join(root, self.vectors_file), mmap_mode='r')
+        '''The float16 array of shape (N, D), grouped by list.'''
+        self.coords = np.load(os.path.join(root, self.coords_file), mmap_mode='r')
+        '''The float32 array of shape (N, 2) of lng and lat.'''
+        self.centroids = np.load(os.path.join(root, self.centroids_file))
+        self.offsets = np.load(os.path.join(root, self.offsets_file))
+        self.keys:list = json.load(open(os.path.join(root, self.keys_file), 'r', encoding='UTF-8'))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, root:str, features, coords, keys:list, num_lists:int=None, train_size:int=65536, chunk_size:int=65536, seed:int=0):
+        '''
+        Build an index directory.
+        :param features: Array-like of shape (N, D), which can be a memory-mapped array larger than RAM.
+        :param coords: Array-like of shape (N, 2) of lng and lat.
+        :param keys: The list of the N keys.
+        :param num_lists: The number of inverted lists, `None` for about 4*sqrt(N).
+        :returns: TuxunRetrievalIndex object.
+        '''
+        os.makedirs(root, exist_ok=True)
+        coords = np.asarray(coords, dtype=np.float32)
+        n, dim = len(keys), features.shape[1]
+        num_lists = max(1, min(n, num_lists or int(4 * math.sqrt(n))))
+        rnd = np.random.default_rng(seed)
+        sample = np.sort(rnd.choice(n, size=min(n, train_size), replace=False))
+        centroids = _kmeans(_normalize(np.asarray(features[sample], dtype=np.float32)), num_lists, seed=seed)
+
+        assign = np.empty((n,), dtype=np.int64)
+        for start in range(0, n, chunk_size):
+            x = _normalize(np.asarray(features[start:start + chunk_size], dtype=np.float32))
+            assign[start:start + chunk_size] = np.argmax(x @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=num_lists))]).astype(np.int64)
+
+        vectors = np.lib.format.open_memmap(os.path.join(root, cls.vectors_file), mode='w+', dtype=np.float16, shape=(n, dim))
+        sorted_coords = np.empty((n, 2), dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            idx = order[start:start + chunk_size]
+            # Gather in ascending order to keep the reads of a memory-mapped source sequential
+            rank = np.argsort(idx)
+            gathered = np.empty((len(idx), dim), dtype=np.float32)
+            gathered[rank] = _normalize(np.asarray(features[idx[rank]], dtype=np.float32))
+            vectors[start:start + len(idx)] = gathered.astype(np.float16)
+            sorted_coords[start:start + len(idx)] = coords[idx]
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(root, cls.coords_file), sorted_coords)
+        np.save(os.path.join(root, cls.centroids_file), centroids)
+        np.save(os.path.join(root, cls.offsets_file), offsets)
+        with open(os.path.join(root, cls.keys_file), 'w', encoding='UTF-8') as f:
+            json.dump([keys[i] for i in order.tolist()], f, ensure_ascii=False)
+        return cls(root)
+
+    def search(self, queries:np.ndarray, k:int=10, nprobe:int=8):
+        '''
+        Find the nearest vectors by cosine similarity.
+        :param queries: Array of shape (Q, D).
+        :param nprobe: The number of inverted lists to scan for each query.
+        :returns: Tuple (indices, similarities), both of shape (Q, k), the missing entries are -1 and -inf.
+        '''
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, lists in enumerate(probes):
+            ranges = [(self.offsets[l], self.offsets[l + 1]) for l in lists if self.offsets[l + 1] > self.offsets[l]]
+            if not ranges:
+                continue
+            # Every list is a contiguous slice, so the scan reads the memory-mapped file sequentially
+            candidates = np.concatenate([np.arange(a, b) for a, b in ranges])
+            scores = np.concatenate([np.asarray(self.vectors[a:b], dtype=np.float32) @ queries[q] for a, b in ranges])
+            top = min(k, len(scores))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            indices[q, :top] = candidates[best]
+            sims[q, :top] = scores[best]
+        return indices, sims
+
+    def query(self, vector:np.ndarray, k:int=10, nprobe:int=8, temperature:float=0.05):
+        '''
+        Find the k nearest training panos of a feature vector, and estimate its coordinate.
+        The estimate is the softmax(similarity / temperature)-weighted mean of the neighbours on the unit sphere.
+        :returns: Tuple (neighbours, estimate), neighbours is a list of dicts of key, lng, lat and similarity, estimate is a dict of lng and lat.
+        '''
+        indices, sims = self.search(vector, k, nprobe)
+        valid = indices[0] >= 0
+        indices, sims = indices[0][valid], sims[0][valid]
+        if not len(indices):
+            return [], None
+        coords = np.asarray(self.coords[indices], dtype=np.float64)
+        neighbours = [{'key': self.keys[i], 'lng': float(c[0]), 'lat': float(c[1]), 'similarity': float(s)}
+            for i, c, s in zip(indices.tolist(), coords, sims)]
+        weights = np.exp((sims - sims.max()) / temperature)
+        lng, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+        xyz = np.stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)], axis=1)
+        x, y, z = (weights[:, None] * xyz).sum(axis=0)
+        estimate = {
+            'lng': round(math.degrees(math.atan2(y, x)), 5),
+            'lat': round(math.degrees(math.atan2(z, math.hypot(x, y))), 5)
+        }
+        return neighbours, estimate
+
+
+class _ViewsDataset():
+    # Yields all the views of each sample at once, so that a sample is embedded the same way as `TuxunPredictor.embed`
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        import torch
+        num_samples = len(self.dataset.keys)
+        return torch.stack([self.dataset[view * num_samples + index][0] for view in range(len(self.dataset.views))])
+
+    def __len__(self):
+        return len(self.dataset.keys)
+
+
+if __name__ == '__main__':
+    import argparse, time
+    import torch
+    from torch.utils.data import DataLoader
+    from Dataset import StreetViewDataset, StreetViewImageDataset
+    from Inference import TuxunPredictor, TTAPolicy
+    parser = argparse.ArgumentParser(description='Tuxun-AI feature retrieval index')
+    parser.add_argument('index', help='index directory')
+    parser.add_argument('--build', default=None, help='JSON file of the street view data to build the index from')
+    parser.add_argument('--images', default='images')
+    parser.add_argument('--query', default=None, help='image file to query')
+    parser.add_argument('--model', default=os.path.join('models', 'v0.3.0.pth'))
+    parser.add_argument('--mapping', default=os.path.join('models', 'mapping.json'))
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--tta', default=None, help='views to embed and average for both building and querying, e.g. "left,right,center"')
+    args = parser.parse_args()
+
+    predictor = TuxunPredictor.load(args.model, args.mapping)
+    if args.tta:
+        predictor.policy = TTAPolicy.parse(args.tta)
+    if args.build:
+        # The index vectors are the mean over the same views as the queries
+        views = [TTAPolicy.view_methods[v] for v in predictor.policy.views]
+        dataset = StreetViewImageDataset(args.images, StreetViewDataset(json.load(open(args.build, 'r', encoding='UTF-8'))), views=views)
+        num_samples = len(dataset.keys)
+        loader = DataLoader(_ViewsDataset(dataset), batch_size=args.batch_size)
+        os.makedirs(args.index, exist_ok=True)
+        features_path = os.path.join(args.index, 'features.tmp.npy')
+        features = np.lib.format.open_memmap(features_path, mode='w+', dtype=np.float16,
+            shape=(num_samples, predictor.model.num_features))
+        start = 0
+        with torch.inference_mode():
+            for x in loader:
+                x = predictor.model.forward_features(x.flatten(0, 1)).view(len(x), len(views), -1).mean(dim=1)
+                features[start:start + len(x)] = _normalize(x.numpy()).astype(np.float16)
+                start += len(x)
+        coords = np.array([[dataset.data[k]['lng'], dataset.data[k]['lat']] for k in dataset.keys], dtype=np.float32)
+        TuxunRetrievalIndex.build(args.index, features, coords, list(dataset.keys))
+        del features
+        os.remove(features_path)
+    if args.query:
+        from PIL import Image
+        index = TuxunRetrievalIndex(args.index)
+        vector = predictor.embed(Image.open(args.query))
+        t = time.perf_counter()
+        neighbours, estimate = index.query(vector, args.k, args.nprobe)
+        elapsed = time.perf_counter() - t
+        for n in neighbours:
+            print(f"  {n['key']}\t({n['lng']:.4f}, {n['lat']:.4f})\tsim {n['similarity']:.4f}")
+        print(f"Estimate: {estimate} in {elapsed * 1000:.2f}ms over {len(index)} vectors")
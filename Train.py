@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2023, Harry Huang
+# @ BSD 3-Clause License
+import os, json, time
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.utils.data import DataLoader, TensorDataset, Subset, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
+from Dataset import StreetViewDataset, StreetViewImageDataset, StreetViewImageSampleDataset, StreetViewCachedImageDataset, StreetViewShardDataset, StreetViewTensorAugment
+from Model import TuxunAIModelV0
+
+
+def load_image_dataset(data_path:str, root:str, mapping_path:str=None, sample_mode:bool=False):
+    '''
+    Load the image dataset.
+    :param data_path: The JSON file of the dict that `StreetViewDataset` expects, a tensor cache directory or a shard directory.
+    :param root: The directory of the images, ignored if `data_path` is a directory.
+    :param mapping_path: The mapping file whose targets are used as the classes, `None` to derive them from the data.
+    :param sample_mode: Whether to yield uint8 sample tensors for `StreetViewTensorAugment` instead of the views.
+    :returns: StreetViewImageDataset, StreetViewImageSampleDataset, StreetViewCachedImageDataset or StreetViewShardDataset object.
+    '''
+    targets = None
+    if mapping_path:
+        targets = {int(k): v for k, v in json.load(open(mapping_path, 'r', encoding='UTF-8')).items()}
+    if os.path.isdir(data_path):
+        if os.path.isfile(os.path.join(data_path, StreetViewCachedImageDataset.images_file)):
+            return StreetViewCachedImageDataset(data_path)
+        return StreetViewShardDataset(data_path, targets)
+    data = json.load(open(data_path, 'r', encoding='UTF-8'))
+    dataset_class = StreetViewImageSampleDataset if sample_mode else StreetViewImageDataset
+    return dataset_class(root, StreetViewDataset(data, targets))
+
+def split_dataset(dataset, val_ratio:float, seed:int=0):
+    '''
+    Split the dataset into the training set and the validation set by samples,
+    so that the views of a sample never appear in both sets.
+    :returns: Tuple (train_subset, val_subset).
+    '''
+    num_samples = len(dataset.keys)
+    views = len(dataset) // max(1, num_samples)
+    order = torch.randperm(num_samples, generator=torch.Generator().manual_seed(seed)).tolist()
+    num_val = int(num_samples * val_ratio)
+    val_samples, train_samples = order[:num_val], order[num_val:]
+    expand = lambda samples: [s + v * num_samples for s in samples for v in range(views)]
+    return Subset(dataset, expand(train_samples)), Subset(dataset, expand(val_samples))
+
+def make_loader(dataset, batch_size:int, shuffle:bool, workers:int=0, prefetch:int=2, collate_fn=None, distributed:bool=False):
+    '''
+    Make a DataLoader, whose workers are kept alive across epochs. The iterable datasets shuffle by themselves.
+    :param distributed: Whether to load only the shard of this rank by a DistributedSampler, call `loader.sampler.set_epoch` every epoch.
+    '''
+    kwargs = {'collate_fn': collate_fn} if collate_fn else {}
+    iterable = isinstance(dataset, IterableDataset)
+    if distributed and not iterable:
+        kwargs['sampler'] = DistributedSampler(dataset, shuffle=shuffle)
+    shuffle = shuffle and not iterable and not distributed
+    if workers > 0:
+        # The persistent workers would keep the epoch of their own dataset copies
+        kwargs['persistent_workers'] = not iterable
+        kwargs['prefetch_factor'] = prefetch
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=workers,
+        pin_memory=torch.cuda.is_available(), **kwargs)
+
+def accuracy(logits:torch.Tensor, labels:torch.Tensor, topk=(1, 5)):
+    ''':returns: The list of the numbers of correct predictions for each k.'''
+    maxk = min(max(topk), logits.shape[1])
+    pred = logits.topk(maxk, dim=1).indices
+    correct = pred.eq(labels.view(-1, 1))
+    return [int(correct[:, :min(k, maxk)].any(dim=1).sum()) for k in topk]
+
+
+class Trainer():
+    '''Trainer of TuxunAIModelV0, supporting the two-phase schedule: classifier only, then the full model.'''
+
+    def __init__(self, model:TuxunAIModelV0, device:str='cpu', channels_last:bool=True, distributed:bool=False):
+        '''
+        Initialize a Trainer instance.
+        :param distributed: Whether to average the gradients and the results over the initialized process group,
+            every rank should be given the loaders of its own shard.
+        '''
+        self.model = model.to(device)
+        self.device = device
+        self.channels_last = channels_last
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        self.criterion = nn.CrossEntropyLoss()
+        self.optimizer = None
+        self.phase = None
+        self.epoch = 0
+        self.best_acc = 0.0
+        self.dropped_batches = 0
+        '''The number of the batches left unused over all the ranks by the last distributed epoch.'''
+        self.distributed = distributed and dist.is_available() and dist.is_initialized()
+        self.broadcast_state()
+
+    def broadcast_state(self):
+        '''Copy the parameters and the buffers of rank 0 to the other ranks, does nothing if not distributed.'''
+        if self.distributed:
+            for t in list(self.model.parameters()) + list(self.model.buffers()):
+                dist.broadcast(t.data, 0)
+
+    def set_phase(self, phase:str, lr:float):
+        '''
+        Set the training phase and reset the optimizer.
+        :param phase: 'classifier' to train the classifier only, or 'full' to train all the layers.
+        :param lr: The learning rate.
+        '''
+        self.model.freeze_features_params(phase == 'classifier')
+        self.model.freeze_avgpool_params(phase == 'classifier')
+        self.model.freeze_classifier_params(False)
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        self.optimizer = torch.optim.Adam(params, lr=lr)
+        self.phase = phase
+
+    def _to_device(self, x:torch.Tensor):
+        x = x.to(self.device, non_blocking=True)
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    @torch.inference_mode()
+    def cache_features(self, loader:DataLoader):
+        '''
+        Run the frozen backbone once over the loader.
+        :returns: TensorDataset of (features, labels).
+        '''
+        self.model.eval()
+        features, labels = [], []
+        for x, y in loader:
+            features.append(self.model.forward_features(self._to_device(x)).cpu())
+            labels.append(y)
+        return TensorDataset(torch.cat(features), torch.cat(labels))
+
+    def train_epoch(self, loader:DataLoader, on_features:bool=False):
+        '''
+        Train one epoch.
+        :param on_features: Whether the loader yields cached features instead of images.
+        :returns: A dict containing the loss and the top-1/top-5 accuracy.
+        '''
+        self.model.train()
+        if self.phase == 'classifier':
+            # The frozen backbone keeps its BatchNorm statistics
+            self.model.features.eval()
+        head = self.model.classifier if on_features else self.model
+        total, loss_sum, correct = 0, 0.0, [0, 0]
+        for x, y in self.__synchronized(loader):
+            x, y = self._to_device(x), y.to(self.device, non_blocking=True)
+            logits = head(x)
+            loss = self.criterion(logits, y)
+            self.optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            if self.distributed:
+                self.__all_reduce_gradients()
+            self.optimizer.step()
+            total += len(y)
+            loss_sum += loss.item() * len(y)
+            correct = [a + b for a, b in zip(correct, accuracy(logits.detach(), y))]
+        self.epoch += 1
+        return self.__summary(total, loss_sum, correct)
+
+    @torch.inference_mode()
+    def evaluate(self, loader:DataLoader, on_features:bool=False):
+        '''
+        Evaluate the model.
+        :returns: A dict containing the loss and the top-1/top-5 accuracy.
+        '''
+        # The BatchNorm statistics of the ranks drift apart, while only the ones of rank 0 are saved
+        if self.distributed and not on_features:
+            for t in self.model.buffers():
+                dist.broadcast(t.data, 0)
+        self.model.eval()
+        head = self.model.classifier if on_features else self.model
+        total, loss_sum, correct = 0, 0.0, [0, 0]
+        for x, y in loader:
+            x, y = self._to_device(x), y.to(self.device, non_blocking=True)
+            logits = head(x)
+            total += len(y)
+            loss_sum += float(self.criterion(logits, y)) * len(y)
+            correct = [a + b for a, b in zip(correct, accuracy(logits, y))]
+        return self.__summary(total, loss_sum, correct)
+
+    def train_region_heads(self, features:torch.Tensor, countries:torch.Tensor, regions:torch.Tensor, epochs:int, lr:float, batch_size:int=256):
+        '''
+        Train the region heads on the cached features, the backbone and the country classifier are untouched.
+        :param features: Tensor of shape (N, 960).
+        :param countries: Tensor of shape (N,) of the country labels.
+        :param regions: Tensor of shape (N,) of the region labels within the countries.
+        :returns: The training accuracy of the region heads in the last epoch.
+        '''
+        heads = self.model.region_heads
+        heads.train()
+        optimizer = torch.optim.Adam(heads.parameters(), lr=lr)
+        total, correct = 0, 0
+        for _ in range(epochs):
+            total, correct = 0, 0
+            for country, head in heads.items():
+                rows = (countries == int(country)).nonzero(as_tuple=True)[0]
+                rows = rows[torch.randperm(len(rows))]
+                for start in range(0, len(rows), batch_size):
+                    batch = rows[start:start + batch_size]
+                    x, y = features[batch].to(self.device), regions[batch].to(self.device)
+                    logits = head(x)
+                    loss = self.criterion(logits, y)
+                    optimizer.zero_grad(set_to_none=True)
+                    loss.backward()
+                    optimizer.step()
+                    total += len(batch)
+                    correct += int((logits.argmax(dim=1) == y).sum())
+        heads.eval()
+        return correct / max(1, total)
+
+    def save_checkpoint(self, path:str):
+        '''Save the checkpoint atomically.'''
+        tmp = path + '.tmp'
+        torch.save({
+            'epoch': self.epoch,
+            'phase': self.phase,
+            'best_acc': self.best_acc,
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict() if self.optimizer else None
+            }, tmp)
+        os.replace(tmp, path)
+
+    def load_checkpoint(self, path:str, lrs:dict):
+        '''
+        Resume from the checkpoint, the phase and the optimizer state are restored.
+        In distributed training only rank 0 reads the file, and broadcasts the state to the other ranks.
+        :param lrs: The dict mapping each phase to its learning rate, used if no optimizer state is saved.
+        :returns: Whether the checkpoint is loaded, False if it does not exist.
+        '''
+        ckpt = None
+        if (not self.distributed or dist.get_rank() == 0) and os.path.isfile(path):
+            ckpt = torch.load(path, map_location='cpu')
+            self.model.load_state_dict(ckpt.pop('model'))
+        if self.distributed:
+            # The model is broadcast as tensors, the rest of the checkpoint as a picklable object
+            objects = [ckpt]
+            dist.broadcast_object_list(objects, 0)
+            ckpt = objects[0]
+            if ckpt is not None:
+                self.broadcast_state()
+        if ckpt is None:
+            return False
+        self.epoch = ckpt['epoch']
+        self.best_acc = ckpt.get('best_acc', 0.0)
+        phase = ckpt['phase'] or 'full'
+        self.set_phase(phase, lrs[phase])
+        if ckpt.get('optimizer'):
+            self.optimizer.load_state_dict(ckpt['optimizer'])
+        return True
+
+    def __synchronized(self, loader:DataLoader):
+        # Every rank must run the same number of steps, so that the gradient all-reduces stay paired,
+        # the epoch ends as soon as any rank runs out of batches
+        self.dropped_batches = 0
+        if not self.distributed:
+            yield from loader
+            return
+        iterator = iter(loader)
+        while True:
+            batch = next(iterator, None)
+            flag = torch.tensor([0 if batch is None else 1])
+            dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+            if not flag.item():
+                break
+            yield batch
+        # The batches the other ranks have left are counted, so that the uneven shards do not go unnoticed
+        dropped = torch.tensor([0 if batch is None else 1 + sum(1 for _ in iterator)])
+        dist.all_reduce(dropped)
+        self.dropped_batches = int(dropped.item())
+
+    def __all_reduce_gradients(self):
+        # One all-reduce over the flattened gradients, instead of one per parameter
+        grads = [p.grad for p in self.model.parameters() if p.grad is not None]
+        if not grads:
+            return
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        dist.all_reduce(flat)
+        flat /= dist.get_world_size()
+        offset = 0
+        for g in grads:
+            g.copy_(flat[offset:offset + g.numel()].view_as(g))
+            offset += g.numel()
+
+    def __summary(self, total:int, loss_sum:float, correct:list):
+        if self.distributed:
+            stats = torch.tensor([total, loss_sum, *correct], dtype=torch.float64)
+            dist.all_reduce(stats)
+            total, loss_sum, correct = int(stats[0]), float(stats[1]), stats[2:].tolist()
+        total = max(1, total)
+        return {'loss': loss_sum / total, 'acc1': correct[0] / total, 'acc5': correct[1] / total}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Tuxun-AI training and evaluation')
+    parser.add_argument('--data', required=True, help='JSON file of the street view data, a tensor cache directory or a shard directory')
+    parser.add_argument('--images', default='images', help='directory of the street view images')
+    parser.add_argument('--mapping', default=os.path.join('models', 'mapping.json'))
+    parser.add_argument('--val-data', default=None, help='separate validation data, otherwise split from --data')
+    parser.add_argument('--val-ratio', type=float, default=0.1)
+    parser.add_argument('--eval-only', action='store_true')
+    parser.add_argument('--weights', default=None, help='initial model weights, e.g. models/v0.3.0.pth')
+    parser.add_argument('--pretrained', action='store_true', help='initialize the backbone from the ImageNet weights')
+    parser.add_argument('--classifier-epochs', type=int, default=10)
+    parser.add_argument('--full-epochs', type=int, default=30)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--full-lr', type=float, default=1e-4)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads per process, 0 for default, or the cores divided by the local ranks if distributed')
+    parser.add_argument('--distributed', action='store_true', help='data-parallel training over the gloo backend, launch by torchrun, e.g. '
+        '"torchrun --nproc-per-node 4 Train.py --distributed --resume ..."')
+    parser.add_argument('--no-feature-cache', action='store_true', help='run the backbone in every classifier epoch')
+    parser.add_argument('--no-channels-last', action='store_true')
+    parser.add_argument('--tensor-augment', default=None, help='decode each sample once and generate these views from batches, e.g. "left,right,left-flip"')
+    parser.add_argument('--checkpoint', default='checkpoint.pth')
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--output', default=os.path.join('models', 'trained.pth'))
+    parser.add_argument('--load-processes', type=int, default=0, help='processes validating the images while loading, 0 to validate in threads')
+    parser.add_argument('--to-shards', default=None, help='convert the JSON data and the images into a shard directory, then exit')
+    parser.add_argument('--shard-size', type=int, default=1000)
+    parser.add_argument('--region-epochs', type=int, default=0, help='train the region heads on top of the best model after the schedule')
+    parser.add_argument('--max-regions', type=int, default=8, help='max regions per country')
+    parser.add_argument('--min-region-size', type=int, default=50, help='min places per region')
+    parser.add_argument('--regions', default=os.path.join('models', 'regions.json'), help='path to save the regions of the region heads, whose weights are saved beside it as .pth')
+    args = parser.parse_args()
+
+    is_main = True
+    if args.distributed:
+        # The rank, the world size and the rendezvous address are given by torchrun in the environment variables
+        dist.init_process_group('gloo')
+        is_main = dist.get_rank() == 0
+        if args.threads <= 0:
+            args.threads = max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    log = print if is_main else lambda *_, **__: None
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    if args.to_shards:
+        data = json.load(open(args.data, 'r', encoding='UTF-8'))
+        count = StreetViewDataset(data).to_shards(args.images, args.to_shards, args.shard_size)
+        log(f"Wrote {count} samples to {args.to_shards}")
+        exit()
+
+    StreetViewImageDataset.validate_processes = args.load_processes
+    collate = StreetViewTensorAugment(args.tensor_augment.split(',')) if args.tensor_augment else None
+    dataset = load_image_dataset(args.data, args.images, args.mapping, bool(collate))
+    for key, reason in getattr(dataset, 'dropped', {}).items():
+        log(f"Dropped {key}: {reason}")
+    if getattr(dataset, 'dropped', None):
+        log(f"Dropped {len(dataset.dropped)} samples in total")
+    if args.val_data:
+        train_set, val_set = dataset, load_image_dataset(args.val_data, args.images, args.mapping, bool(collate))
+    elif isinstance(dataset, StreetViewShardDataset):
+        raise ValueError("A shard directory cannot be split, give the validation data by --val-data")
+    else:
+        train_set, val_set = split_dataset(dataset, args.val_ratio)
+    log(f"Train: {len(train_set)}, validation: {len(val_set)}, classes: {dataset.num_classes}")
+
+    if args.pretrained:
+        import torchvision.models as models
+        backbone = models.mobilenet_v3_large(weights=models.MobileNet_V3_Large_Weights.DEFAULT)
+        model = TuxunAIModelV0(backbone.features, backbone.avgpool, TuxunAIModelV0.get_classifier(dataset.num_classes))
+    else:
+        model = TuxunAIModelV0(classifier=TuxunAIModelV0.get_classifier(dataset.num_classes))
+    if args.weights:
+        model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+    trainer = Trainer(model, device, not args.no_channels_last, args.distributed)
+    # Only rank 0 needs the checkpoint file, so a restarted group may have a different world size and no shared file system
+    if args.resume and trainer.load_checkpoint(args.checkpoint, {'classifier': args.lr, 'full': args.full_lr}):
+        log(f"Resumed from epoch {trainer.epoch} ({trainer.phase})")
+    if args.distributed:
+        log(f"Distributed: {dist.get_world_size()} processes, {args.threads} threads each")
+        readers = dist.get_world_size() * max(args.workers, 1)
+        if isinstance(train_set, StreetViewShardDataset) and len(train_set.shards) % readers:
+            log(f"Warning: {len(train_set.shards)} shards are not a multiple of {readers} readers (processes × workers), "
+                "the batches beyond the shortest reader are dropped every epoch")
+
+    train_loader = make_loader(train_set, args.batch_size, True, args.workers, collate_fn=collate, distributed=args.distributed)
+    val_loader = make_loader(val_set, args.batch_size, False, args.workers, collate_fn=collate, distributed=args.distributed)
+
+    def report(name:str, result:dict, elapsed:float):
+        log(f"{name}\tloss {result['loss']:.4f}\tAcc@1 {result['acc1']*100:.2f}%\tAcc@5 {result['acc5']*100:.2f}%\t{elapsed:.1f}s")
+
+    if args.eval_only:
+        t = time.perf_counter()
+        report('Eval', trainer.evaluate(val_loader), time.perf_counter() - t)
+        exit()
+
+    schedule = [('classifier', args.lr)] * args.classifier_epochs + [('full', args.full_lr)] * args.full_epochs
+    cached = None
+    for epoch in range(trainer.epoch, len(schedule)):
+        phase, lr = schedule[epoch]
+        if trainer.phase != phase:
+            trainer.set_phase(phase, lr)
+        if isinstance(train_set, StreetViewShardDataset):
+            train_set.set_epoch(epoch)
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+        t = time.perf_counter()
+        if phase == 'classifier' and not args.no_feature_cache:
+            if cached is None:
+                cached = (
+                    make_loader(trainer.cache_features(make_loader(train_set, args.batch_size, False, args.workers, collate_fn=collate,
+                        distributed=args.distributed)), args.batch_size, True),
+                    make_loader(trainer.cache_features(val_loader), args.batch_size, False)
+                    )
+                log(f"Cached features in {time.perf_counter() - t:.1f}s")
+            train_result = trainer.train_epoch(cached[0], True)
+            val_result = trainer.evaluate(cached[1], True)
+        else:
+            train_result = trainer.train_epoch(train_loader)
+            val_result = trainer.evaluate(val_loader)
+        report(f"Epoch {trainer.epoch} {phase}\ttrain", train_result, time.perf_counter() - t)
+        if trainer.dropped_batches:
+            log(f"Epoch {trainer.epoch} dropped {trainer.dropped_batches} batches of the uneven ranks")
+        report(f"Epoch {trainer.epoch} {phase}\tval", val_result, time.perf_counter() - t)
+        if val_result['acc1'] > trainer.best_acc or not os.path.isfile(args.output):
+            trainer.best_acc = val_result['acc1']
+            if is_main:
+                torch.save(trainer.model.state_dict(), args.output)
+        if is_main:
+            trainer.save_checkpoint(args.checkpoint)
+        if args.distributed:
+            dist.barrier()
+    if len(schedule):
+        log(f"Best Acc@1: {trainer.best_acc*100:.2f}%, saved to {args.output}")
+
+    if args.distributed:
+        dist.destroy_process_group()
+
+    if args.region_epochs > 0 and is_main:
+        if not isinstance(dataset, StreetViewImageDataset) or collate:
+            raise ValueError("Region heads need the street view data, without a tensor cache or --tensor-augment")
+        t = time.perf_counter()
+        if os.path.isfile(args.output):
+            # The region heads are not created yet, so the main weights load strictly
+            trainer.model.load_state_dict(TuxunAIModelV0.strip_region_heads(torch.load(args.output, map_location=device)))
+        regions, assignments = StreetViewDataset(dataset.data, dataset.targets).get_regions(args.max_regions, args.min_region_size)
+        trainer.model.set_region_heads({c: len(r) for c, r in regions.items()})
+        trainer.model.region_heads.to(device)
+        features, countries = trainer.cache_features(make_loader(train_set, args.batch_size, False, args.workers)).tensors
+        indices = train_set.indices if isinstance(train_set, Subset) else range(len(train_set))
+        region_labels = torch.tensor([assignments.get(dataset.keys[i % len(dataset.keys)], 0) for i in indices], dtype=torch.long)
+        acc = trainer.train_region_heads(features, countries, region_labels, args.region_epochs, args.lr)
+        # The main weights stay loadable without the regions file
+        torch.save(trainer.model.get_main_state_dict(), args.output)
+        torch.save(trainer.model.region_heads.state_dict(), TuxunAIModelV0.get_region_heads_path(args.regions))
+        with open(args.regions, 'w', encoding='UTF-8') as f:
+            json.dump({str(c): {str(j): v for j, v in r.items()} for c, r in regions.items() if len(r) >= 2}, f, ensure_ascii=False, indent=4)
+        log(f"Region heads: {len(trainer.model.region_heads)}, train Acc@1 {acc*100:.2f}%, {time.perf_counter() - t:.1f}s, saved to {args.regions}")
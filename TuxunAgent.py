@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2023, Harry Huang
 # @ BSD 3-Clause License
-import json, base64, time
+import json, base64, time, threading
 import requests as R
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
+from Cache import DiskCache
+import Metrics
 
 
 class TuxunGame():
@@ -53,19 +57,28 @@ class TuxunAgentException(Exception):
 class TuxunAgent():
     '''Tuxun Agent'''
 
-    def __init__(self):
-        '''Initialize a TuxunGame instance.'''
+    base_url = "https://tuxun.fun"
+    '''The base URL of the API server, can be replaced with a local server for testing.'''
+    game_ttl = 5
+    '''The time-to-live(s) of the cached game state.'''
+
+    def __init__(self, cache:DiskCache=None):
+        '''
+        Initialize a TuxunGame instance.
+        :param cache: DiskCache object to cache the game state, `None` to disable.
+        '''
         self.cookie = ""
-        pass
+        self.cache = cache
 
     def set_cookie(self, cookie:str):
         '''Set the Cookie to be used to interact with the server.'''
         self.cookie = cookie
     
+    @Metrics.instrumented('get_user_id')
     def get_user_id(self):
         ''''Get the user ID of the current user.'''
         try:
-            r = R.get(f"https://tuxun.fun/api/get_profile",
+            r = R.get(f"{self.base_url}/api/get_profile",
                 headers=self.__get_http_header())
 
             if r.status_code == 200:
@@ -83,10 +96,11 @@ class TuxunAgent():
         except Exception as e:
             return e
     
+    @Metrics.instrumented('get_user_rating')
     def get_user_rating(self, id:int):
         '''Get the rating of the specified user.'''
         try:
-            r = R.get(f"https://tuxun.fun/api/v0/tuxun/getProfile?userId={id}",
+            r = R.get(f"{self.base_url}/api/v0/tuxun/getProfile?userId={id}",
                 headers=self.__get_http_header())
 
             if r.status_code == 200:
@@ -102,6 +116,7 @@ class TuxunAgent():
         except Exception as e:
             return e
     
+    @Metrics.instrumented('create')
     def create(self, type='country', mode='streak'):
         '''
         Create a Tuxun Game.
@@ -110,7 +125,7 @@ class TuxunAgent():
         :returns: TuxunGame object if success.
         '''
         try:
-            r = R.get(f"https://tuxun.fun/api/v0/tuxun/{mode}/create?type={type}",
+            r = R.get(f"{self.base_url}/api/v0/tuxun/{mode}/create?type={type}",
                 headers=self.__get_http_header())
 
             if r.status_code == 200:
@@ -126,6 +141,7 @@ class TuxunAgent():
         except Exception as e:
             return e
     
+    @Metrics.instrumented('get')
     def get(self, id:str, mode='solo'):
         '''
         Get a given Tuxun Game.
@@ -134,13 +150,18 @@ class TuxunAgent():
         :returns: TuxunGame object if success.
         '''
         try:
-            r = R.get(f"https://tuxun.fun/api/v0/tuxun/{mode}/get?gameId={id}",
+            if self.cache:
+                cached = self.cache.get(self.__get_game_key(mode, id), self.game_ttl)
+                if cached is not None:
+                    return TuxunGame(json.loads(cached))
+            r = R.get(f"{self.base_url}/api/v0/tuxun/{mode}/get?gameId={id}",
                 headers=self.__get_http_header())
 
             if r.status_code == 200:
                 r.encoding = 'UTF-8'
                 resp = json.loads(r.text)
                 if resp['success']:
+                    self.__cache_game(mode, resp['data'])
                     return TuxunGame(resp['data'])
                 else:
                     msg = resp['errorCode'] if 'errorCode' in resp.keys() else 'unknown'
@@ -150,6 +171,7 @@ class TuxunAgent():
         except Exception as e:
             return e
     
+    @Metrics.instrumented('guess')
     def guess(self, game:TuxunGame, lng:float, lat:float):
         '''
         Do a guess of the game.
@@ -165,13 +187,14 @@ class TuxunAgent():
                 api = 'solo'
             else:
                 return TuxunAgentException(f"Unsupported game type: {game.type}")
-            r = R.get(f"https://tuxun.fun/api/v0/tuxun/{api}/guess?gameId={game.id}&lng={lng}&lat={lat}",
+            r = R.get(f"{self.base_url}/api/v0/tuxun/{api}/guess?gameId={game.id}&lng={lng}&lat={lat}",
                 headers=self.__get_http_header())
 
             if r.status_code == 200:
                 r.encoding = 'UTF-8'
                 resp = json.loads(r.text)
                 if resp['success']:
+                    self.__cache_game(api, resp['data'])
                     return TuxunGame(resp['data'])
                 else:
                     msg = resp['errorCode'] if 'errorCode' in resp.keys() else 'unknown'
@@ -181,6 +204,20 @@ class TuxunAgent():
         except Exception as e:
             return e
 
+    def guess_probs(self, game:TuxunGame, probs, engine):
+        '''
+        Do the guess of the game which minimizes the expected distance under the predicted probabilities.
+        :param probs: Array-like of shape (classes,) of the probabilities of the target places.
+        :param engine: Guess.TuxunGuessEngine object.
+        :returns: TuxunGame object if success.
+        '''
+        try:
+            best = engine.guess_one(probs)
+        except Exception as e:
+            return e
+        return self.guess(game, best['lng'], best['lat'])
+
+    @Metrics.instrumented('emoji')
     def emoji(self, game:TuxunGame, emoji_id:int):
         '''
         Send an emoji to the given game.
@@ -194,7 +231,7 @@ class TuxunAgent():
                 api = 'solo'
             else:
                 return TuxunAgentException(f"Unsupported game type: {game.type}")
-            r = R.get(f"https://tuxun.fun/api/v0/tuxun/{api}/sendEmoji?gameId={game.id}&emojiId={emoji_id}",
+            r = R.get(f"{self.base_url}/api/v0/tuxun/{api}/sendEmoji?gameId={game.id}&emojiId={emoji_id}",
                 headers=self.__get_http_header())
 
             if r.status_code == 200:
@@ -210,6 +247,7 @@ class TuxunAgent():
         except Exception as e:
             return e
 
+    @Metrics.instrumented('match')
     def match(self, mode='solo'):
         '''
         Match a PVP game.
@@ -220,7 +258,7 @@ class TuxunAgent():
             interval = 1500
             match = None
             while not match:
-                r = R.get(f"https://tuxun.fun/api/v0/tuxun/{mode}/joinRandom?interval={interval}",
+                r = R.get(f"{self.base_url}/api/v0/tuxun/{mode}/joinRandom?interval={interval}",
                     headers=self.__get_http_header())
 
                 if r.status_code == 200:
@@ -236,6 +274,7 @@ class TuxunAgent():
         except Exception as e:
             return e
     
+    @Metrics.instrumented('join')
     def join(self, id:str):
         '''
         Join-in a multi-player game.
@@ -243,7 +282,7 @@ class TuxunAgent():
         :returns: TuxunGame object if success.
         '''
         try:
-            r = R.get(f"https://tuxun.fun/api/v0/tuxun/game/join?gameId={id}",
+            r = R.get(f"{self.base_url}/api/v0/tuxun/game/join?gameId={id}",
                 headers=self.__get_http_header())
 
             if r.status_code == 200:
@@ -264,6 +303,14 @@ class TuxunAgent():
             'cookie': self.cookie
         }
 
+    def __cache_game(self, mode:str, data:dict):
+        if self.cache and data and data.get('id'):
+            self.cache.set(self.__get_game_key(mode, data['id']), json.dumps(data).encode('UTF-8'))
+
+    @staticmethod
+    def __get_game_key(mode:str, id:str):
+        return f"game:{mode}:{id}"
+
 class StreetViewException(Exception):
 
     def __init__(self, msg:str):
@@ -280,11 +327,43 @@ class StreetView():
     T_GOOGLE_PANO   = 2
     T_CHAOFAN_PANO  = 3
 
+    google_url = "https://streetviewpixels-pa.googleapis.com/cbk?cb_client=apiv3&panoid={pano}&output=tile&x={x}&y={y}&zoom={z}&nbt=1&fover=2"
+    '''The URL template of the Google tile API, can be replaced with a local server for testing.'''
+    chaofan_url = "https://map.chao-fan.com/p/{pano}=x{x}-y{y}-z{z}"
+    '''The URL template of the Chaofan tile API, can be replaced with a local server for testing.'''
+    timeout = 10
+    retries = 3
+    '''The maximum number of retries of a tile request.'''
+    backoff = 0.2
+    '''The base delay(s) of the exponential backoff between retries.'''
+    max_workers = 8
+    '''The maximum number of concurrent tile requests of a panorama.'''
+    cache:DiskCache = None
+    '''DiskCache object to cache the tiles, `None` to disable.'''
+    __session = None
+    __session_lock = threading.Lock()
+
     def __init__(self, pano:str, type:int=T_AUTO_DETECT):
         self.pano = pano
         '''The pano ID of the street view.'''
         self.__type = type
 
+    @classmethod
+    def get_session(cls):
+        '''
+        Get the HTTP session shared by all street views, whose connections are kept alive and pooled.
+        :returns: Session object.
+        '''
+        # The tile threads may ask for it at the same time, only one of them creates it
+        with StreetView.__session_lock:
+            if StreetView.__session is None:
+                session = R.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(cls.max_workers, 10))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                StreetView.__session = session
+            return StreetView.__session
+
     def get_type(self):
         if self.__type == self.T_BAIDU_PANO:
             return self.T_BAIDU_PANO
@@ -308,21 +387,80 @@ class StreetView():
         t = self.get_type()
         if t == self.T_BAIDU_PANO:
             return None
+        key = f"tile:{self.pano}:{x}:{y}:{z}"
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
         if t == self.T_GOOGLE_PANO:
-            return self.__get_google_street_view(self.pano, x, y, z)
-        if t == self.T_CHAOFAN_PANO:
-            return self.__get_chaofan_street_view(self.pano, x, y, z)
+            source = 'google'
+            with Metrics.timer('tile_fetch_seconds', source=source):
+                img = self.__get_google_street_view(self.pano, x, y, z)
+        elif t == self.T_CHAOFAN_PANO:
+            source = 'chaofan'
+            with Metrics.timer('tile_fetch_seconds', source=source):
+                img = self.__get_chaofan_street_view(self.pano, x, y, z)
+        else:
+            return None
+        Metrics.inc('tile_requests_total', source=source, result='ok' if type(img) == bytes else 'error')
+        if self.cache and type(img) == bytes:
+            self.cache.set(key, img)
+        return img
+
+    @staticmethod
+    def get_tile_grid(z:int):
+        '''
+        Get the tile grid size of a panorama at the given zoom level.
+        :returns: Tuple (columns, rows).
+        '''
+        return (2 ** z, 2 ** (z - 1) if z > 0 else 1)
+
+    def get_panorama(self, z:int=1, grid:tuple=None):
+        '''
+        Fetch all the tiles of the panorama at the given zoom level concurrently, and stitch them together.
+        :param z: The zoom level.
+        :param grid: Tuple (columns, rows) to override the default tile grid size.
+        :returns: Image object if success.
+        '''
+        try:
+            cols, rows = grid if grid else self.get_tile_grid(z)
+            coords = [(x, y) for y in range(rows) for x in range(cols)]
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(coords))) as executor:
+                tiles = list(executor.map(lambda c: self.get_image_bytes(c[0], c[1], z), coords))
+            for tile in tiles:
+                if type(tile) != bytes:
+                    raise tile if isinstance(tile, Exception) else StreetViewException(f"Unsupported pano type of {self.pano}")
+            tiles = [Image.open(BytesIO(tile)) for tile in tiles]
+            width, height = tiles[0].size
+            img = Image.new('RGB', (width * cols, height * rows))
+            for (x, y), tile in zip(coords, tiles):
+                img.paste(tile, (x * width, y * height))
+            return img
+        except Exception as e:
+            return e
+
+    @classmethod
+    def _fetch(cls, url:str):
+        for attempt in range(cls.retries + 1):
+            try:
+                r = cls.get_session().get(url, timeout=cls.timeout)
+                if r.status_code == 200:
+                    return r.content
+                if r.status_code != 429 and r.status_code < 500:
+                    raise StreetViewException(f"HTTP request failed, response code: {r.status_code}")
+                error = StreetViewException(f"HTTP request failed, response code: {r.status_code}")
+            except StreetViewException:
+                raise
+            except R.RequestException as e:
+                error = e
+            if attempt < cls.retries:
+                time.sleep(cls.backoff * (2 ** attempt))
+        raise error
 
     @staticmethod
     def __get_google_street_view(pano_id:str, x:int=0, y:int=0, zoom:int=0):
         try:
-            r = R.get(f"https://streetviewpixels-pa.googleapis.com/cbk?cb_client=apiv3&panoid={pano_id}&output=tile&x={x}&y={y}&zoom={zoom}&nbt=1&fover=2",
-                    timeout=10)
-            
-            if r.status_code == 200:
-                return r.content
-            else:
-                raise StreetViewException(f"HTTP request failed, response code: {r.status_code}")
+            return StreetView._fetch(StreetView.google_url.format(pano=pano_id, x=x, y=y, z=zoom))
         except Exception as e:
             return e
 
@@ -332,12 +470,6 @@ class StreetView():
         try:
             pano_id = str(base64.decodebytes(bytes(pano_id, encoding=encoding)), encoding=encoding)
             pano_id = pano_id[pano_id.find(',')+1:]
-            r = R.get(f"https://map.chao-fan.com/p/{pano_id}=x{x}-y{y}-z{z}",
-                    timeout=10)
-            
-            if r.status_code == 200:
-                return r.content
-            else:
-                raise StreetViewException(f"HTTP request failed, response code: {r.status_code}")
+            return StreetView._fetch(StreetView.chaofan_url.format(pano=pano_id, x=x, y=y, z=z))
         except Exception as e:
             return e
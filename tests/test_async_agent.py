@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+pytest.importorskip('aiohttp')
+import AsyncTuxunAgent as A
+from Benchmark import start_fake_server
+from Cache import DiskCache
+from TuxunAgent import TuxunGame, TuxunAgentException
+
+
+@pytest.fixture
+def base_url():
+    server, url = start_fake_server(tile_size=(16, 8))
+    yield url
+    server.shutdown()
+    server.server_close()
+
+def _run(base_url:str, func, cache:DiskCache=None):
+    async def run():
+        async with A.AsyncTuxunAgent(cache=cache) as agent:
+            agent.base_url = base_url
+            agent.rate_limits = {'default': 0}
+            return await func(agent)
+    return asyncio.run(run())
+
+def test_solo_session(base_url):
+    async def session(agent):
+        gid = await agent.match('solo', timeout=10)
+        game = await agent.join(gid)
+        got = await agent.get(game.id, 'solo')
+        guessed = await agent.guess(got, 0.0, 0.0)
+        return gid, game, got, guessed, await agent.emoji(guessed, 1)
+
+    gid, game, got, guessed, sent = _run(base_url, session)
+    assert isinstance(gid, str) and game.id == gid == got.id
+    assert type(guessed) == TuxunGame and 'solo' in guessed.type
+    assert sent is True
+
+def test_streak_guess_answers(base_url):
+    async def session(agent):
+        game = await agent.create('country', 'streak')
+        return game, await agent.guess(game, 116.4, 39.9), await agent.get_user_id(), await agent.get_user_rating(7)
+
+    game, guessed, user_id, rating = _run(base_url, session)
+    assert type(game) == TuxunGame and not game.has_answer()
+    assert guessed.id == game.id and guessed.has_answer()
+    assert guessed.status == 'finished' and guessed.last_guess_target.startswith('T')
+    assert (user_id, rating) == ('1', 1500)
+
+def test_guess_state_cached(base_url, tmp_path):
+    cache = DiskCache(str(tmp_path))
+
+    async def session(agent):
+        game = await agent.create('country', 'streak')
+        guessed = await agent.guess(game, 0.0, 0.0)
+        return guessed, await agent.get(game.id, 'streak')
+
+    guessed, got = _run(base_url, session, cache)
+    assert cache.hits == 1
+    assert got.id == guessed.id and got.has_answer() and got.last_guess_target == guessed.last_guess_target
+
+def test_concurrent_sessions(base_url):
+    async def sessions(agent):
+        games = await asyncio.gather(*[agent.create('country', 'streak') for _ in range(20)])
+        return games, await asyncio.gather(*[agent.guess(g, 0.0, 0.0) for g in games])
+
+    games, guessed = _run(base_url, sessions)
+    assert len({g.id for g in games}) == 20
+    assert [g.id for g in guessed] == [g.id for g in games]
+    assert all(g.has_answer() for g in guessed)
+
+def test_errors_returned(base_url):
+    async def session(agent):
+        game = await agent.create('country', 'challenge')
+        unsupported = await agent.guess(game, 0.0, 0.0), await agent.emoji(game, 1)
+        # The fake server answers 404 for the unknown paths
+        agent.base_url = base_url + '/missing'
+        return unsupported + (await agent.get_user_id(),)
+
+    results = _run(base_url, session)
+    assert all(isinstance(r, TuxunAgentException) for r in results)
+
+def test_requires_aiohttp(monkeypatch):
+    monkeypatch.setattr(A, 'aiohttp', None)
+    with pytest.raises(ImportError, match='pip install aiohttp'):
+        A.AsyncTuxunAgent()
@@ -0,0 +1,36 @@
+import time
+from Cache import DiskCache
+
+
+def test_get_and_set(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    assert cache.get('tile:a') is None
+    cache.set('tile:a', b'value')
+    assert cache.get('tile:a') == b'value'
+    cache.set('tile:a', b'new')
+    assert cache.get('tile:a') == b'new'
+    assert (cache.hits, cache.misses) == (2, 1)
+
+def test_ttl_expires(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.set('game:a', b'state')
+    assert cache.get('game:a', ttl=60) == b'state'
+    time.sleep(0.1)
+    assert cache.get('game:a', ttl=0.05) is None
+    # Expiration does not delete the value
+    assert cache.get('game:a') == b'state'
+
+def test_lru_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=250)
+    cache.set('a', b'a' * 100)
+    time.sleep(0.05)
+    cache.set('b', b'b' * 100)
+    time.sleep(0.05)
+    # Reading refreshes the recency of a, so b is the least recently used
+    assert cache.get('a') is not None
+    time.sleep(0.05)
+    cache.set('c', b'c' * 100)
+    cache.evict()
+    assert cache.get('b') is None
+    assert cache.get('a') == b'a' * 100
+    assert cache.get('c') == b'c' * 100
@@ -0,0 +1,23 @@
+from Benchmark import make_street_view_data
+from Dataset import StreetViewDataset
+
+
+def _cleansed_reference(dataset:StreetViewDataset, topk:int, max_distance:float):
+    keeps = sorted(dataset.targets.values(), key=lambda x: x['frequency'], reverse=True)[:topk]
+    names = set(x['name'] for x in keeps)
+    result = {}
+    for key, item in dataset.data.items():
+        if item['target'] in names:
+            result[key] = item
+            continue
+        best = min(keeps, key=lambda x: StreetViewDataset.get_distance(item['lng'], item['lat'], x['lng'], x['lat']))
+        if StreetViewDataset.get_distance(item['lng'], item['lat'], best['lng'], best['lat']) <= max_distance:
+            result[key] = dict(item, target=best['name'])
+    return result
+
+def test_get_cleansed_matches_reference(monkeypatch):
+    dataset = StreetViewDataset(make_street_view_data(2000, num_targets=40))
+    # A small chunk size covers the chunk boundaries as well
+    monkeypatch.setattr(StreetViewDataset, 'cleanse_chunk_size', 97)
+    for topk, max_distance in ((10, 3000), (25, 1000), (40, 1000)):
+        assert dataset.get_cleansed(topk, max_distance).data == _cleansed_reference(dataset, topk, max_distance)
@@ -0,0 +1,58 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset
+from Model import TuxunAIStudentModel
+from Train import Trainer, make_loader
+
+WORLD_SIZE = 2
+
+
+def _make_trainer(seed:int):
+    # Every rank starts from different weights, so that the broadcast from rank 0 is checked too
+    torch.manual_seed(seed)
+    model = TuxunAIStudentModel(classifier=TuxunAIStudentModel.get_classifier(3))
+    return Trainer(model, 'cpu', False, True)
+
+def _worker(rank:int, root:str):
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', init_method='file://' + os.path.join(root, 'store'), rank=rank, world_size=WORLD_SIZE)
+    try:
+        generator = torch.Generator().manual_seed(0)
+        dataset = TensorDataset(torch.randn(16, 3, 32, 32, generator=generator), torch.randint(0, 3, (16,), generator=generator))
+        trainer = _make_trainer(rank + 1)
+        trainer.set_phase('full', 1e-3)
+        trainer.train_epoch(make_loader(dataset, 4, True, distributed=True))
+        torch.save(trainer.model.state_dict(), os.path.join(root, f'trained-{rank}.pth'))
+        if rank == 0:
+            trainer.save_checkpoint(os.path.join(root, 'ckpt.pth'))
+        dist.barrier()
+        # Only rank 0 can see the checkpoint, as on the machines without a shared file system
+        path = os.path.join(root, 'ckpt.pth' if rank == 0 else 'missing.pth')
+        resumed = _make_trainer(rank + 10)
+        assert resumed.load_checkpoint(path, {'full': 1e-3})
+        assert (resumed.epoch, resumed.phase) == (1, 'full')
+        torch.save(resumed.model.state_dict(), os.path.join(root, f'resumed-{rank}.pth'))
+        # Rank 0 has two batches and rank 1 one, every rank stops after one step
+        uneven = DataLoader(TensorDataset(*(t[:8 // (rank + 1)] for t in dataset.tensors)), batch_size=4)
+        result = resumed.train_epoch(uneven)
+        assert result['loss'] > 0 and resumed.dropped_batches == 1
+    finally:
+        dist.destroy_process_group()
+
+def _assert_same_state(a:dict, b:dict):
+    assert a.keys() == b.keys()
+    for k in a:
+        assert torch.equal(a[k], b[k]), k
+
+def test_ranks_stay_in_sync(tmp_path):
+    root = str(tmp_path)
+    mp.spawn(_worker, args=(root,), nprocs=WORLD_SIZE)
+    trained = [torch.load(os.path.join(root, f'trained-{r}.pth')) for r in range(WORLD_SIZE)]
+    resumed = [torch.load(os.path.join(root, f'resumed-{r}.pth')) for r in range(WORLD_SIZE)]
+    # The BatchNorm statistics are only synchronized on evaluation, the parameters on every step
+    params = {k for k, _ in TuxunAIStudentModel(classifier=TuxunAIStudentModel.get_classifier(3)).named_parameters()}
+    _assert_same_state(*({k: v for k, v in s.items() if k in params} for s in trained))
+    _assert_same_state(resumed[0], trained[0])
+    _assert_same_state(resumed[1], trained[0])
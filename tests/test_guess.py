@@ -0,0 +1,40 @@
+import numpy as np
+from Dataset import StreetViewDataset
+from Guess import TuxunGuessEngine
+
+
+def _make_mapping(num_classes:int, seed:int=0):
+    rnd = np.random.default_rng(seed)
+    return {str(i): {'name': f'T{i:03d}', 'lng': float(rnd.uniform(-180, 180)), 'lat': float(rnd.uniform(-60, 70))}
+        for i in range(num_classes)}
+
+def _random_probs(batch_size:int, num_classes:int, seed:int=0):
+    probs = np.random.default_rng(seed).dirichlet(np.full(num_classes, 0.3), size=batch_size)
+    return probs.astype(np.float32)
+
+def test_expected_distance_matches_brute_force():
+    mapping = _make_mapping(12)
+    engine = TuxunGuessEngine(mapping, grid_step=30)
+    probs = _random_probs(4, 12)
+    coords, expected = engine.guess(probs)
+    for p, coord, value in zip(probs, coords, expected):
+        brute = [sum(float(p[int(i)]) * StreetViewDataset.get_distance(v['lng'], v['lat'], c[0], c[1]) for i, v in mapping.items())
+            for c in engine.candidates]
+        best = int(np.argmin(brute))
+        assert np.allclose(coord, engine.candidates[best])
+        assert abs(value - brute[best]) <= 1e-3 * brute[best] + 1e-2
+
+def test_certain_probs_guess_the_target():
+    mapping = _make_mapping(8)
+    engine = TuxunGuessEngine(mapping)
+    probs = np.eye(8, dtype=np.float32)
+    coords, expected = engine.guess(probs)
+    assert np.allclose(coords, [[mapping[str(i)]['lng'], mapping[str(i)]['lat']] for i in range(8)])
+    assert np.allclose(expected, 0, atol=1e-3)
+
+def test_distance_cache_is_keyed_on_mapping(tmp_path):
+    path = str(tmp_path / 'distances.npz')
+    first = TuxunGuessEngine(_make_mapping(8, seed=0), cache_path=path)
+    assert np.array_equal(TuxunGuessEngine(_make_mapping(8, seed=0), cache_path=path).distances, first.distances)
+    other = TuxunGuessEngine(_make_mapping(8, seed=1), cache_path=path)
+    assert not np.array_equal(other.distances, first.distances)
@@ -0,0 +1,46 @@
+import tarfile
+from Benchmark import make_jpeg, make_street_view_data
+from Dataset import StreetViewDataset, StreetViewShardDataset
+from Harvest import HarvestStore
+
+
+def test_append_matches_rebuild():
+    data = make_street_view_data(500, num_targets=20)
+    dataset = StreetViewDataset()
+    for key, item in data.items():
+        dataset.append(key, item)
+    # Replacing an item moves it to another target
+    moved = dict(data['00000000'], target='T999')
+    dataset.append('00000000', moved)
+    data['00000000'] = moved
+    assert dataset.targets == StreetViewDataset(dict(data)).targets
+
+def test_default_data_is_not_shared():
+    StreetViewDataset().append('k', {'target': 'T000', 'lng': 0.0, 'lat': 0.0})
+    assert StreetViewDataset().data == {}
+
+def test_given_targets_stay_fixed():
+    targets = {0: {'name': 'T001', 'lng': 1.0, 'lat': 1.0, 'frequency': 1.0}}
+    dataset = StreetViewDataset({'a': {'target': 'T001', 'lng': 1.0, 'lat': 1.0}}, targets)
+    dataset.append('b', {'target': 'T000', 'lng': 0.0, 'lat': 0.0})
+    assert dataset.targets == targets
+    assert 'b' in dataset.data
+
+def test_store_resumes_and_rolls_over(tmp_path):
+    image = make_jpeg(128, 64)
+    with HarvestStore(str(tmp_path), shard_size=3) as store:
+        for i in range(7):
+            assert store.append(f'k{i}', image, f'T{i % 2:03d}', float(i), float(i))
+        assert not store.append('k0', image, 'T000', 0.0, 0.0)
+        assert not store.append('bad', b'not an image', 'T000', 0.0, 0.0)
+        # The open shard is readable before closing
+        with tarfile.open(str(tmp_path / 'shard-00002.tar'), 'r') as tar:
+            assert tar.getnames() == ['k6.jpg']
+        targets = store.dataset.targets
+    with HarvestStore(str(tmp_path), shard_size=3) as store:
+        assert len(store) == 7 and store.dataset.targets == targets
+        assert store.append('k7', image, 'T000', 0.0, 0.0)
+    with tarfile.open(str(tmp_path / 'shard-00002.tar'), 'r') as tar:
+        assert tar.getnames() == ['k6.jpg', 'k7.jpg']
+    dataset = StreetViewShardDataset(str(tmp_path), views=[lambda x: x], transform=lambda x: x, shuffle_buffer=0)
+    assert len(dataset) == len(list(dataset)) == 8
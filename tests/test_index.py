@@ -0,0 +1,19 @@
+import json
+import numpy as np
+from Benchmark import make_jpeg, make_street_view_data
+from Dataset import StreetViewDataset, StreetViewImageDataset
+
+
+def test_build_index_drops_unknown_targets(tmp_path):
+    data = make_street_view_data(40, num_targets=4)
+    for i, key in enumerate(data.keys()):
+        (tmp_path / (key + StreetViewImageDataset.image_ext)).write_bytes(make_jpeg(128, 64, seed=i))
+    targets = StreetViewDataset(json.loads(json.dumps(data))).targets
+    known = {0: targets[0], 1: targets[1]}
+    expected = [k for k, v in data.items() if v['target'] in (known[0]['name'], known[1]['name'])]
+    dataset = StreetViewImageDataset(str(tmp_path), StreetViewDataset(data, known))
+    assert dataset.keys == expected
+    assert len(dataset.dropped) == 40 - len(expected)
+    assert all(reason.startswith('unknown target') for reason in dataset.dropped.values())
+    assert set(np.unique(dataset.labels).tolist()) <= {0, 1}
+    assert dataset[0][1] == int(dataset.labels[0])
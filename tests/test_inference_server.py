@@ -0,0 +1,52 @@
+import torch
+import torch.nn as nn
+from Benchmark import make_jpeg
+from Dataset import StreetViewImageDataset
+from Inference import TuxunPredictor, TuxunInferenceServer
+
+
+class _RecordingModel(nn.Module):
+    # Records the batch size of every forward pass
+
+    def __init__(self, num_classes:int):
+        super().__init__()
+        self.linear = nn.Linear(3, num_classes)
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(len(x))
+        return self.linear(x.mean(dim=(2, 3)))
+
+def _make_mapping(num_classes:int):
+    return {str(i): {'name': f'T{i:03d}', 'lng': float(i), 'lat': 0.0} for i in range(num_classes)}
+
+def test_server_batches_pending_requests():
+    torch.manual_seed(0)
+    predictor = TuxunPredictor(_RecordingModel(6).eval(), _make_mapping(6))
+    images = [StreetViewImageDataset.decode_image(make_jpeg(128, 64, seed=i)) for i in range(5)]
+    expected = [predictor.predict(img, k=3) for img in images]
+    predictor.model.batch_sizes.clear()
+    server = TuxunInferenceServer(predictor, max_batch_size=64, max_wait=50)
+    # Submitted before the worker starts, so the requests are collected into one batch
+    futures = [server.submit(img, k=3) for img in images]
+    server.start()
+    results = [f.result(timeout=30) for f in futures]
+    server.stop()
+    views = len(predictor.policy.views)
+    assert predictor.model.batch_sizes == [views * len(images)]
+    for result, ref in zip(results, expected):
+        assert [t['index'] for t in result] == [t['index'] for t in ref]
+        assert all(abs(a['confidence'] - b['confidence']) < 1e-5 for a, b in zip(result, ref))
+
+def test_server_respects_max_batch_size():
+    predictor = TuxunPredictor(_RecordingModel(6).eval(), _make_mapping(6))
+    images = [StreetViewImageDataset.decode_image(make_jpeg(128, 64, seed=i)) for i in range(5)]
+    server = TuxunInferenceServer(predictor, max_batch_size=4, max_wait=50)
+    futures = [server.submit(img) for img in images]
+    server.start()
+    for f in futures:
+        f.result(timeout=30)
+    server.stop()
+    views = len(predictor.policy.views)
+    assert sum(predictor.model.batch_sizes) == views * len(images)
+    assert max(predictor.model.batch_sizes) <= max(4, views)
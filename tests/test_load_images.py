@@ -0,0 +1,27 @@
+import json
+from Benchmark import make_jpeg, make_street_view_data
+from Dataset import StreetViewDataset, StreetViewImageDataset
+
+
+def _write_images(root, data:dict, corrupt:tuple=()):
+    for i, key in enumerate(data.keys()):
+        binary = b'not an image' if i in corrupt else make_jpeg(128, 64, seed=i)
+        (root / (key + StreetViewImageDataset.image_ext)).write_bytes(binary)
+
+def test_invalid_images_are_dropped(tmp_path):
+    data = make_street_view_data(10, num_targets=2)
+    _write_images(tmp_path, data, corrupt=(2,))
+    (tmp_path / ('00000005' + StreetViewImageDataset.image_ext)).unlink()
+    dataset = StreetViewImageDataset(str(tmp_path), StreetViewDataset(data))
+    assert sorted(dataset.dropped.keys()) == ['00000002', '00000005']
+    assert len(dataset.keys) == 8
+
+def test_manifest_keeps_other_splits(tmp_path):
+    data = make_street_view_data(20, num_targets=2)
+    _write_images(tmp_path, data)
+    keys = list(data.keys())
+    StreetViewImageDataset(str(tmp_path), StreetViewDataset({k: dict(data[k]) for k in keys[:10]}))
+    StreetViewImageDataset(str(tmp_path), StreetViewDataset({k: dict(data[k]) for k in keys[10:]}))
+    manifest = json.loads((tmp_path / StreetViewImageDataset.manifest_file).read_text(encoding='UTF-8'))
+    assert sorted(manifest.keys()) == keys
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith('.tmp')]
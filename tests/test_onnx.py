@@ -0,0 +1,20 @@
+import sys, json
+import pytest
+import torch.nn as nn
+from Export import export_onnx
+from Inference import TuxunPredictor
+
+
+def test_export_without_onnx(monkeypatch, tmp_path):
+    # A `None` entry makes the import fail as if the package were not installed
+    monkeypatch.setitem(sys.modules, 'onnxscript', None)
+    with pytest.raises(ImportError, match='pip install onnx onnxscript'):
+        export_onnx(nn.Linear(3, 2), str(tmp_path / 'model.onnx'))
+    assert not (tmp_path / 'model.onnx').exists()
+
+def test_load_without_onnxruntime(monkeypatch, tmp_path):
+    monkeypatch.setitem(sys.modules, 'onnxruntime', None)
+    mapping = tmp_path / 'mapping.json'
+    mapping.write_text(json.dumps({'0': {'name': 'T000', 'lng': 0.0, 'lat': 0.0}}))
+    with pytest.raises(ImportError, match='pip install onnxruntime'):
+        TuxunPredictor.load(str(tmp_path / 'model.onnx'), str(mapping))
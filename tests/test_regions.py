@@ -0,0 +1,48 @@
+import json
+import pytest
+import torch
+from Benchmark import make_jpeg
+from Inference import TuxunPredictor
+from Model import TuxunAIModelV0, TuxunAIStudentModel
+
+
+def _make_mapping(num_classes:int):
+    return {str(i): {'name': f'T{i:03d}', 'lng': float(i), 'lat': 0.0} for i in range(num_classes)}
+
+def test_region_heads_are_saved_beside_the_regions(tmp_path):
+    num_classes = 3
+    model = TuxunAIStudentModel(classifier=TuxunAIStudentModel.get_classifier(num_classes)).eval()
+    model.set_region_heads({0: 2, 2: 3})
+    assert model.region_heads['0'][0].in_features == TuxunAIStudentModel.num_features
+    model_path, regions_path = str(tmp_path / 'model.pth'), str(tmp_path / 'regions.json')
+    torch.save(model.get_main_state_dict(), model_path)
+    torch.save(model.region_heads.state_dict(), TuxunAIModelV0.get_region_heads_path(regions_path))
+    assert not [k for k in torch.load(model_path) if k.startswith('region_heads.')]
+    mapping_path = tmp_path / 'mapping.json'
+    mapping_path.write_text(json.dumps(_make_mapping(num_classes)), encoding='UTF-8')
+    regions = {'0': {str(j): {'name': f'R{j}', 'lng': 0.0, 'lat': 0.0} for j in range(2)},
+        '2': {str(j): {'name': f'R{j}', 'lng': 0.0, 'lat': 0.0} for j in range(3)}}
+    with open(regions_path, 'w', encoding='UTF-8') as f:
+        json.dump(regions, f)
+
+    # The main weights load strictly without the regions file
+    plain = TuxunPredictor.load(model_path, str(mapping_path))
+    assert plain.regions is None and len(plain.model.region_heads) == 0
+    predictor = TuxunPredictor.load(model_path, str(mapping_path), regions_path)
+    for name, value in model.state_dict().items():
+        assert torch.equal(predictor.model.state_dict()[name], value)
+    result = predictor.predict_regions(make_jpeg(256, 128), k=3)
+    assert len(result) == 3
+
+def test_incomplete_main_weights_are_rejected(tmp_path):
+    model = TuxunAIStudentModel(classifier=TuxunAIStudentModel.get_classifier(3))
+    state_dict = model.get_main_state_dict()
+    state_dict.pop('features.0.0.weight')
+    model_path, regions_path = str(tmp_path / 'model.pth'), str(tmp_path / 'regions.json')
+    torch.save(state_dict, model_path)
+    model.set_region_heads({0: 2})
+    torch.save(model.region_heads.state_dict(), TuxunAIModelV0.get_region_heads_path(regions_path))
+    (tmp_path / 'regions.json').write_text(json.dumps({'0': {'0': {}, '1': {}}}), encoding='UTF-8')
+    (tmp_path / 'mapping.json').write_text(json.dumps(_make_mapping(3)), encoding='UTF-8')
+    with pytest.raises(RuntimeError):
+        TuxunPredictor.load(model_path, str(tmp_path / 'mapping.json'), regions_path)
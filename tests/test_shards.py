@@ -0,0 +1,57 @@
+import os, sys, json, subprocess
+from Benchmark import make_jpeg
+from Dataset import StreetViewDataset, StreetViewImageDataset, StreetViewShardDataset
+
+
+def _make_shards(tmp_path, size:int=30, corrupt:tuple=()):
+    images, shards = tmp_path / 'images', tmp_path / 'shards'
+    images.mkdir()
+    # One target per sample, so that the labels identify the samples
+    data = {f'{i:04d}': {'target': f'T{i:03d}', 'lng': float(i), 'lat': float(i) / 2} for i in range(size)}
+    for i, key in enumerate(data.keys()):
+        binary = b'not an image' if i in corrupt else make_jpeg(128, 64, seed=i)
+        (images / (key + StreetViewImageDataset.image_ext)).write_bytes(binary)
+    count = StreetViewDataset(data).to_shards(str(images), str(shards), shard_size=7)
+    return str(shards), data, count
+
+def _identity(img):
+    return img
+
+def _labels(dataset:StreetViewShardDataset):
+    return [label for _, label in dataset]
+
+def test_round_trip(tmp_path):
+    root, data, count = _make_shards(tmp_path)
+    assert count == len(data)
+    dataset = StreetViewShardDataset(root, views=[_identity], transform=_identity, shuffle_buffer=0)
+    names = [dataset.targets[label]['name'] for label in _labels(dataset)]
+    assert names == [v['target'] for v in data.values()]
+    assert len(dataset) == len(data)
+
+def test_invalid_images_are_not_written(tmp_path):
+    root, data, count = _make_shards(tmp_path, corrupt=(3, 11))
+    assert count == len(data) - 2
+    dataset = StreetViewShardDataset(root, views=[_identity], transform=_identity)
+    assert len(dataset) == len(_labels(dataset)) == count
+
+def test_len_without_index_counts_known_targets(tmp_path):
+    root, data, _ = _make_shards(tmp_path)
+    os.remove(os.path.join(root, StreetViewShardDataset.index_file))
+    targets = {0: {'name': 'T000', 'lng': 0.0, 'lat': 0.0}, 1: {'name': 'T005', 'lng': 5.0, 'lat': 2.5}}
+    dataset = StreetViewShardDataset(root, targets, views=[_identity], transform=_identity)
+    assert len(dataset) == len(_labels(dataset)) == 2
+
+def test_shuffle_is_reproducible_across_processes(tmp_path):
+    root, _, _ = _make_shards(tmp_path)
+    code = ("import sys; sys.path.insert(0, sys.argv[1]); from Dataset import StreetViewShardDataset; "
+        "ds = StreetViewShardDataset(sys.argv[2], views=[lambda x: x], transform=lambda x: x, shuffle_buffer=8); ds.set_epoch(2); "
+        "print([label for _, label in ds])")
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    orders = []
+    # The hash of the strings is salted by PYTHONHASHSEED, which must not change the order
+    for hash_seed in ('1', '2'):
+        out = subprocess.run([sys.executable, '-c', code, repo, root], env=dict(os.environ, PYTHONHASHSEED=hash_seed),
+            capture_output=True, text=True, check=True).stdout
+        orders.append(json.loads(out))
+    assert orders[0] == orders[1]
+    assert orders[0] != sorted(orders[0])
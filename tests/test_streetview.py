@@ -0,0 +1,115 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import pytest
+from PIL import Image
+from Benchmark import start_fake_server
+from Cache import DiskCache
+from TuxunAgent import StreetView
+
+PANO = 'p' * 22
+
+
+class _TileHandler(BaseHTTPRequestHandler):
+    # Serves a tile colored by its coordinates at /tile/{pano}/{x}/{y}/{z}, failing the first requests of each tile
+    failures = 0
+    codes:dict = None
+    lock:threading.Lock = None
+
+    def do_GET(self):
+        _, _, _, x, y, z = self.path.split('/')
+        with self.lock:
+            seen = self.codes.setdefault(self.path, [])
+            code = 503 if len(seen) < self.failures else 200
+            seen.append(code)
+        if code != 200:
+            self.send_response(code)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        buffer = BytesIO()
+        Image.new('RGB', (16, 8), (int(x) * 60, int(y) * 60, int(z) * 60)).save(buffer, 'PNG')
+        body = buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def tile_server():
+    saved = StreetView.google_url, StreetView.cache, StreetView.backoff
+    servers = []
+
+    def start(failures:int=0):
+        handler = type('_Handler', (_TileHandler,), {'failures': failures, 'codes': {}, 'lock': threading.Lock()})
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        StreetView.google_url = f"http://127.0.0.1:{server.server_address[1]}" + "/tile/{pano}/{x}/{y}/{z}"
+        StreetView.cache = None
+        StreetView.backoff = 0.01
+        return handler
+
+    yield start
+    for server in servers:
+        server.shutdown()
+    StreetView.google_url, StreetView.cache, StreetView.backoff = saved
+
+def test_panorama_stitches_tiles_in_place(tile_server):
+    tile_server()
+    img = StreetView(PANO).get_panorama(z=2)
+    assert img.size == (16 * 4, 8 * 2)
+    for y in range(2):
+        for x in range(4):
+            assert img.getpixel((x * 16 + 8, y * 8 + 4)) == (x * 60, y * 60, 120)
+
+def test_tiles_retried_on_server_errors(tile_server):
+    handler = tile_server(failures=2)
+    img = StreetView(PANO).get_panorama(z=1)
+    assert isinstance(img, Image.Image)
+    assert len(handler.codes) == 2
+    assert all(codes == [503, 503, 200] for codes in handler.codes.values())
+
+def test_tile_error_after_retries(tile_server):
+    handler = tile_server(failures=StreetView.retries + 1)
+    result = StreetView(PANO).get_panorama(z=0)
+    assert isinstance(result, Exception)
+    assert [len(codes) for codes in handler.codes.values()] == [StreetView.retries + 1]
+
+def test_cached_tiles_not_fetched(tile_server, tmp_path):
+    handler = tile_server()
+    StreetView.cache = DiskCache(str(tmp_path))
+    first = StreetView(PANO).get_panorama(z=1)
+    second = StreetView(PANO).get_panorama(z=1)
+    assert sum(len(codes) for codes in handler.codes.values()) == 2
+    assert first.tobytes() == second.tobytes()
+
+def test_fake_server_panorama():
+    saved = StreetView.google_url, StreetView.cache
+    server, base_url = start_fake_server(tile_size=(64, 32))
+    try:
+        StreetView.google_url = base_url + "/tile/{pano}/{x}/{y}/{z}"
+        StreetView.cache = None
+        assert StreetView(PANO).get_panorama(z=1).size == (128, 32)
+    finally:
+        server.shutdown()
+        StreetView.google_url, StreetView.cache = saved
+
+def test_session_created_once_across_threads():
+    sessions = []
+    barrier = threading.Barrier(8)
+
+    def get():
+        barrier.wait()
+        sessions.append(StreetView.get_session())
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len({id(s) for s in sessions}) == 1
@@ -0,0 +1,38 @@
+import pickle
+import numpy as np
+import torch
+from Benchmark import make_jpeg, make_street_view_data
+from Dataset import StreetViewDataset, StreetViewImageDataset, StreetViewCachedImageDataset
+
+
+def _make_dataset(root, size:int):
+    data = make_street_view_data(size, num_targets=3)
+    for i, key in enumerate(data.keys()):
+        (root / (key + StreetViewImageDataset.image_ext)).write_bytes(make_jpeg(128, 64, seed=i))
+    return StreetViewImageDataset(str(root), StreetViewDataset(data))
+
+def test_round_trip_matches_live(tmp_path):
+    live = _make_dataset(tmp_path, 5)
+    cache_dir = tmp_path / 'cache'
+    assert live.export_cache(str(cache_dir)) == 5
+    cached = StreetViewCachedImageDataset(str(cache_dir))
+    assert cached.keys == live.keys
+    assert cached.targets == live.targets
+    assert np.array_equal(cached.labels, live.labels)
+    assert len(cached) == len(live)
+    for i in range(len(live)):
+        (x, y), (ref, ref_y) = cached[i], live[i]
+        assert y == ref_y
+        assert x.dtype == ref.dtype and x.shape == ref.shape
+        # The cache stores uint8 pixels, which the live transform rounds to as well
+        assert torch.allclose(x, ref, atol=1e-5)
+
+def test_pickled_without_memmap(tmp_path):
+    live = _make_dataset(tmp_path, 3)
+    live.export_cache(str(tmp_path / 'cache'))
+    cached = StreetViewCachedImageDataset(str(tmp_path / 'cache'))
+    x = cached[1][0]
+    # The DataLoader workers reopen the memory map by themselves
+    copy = pickle.loads(pickle.dumps(cached))
+    assert copy._StreetViewCachedImageDataset__images is None
+    assert torch.equal(copy[1][0], x)
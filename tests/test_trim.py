@@ -0,0 +1,12 @@
+from Benchmark import make_jpeg, check_trim_parity
+from Dataset import StreetViewImageDataset
+
+
+def test_trim_parity():
+    assert check_trim_parity(sizes=((512, 512), (416, 208), (1024, 512)), seeds=range(2)) == []
+
+def test_trim_box_of_blank_strip():
+    img = StreetViewImageDataset.decode_image(make_jpeg(256, 128))
+    left, upper, right, lower = StreetViewImageDataset.get_trim_box(img)
+    assert (left, upper, right) == (0, 0, 256)
+    assert 128 - 128 // 8 - 2 <= lower <= 128 - 128 // 8 + 2
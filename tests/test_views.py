@@ -0,0 +1,37 @@
+import torch
+from PIL import Image
+from Benchmark import make_jpeg, make_street_view_data
+from Dataset import StreetViewDataset, StreetViewImageDataset
+
+
+def _make_dataset(root, size:int, views:list=None):
+    data = make_street_view_data(size, num_targets=3)
+    for i, key in enumerate(data.keys()):
+        (root / (key + StreetViewImageDataset.image_ext)).write_bytes(make_jpeg(128, 64, seed=i))
+    return StreetViewImageDataset(str(root), StreetViewDataset(data), views=views)
+
+def test_views_of_same_sample(tmp_path):
+    ds = _make_dataset(tmp_path, 4)
+    n = len(ds.keys)
+    assert len(ds) == n * len(StreetViewImageDataset.enhance_methods)
+    for i in range(n):
+        (left, label), (right, label_right) = ds[i], ds[i + n]
+        assert label == label_right == ds.target_indices[ds.data[ds.keys[i]]['target']]
+        assert left.shape == right.shape
+        assert not torch.equal(left, right)
+        # Every view is taken from the sample at the same position
+        img = ds.trim_image_bottom_blank(ds.decode_image(ds.data[ds.keys[i]]['image'], ds.decode_size))
+        assert torch.allclose(left, ds.transform(ds.views[0](img)))
+        assert torch.allclose(right, ds.transform(ds.views[1](img)))
+
+def test_index_wraps_around(tmp_path):
+    ds = _make_dataset(tmp_path, 3)
+    assert torch.equal(ds[len(ds) + 1][0], ds[1][0])
+
+def test_custom_views(tmp_path):
+    flip = lambda img: img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    ds = _make_dataset(tmp_path, 3, views=[lambda img: img, flip, flip])
+    n = len(ds.keys)
+    assert len(ds) == 3 * n
+    assert torch.equal(ds[n][0], ds[2 * n][0])
+    assert torch.allclose(ds[n][0], ds[0][0].flip(-1), atol=1e-5)